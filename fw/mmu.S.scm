@@ -1,6 +1,8 @@
 (define MMU-FAULT-REASON #x010300)
 (define MMU-PT-PTR #x010304)
 (define MMU-TLB-FLUSH #x010308)
+(define MMU-ASID #x01030A)
+(define MMU-TLB-FLUSH-ASID #x01030B)
 
 
 (list
@@ -16,20 +16,10 @@
 
 
   (proc puts .a-bits 16 .xy-bits 16
-	,.a8
-
-	#:more
-	lda (x-abs 0)
-	beq done
 	phx
-	jsr putc
+	jsr uart-puts
 	plx
-	inc (x-reg)
-	bra more
-
-	#:done
-	,.a16
-	rts)
+	jmp video-puts)
 
 
   (proc puthex-nibble
@@ -2,6 +2,10 @@
 
 (define VIDEO-CHAR #x0500)
 (define VIDEO-STATUS #x0501)
+(define VIDEO-LEVEL #x0502)
+
+(define VIDEO-FIFO-DEPTH 256)
+(define VIDEO-WINDOW #x030000)
 
 (define (bank-plb bank)
   (* #x0101 bank))
@@ -21,4 +25,30 @@
 	sta (abs ,VIDEO-CHAR)
 
 	plb plp
+	rts)
+
+  ;; Writes the string through the write window, only checking how much
+  ;; room there is in the FIFO once per batch of characters.
+  (proc video-puts .a-bits 16 .xy-bits 16
+	#:batch
+	lda (far-abs ,(+ (* MMIO-BANK #x10000) VIDEO-LEVEL))
+	eor (imm #xFFFF)
+	clc
+	adc (imm ,(+ VIDEO-FIFO-DEPTH 1))
+	beq batch
+	tay
+
+	,.a8
+	#:more
+	lda (x-abs 0)
+	beq done
+	sta (far-abs ,VIDEO-WINDOW)
+	inc (x-reg)
+	dec (y-reg)
+	bne more
+	,.a16
+	bra batch
+
+	#:done
+	,.a16
 	rts)))
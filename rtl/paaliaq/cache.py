@@ -0,0 +1,344 @@
+from amaranth import *
+from amaranth.lib import data, wiring
+from amaranth.lib.memory import Memory
+from amaranth.lib.wiring import In, Out
+from amaranth.utils import exact_log2
+from amaranth_soc import wishbone, csr
+
+
+# A write-back, write-allocate cache sitting in front of a (wider,
+# burst-capable) memory controller. Lines are filled and written back
+# with incrementing bursts. Each way has its own tag and data memories,
+# so all ways of a set are looked up at once. With more than one way,
+# victims are picked round-robin (preferring invalid ways).
+#
+# The cache also exposes a small CSR block with hit/miss/write-back
+# counters, and controls to flush (write back dirty lines and
+# invalidate) or invalidate (drop all lines) the whole cache. Both
+# control bits read back as 1 until the operation completes.
+class WishboneCache(wiring.Component):
+    class ControlRegister(csr.Register, access="rw"):
+        flush:       csr.Field(csr.action.RW1S, 1)
+        invalidate:  csr.Field(csr.action.RW1S, 1)
+        clear_stats: csr.Field(csr.action.W, 1)
+        _unused:     csr.Field(csr.action.ResR0WA, 5)
+
+    class CounterRegister(csr.Register, access="r"):
+        value: csr.Field(csr.action.R, 32)
+
+
+    def __init__(self, target_bus, *, ways=2, sets=128, line_words=8, data_width=8):
+        if target_bus.granularity != data_width:
+            raise ValueError(f"Target bus granularity must be {data_width}, "
+                             f"not {target_bus.granularity}")
+        if not {"cti", "bte"} <= {feature.value for feature in target_bus.features}:
+            raise ValueError("Target bus must support bursts")
+
+        self._tgt_bus = target_bus
+        self._ways = ways
+        self._sets = sets
+        self._line_words = line_words
+        self._ratio = target_bus.data_width // data_width
+
+        super().__init__({
+            "wb_bus": In(wishbone.Signature(
+                addr_width=target_bus.addr_width + exact_log2(self._ratio),
+                data_width=data_width,
+            )),
+            "csr_bus": In(csr.Signature(addr_width=4, data_width=8)),
+        })
+
+        target_bus.memory_map.freeze()
+        self.wb_bus.memory_map = target_bus.memory_map
+
+        regs = csr.Builder(addr_width=4, data_width=8)
+
+        self._control = regs.add("Control", self.ControlRegister())
+        self._hits = regs.add("Hits", self.CounterRegister(), offset=4)
+        self._misses = regs.add("Misses", self.CounterRegister())
+        self._writebacks = regs.add("Writebacks", self.CounterRegister())
+
+        mmap = regs.as_memory_map()
+        self._bridge = csr.Bridge(mmap)
+        self.csr_bus.memory_map = mmap
+
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.bridge = self._bridge
+        wiring.connect(m, wiring.flipped(self.csr_bus), self._bridge.bus)
+
+        tgt = self._tgt_bus
+
+        # Address layout (in manager bus units):
+        #   [ tag | set | word in line | lane in word ]
+        lane_bits = exact_log2(self._ratio)
+        word_bits = exact_log2(self._line_words)
+        set_bits = exact_log2(self._sets)
+        tag_bits = tgt.addr_width - word_bits - set_bits
+
+        if tag_bits <= 0:
+            raise ValueError("Cache is larger than the memory behind it")
+
+        class TagEntry(data.Struct):
+            valid: 1
+            dirty: 1
+            tag:   tag_bits
+
+        adr = self.wb_bus.adr
+        req_lane = adr[:lane_bits]
+        req_word = adr[lane_bits:][:word_bits]
+        req_set = adr[lane_bits + word_bits:][:set_bits]
+        req_tag = adr[lane_bits + word_bits + set_bits:]
+
+        tag_rd, tag_wr, data_rd, data_wr = [], [], [], []
+        for way in range(self._ways):
+            tag_mem = Memory(shape=TagEntry, depth=self._sets, init=[])
+            data_mem = Memory(shape=tgt.data_width, depth=self._sets * self._line_words, init=[])
+            m.submodules[f"tag_{way}"] = tag_mem
+            m.submodules[f"data_{way}"] = data_mem
+
+            tag_rd.append(tag_mem.read_port())
+            tag_wr.append(tag_mem.write_port())
+            data_rd.append(data_mem.read_port())
+            data_wr.append(data_mem.write_port(granularity=self.wb_bus.data_width))
+
+        tag_rd_addr, tag_wr_addr = Signal(set_bits), Signal(set_bits)
+        data_rd_addr, data_wr_addr = Signal(set_bits + word_bits), Signal(set_bits + word_bits)
+        for way in range(self._ways):
+            m.d.comb += [
+                tag_rd[way].addr.eq(tag_rd_addr),
+                tag_wr[way].addr.eq(tag_wr_addr),
+                data_rd[way].addr.eq(data_rd_addr),
+                data_wr[way].addr.eq(data_wr_addr),
+            ]
+
+        # Lookup results
+        hits = Signal(self._ways)
+        for way in range(self._ways):
+            m.d.comb += hits[way].eq(tag_rd[way].data.valid & (tag_rd[way].data.tag == req_tag))
+
+        hit_way = Signal(range(self._ways))
+        for way in reversed(range(self._ways)):
+            with m.If(hits[way]):
+                m.d.comb += hit_way.eq(way)
+
+        tags = Array(port.data for port in tag_rd)
+        words = Array(port.data for port in data_rd)
+
+        # Line being written back or filled.
+        cur_way = Signal(range(self._ways))
+        cur_set = Signal(set_bits)
+        cur_tag = Signal(tag_bits)
+        cur_word = Signal(word_bits)
+        last_word = cur_word == self._line_words - 1
+
+        victim_ctr = Signal(range(self._ways))
+        refilled = Signal()
+
+        flushing = Signal()
+
+        flush_pending = self._control.f.flush.data
+        invalidate_pending = self._control.f.invalidate.data
+
+        hit_ctr = Signal(32)
+        miss_ctr = Signal(32)
+        writeback_ctr = Signal(32)
+
+        m.d.comb += [
+            self._hits.f.value.r_data.eq(hit_ctr),
+            self._misses.f.value.r_data.eq(miss_ctr),
+            self._writebacks.f.value.r_data.eq(writeback_ctr),
+        ]
+
+        m.d.comb += [
+            tgt.bte.eq(wishbone.BurstTypeExt.LINEAR),
+            tgt.sel.eq((1 << self._ratio) - 1),
+            tgt.stb.eq(tgt.cyc),
+            tgt.adr.eq(Cat(cur_word, cur_set, cur_tag)),
+            tgt.dat_w.eq(words[cur_way]),
+        ]
+        with m.If(last_word):
+            m.d.comb += tgt.cti.eq(wishbone.CycleType.END_OF_BURST)
+        with m.Else():
+            m.d.comb += tgt.cti.eq(wishbone.CycleType.INCR_BURST)
+
+        m.d.comb += [
+            self.wb_bus.dat_r.eq(words[hit_way].word_select(req_lane, self.wb_bus.data_width)),
+        ]
+
+        with m.FSM():
+            with m.State("idle"):
+                m.d.comb += [
+                    tag_rd_addr.eq(req_set),
+                    data_rd_addr.eq(Cat(req_word, req_set)),
+                ]
+
+                with m.If(flush_pending | invalidate_pending):
+                    m.d.sync += [
+                        cur_set.eq(0),
+                        flushing.eq(1),
+                    ]
+                    m.next = "flush-read"
+                with m.Elif(self.wb_bus.cyc & self.wb_bus.stb):
+                    m.next = "lookup"
+
+            with m.State("lookup"):
+                m.d.comb += [
+                    tag_rd_addr.eq(req_set),
+                    data_rd_addr.eq(Cat(req_word, req_set)),
+                ]
+
+                with m.If(hits != 0):
+                    m.d.comb += self.wb_bus.ack.eq(1)
+                    m.d.sync += refilled.eq(0)
+                    with m.If(~refilled):
+                        m.d.sync += hit_ctr.eq(hit_ctr + 1)
+
+                    with m.If(self.wb_bus.we):
+                        m.d.comb += [
+                            data_wr_addr.eq(Cat(req_word, req_set)),
+                            data_wr[0].data.eq(Cat(self.wb_bus.dat_w for _ in range(self._ratio))),
+                            tag_wr_addr.eq(req_set),
+                        ]
+                        for way in range(self._ways):
+                            with m.If(hit_way == way):
+                                m.d.comb += [
+                                    data_wr[way].en.eq(Mux(self.wb_bus.sel, 1 << req_lane, 0)),
+                                    tag_wr[way].data.eq(tag_rd[way].data),
+                                    tag_wr[way].data.dirty.eq(1),
+                                    tag_wr[way].en.eq(1),
+                                ]
+                    m.next = "idle"
+                with m.Else():
+                    m.d.sync += miss_ctr.eq(miss_ctr + 1)
+
+                    # Pick a victim, preferring invalid ways.
+                    victim = Signal(range(self._ways))
+                    m.d.comb += victim.eq(victim_ctr)
+                    for way in reversed(range(self._ways)):
+                        with m.If(~tag_rd[way].data.valid):
+                            m.d.comb += victim.eq(way)
+                    m.d.sync += [
+                        victim_ctr.eq(Mux(victim_ctr == self._ways - 1, 0, victim_ctr + 1)),
+                        cur_way.eq(victim),
+                        cur_set.eq(req_set),
+                        cur_word.eq(0),
+                        refilled.eq(1),
+                    ]
+
+                    with m.If(tags[victim].valid & tags[victim].dirty):
+                        m.d.sync += cur_tag.eq(tags[victim].tag)
+                        m.next = "writeback-start"
+                    with m.Else():
+                        m.d.sync += cur_tag.eq(req_tag)
+                        m.next = "fill"
+
+            # Write back the line at cur_way/cur_set/cur_tag.
+            with m.State("writeback-start"):
+                # Data for the first word is available in the next cycle.
+                m.d.comb += data_rd_addr.eq(Cat(cur_word, cur_set))
+                m.next = "writeback"
+            with m.State("writeback"):
+                m.d.comb += [
+                    tgt.cyc.eq(1),
+                    tgt.we.eq(1),
+                    # Keep the read port one word ahead of the bus.
+                    data_rd_addr.eq(Cat((cur_word + tgt.ack)[:word_bits], cur_set)),
+                ]
+                with m.If(tgt.ack):
+                    m.d.sync += cur_word.eq(cur_word + 1)
+                    with m.If(last_word):
+                        m.d.sync += writeback_ctr.eq(writeback_ctr + 1)
+                        with m.If(flushing):
+                            # Keep the line, but mark it as clean.
+                            m.d.comb += tag_wr_addr.eq(cur_set)
+                            for way in range(self._ways):
+                                with m.If(cur_way == way):
+                                    m.d.comb += [
+                                        tag_wr[way].data.valid.eq(1),
+                                        tag_wr[way].data.tag.eq(cur_tag),
+                                        tag_wr[way].en.eq(1),
+                                    ]
+                            m.next = "flush-read"
+                        with m.Else():
+                            m.d.sync += cur_tag.eq(req_tag)
+                            m.next = "fill"
+
+            # Fill the line at cur_way/cur_set from cur_tag.
+            with m.State("fill"):
+                m.d.comb += [
+                    tgt.cyc.eq(1),
+                    tgt.we.eq(0),
+                    data_wr_addr.eq(Cat(cur_word, cur_set)),
+                    data_wr[0].data.eq(tgt.dat_r),
+                ]
+                with m.If(tgt.ack):
+                    m.d.sync += cur_word.eq(cur_word + 1)
+                    for way in range(self._ways):
+                        with m.If(cur_way == way):
+                            m.d.comb += data_wr[way].en.eq((1 << self._ratio) - 1)
+                    with m.If(last_word):
+                        m.d.comb += tag_wr_addr.eq(cur_set)
+                        for way in range(self._ways):
+                            with m.If(cur_way == way):
+                                m.d.comb += [
+                                    tag_wr[way].data.valid.eq(1),
+                                    tag_wr[way].data.tag.eq(cur_tag),
+                                    tag_wr[way].en.eq(1),
+                                ]
+                        # Retry the lookup, which will now hit.
+                        m.next = "idle"
+
+            # Walk through all the sets, writing back dirty lines (unless
+            # just invalidating), and then invalidating them.
+            with m.State("flush-read"):
+                m.d.comb += tag_rd_addr.eq(cur_set)
+                m.next = "flush-check"
+            with m.State("flush-check"):
+                m.d.comb += tag_rd_addr.eq(cur_set)
+
+                dirty = Signal(self._ways)
+                for way in range(self._ways):
+                    m.d.comb += dirty[way].eq(tag_rd[way].data.valid & tag_rd[way].data.dirty)
+
+                with m.If((dirty != 0) & flush_pending):
+                    for way in reversed(range(self._ways)):
+                        with m.If(dirty[way]):
+                            m.d.sync += [
+                                cur_way.eq(way),
+                                cur_tag.eq(tag_rd[way].data.tag),
+                            ]
+                    m.d.sync += cur_word.eq(0)
+                    m.next = "writeback-start"
+                with m.Else():
+                    m.d.comb += tag_wr_addr.eq(cur_set)
+                    for way in range(self._ways):
+                        m.d.comb += [
+                            tag_wr[way].data.eq(0),
+                            tag_wr[way].en.eq(1),
+                        ]
+
+                    m.d.sync += cur_set.eq(cur_set + 1)
+                    with m.If(cur_set == self._sets - 1):
+                        m.d.comb += [
+                            self._control.f.flush.clear.eq(1),
+                            self._control.f.invalidate.clear.eq(1),
+                        ]
+                        m.d.sync += flushing.eq(0)
+                        m.next = "idle"
+                    with m.Else():
+                        m.next = "flush-read"
+
+        for port in data_wr[1:]:
+            m.d.comb += port.data.eq(data_wr[0].data)
+
+        with m.If(self._control.f.clear_stats.w_stb & self._control.f.clear_stats.w_data):
+            m.d.sync += [
+                hit_ctr.eq(0),
+                miss_ctr.eq(0),
+                writeback_ctr.eq(0),
+            ]
+
+        return m
@@ -1,9 +1,13 @@
 from amaranth import *
-from amaranth.lib import wiring, io
+from amaranth.lib import wiring, io, data
 from amaranth.lib.wiring import In, Out
+from amaranth.lib.memory import Memory
+from amaranth.utils import exact_log2
 from amaranth_soc import wishbone, event, csr
 
 from paaliaq.mmu import MMUSignature
+from paaliaq.pmu import PerfEventSignature
+from paaliaq.testseq import TestSeqSignature
 
 class W65C816BusSignature(wiring.Signature):
     def __init__(self):
@@ -100,12 +104,33 @@ class P65C816SoftCore(wiring.Component):
         return m
 
 
+class TraceEntry(data.Struct):
+    vaddr: 24
+    paddr: 24
+    data:  8
+    vpa:   1
+    vda:   1
+    vpb:   1
+    rwb:   1
+    abort: 1
+    _unused: 3
+
+
 class W65C816WishboneBridge(wiring.Component):
     irq: In(event.Source().signature)
     mmu: In(MMUSignature())
 
-    wb_bus: Out(wishbone.Signature(addr_width=24, data_width=8))
-    csr_bus: In(csr.Signature(addr_width=5, data_width=8))
+    wb_bus: Out(wishbone.Signature(addr_width=24, data_width=8, features={"err", "rty", "stall"}))
+    csr_bus: In(csr.Signature(addr_width=6, data_width=8))
+    # Services debug cycles instead of the debugger, while active.
+    test_seq: Out(TestSeqSignature())
+
+    # CPU cycles and instructions, and the number of cycles by which the
+    # CPU clock was stretched (past the minimum pulse width) waiting
+    # for address translation, for the debugger, for a read to complete
+    # and for space in the write buffer.
+    perf: Out(PerfEventSignature(["cycle", "insn", "stretch_xlat", "stretch_dbg",
+                                  "stretch_read", "stretch_write"]))
 
 
     class CounterRegister(csr.Register, access="r"):
@@ -133,11 +158,44 @@ class W65C816WishboneBridge(wiring.Component):
         rwb: csr.Field(csr.action.R, 1)
         _unused: csr.Field(csr.action.ResR0WA, 4)
 
+    class TrcControlRegister(csr.Register, access="rw"):
+        arm:         csr.Field(csr.action.RW1S, 1)
+        stop:        csr.Field(csr.action.W, 1)
+        trig_addr:   csr.Field(csr.action.RW, 1)
+        trig_ifetch: csr.Field(csr.action.RW, 1)
+        trig_abort:  csr.Field(csr.action.RW, 1)
+        triggered:   csr.Field(csr.action.R, 1)
+        _unused:     csr.Field(csr.action.ResR0WA, 2)
 
-    def __init__(self):
+    class TrcTrigAddrRegister(csr.Register, access="rw"):
+        addr: csr.Field(csr.action.RW, 24)
+
+    class TrcPostCountRegister(csr.Register, access="rw"):
+        count: csr.Field(csr.action.RW, 16)
+
+    class TrcCountRegister(csr.Register, access="r"):
+        count: csr.Field(csr.action.R, 16)
+
+    class TrcEntryRegister(csr.Register, access="r"):
+        entry: csr.Field(csr.action.R, TraceEntry)
+
+
+    # io_range is the range of physical addresses that have side
+    # effects (CSRs), or None if every address should be treated as
+    # such. Writes to it are still posted, but reads from it wait for
+    # the write buffer to drain, and are never forwarded from it.
+    def __init__(self, *, spec_xlat=True, write_buffer=4, io_range=None, trace_depth=512):
         super().__init__()
 
-        regs = csr.Builder(addr_width=5, data_width=8)
+        exact_log2(write_buffer) # Must be a power of 2.
+        exact_log2(trace_depth)
+
+        self._spec_xlat = spec_xlat
+        self._wbuf_depth = write_buffer
+        self._io_range = io_range
+        self._trace_depth = trace_depth
+
+        regs = csr.Builder(addr_width=6, data_width=8)
 
         self._clks = regs.add("Clks", self.CounterRegister())
         self._insns = regs.add("Insns", self.CounterRegister())
@@ -148,6 +206,11 @@ class W65C816WishboneBridge(wiring.Component):
         self._dbg_wdata = regs.add("DbgWData", self.OutDataRegister())
         self._dbg_trace_rdata = regs.add("DbgTrcRData", self.OutDataRegister())
         self._dbg_paddr = regs.add("DbgPAddr", self.DbgAddrRegister())
+        self._trc_control = regs.add("TrcControl", self.TrcControlRegister(), offset=0x18)
+        self._trc_trig_addr = regs.add("TrcTrigAddr", self.TrcTrigAddrRegister(), offset=0x1c)
+        self._trc_post_count = regs.add("TrcPostCount", self.TrcPostCountRegister(), offset=0x20)
+        self._trc_count = regs.add("TrcCount", self.TrcCountRegister(), offset=0x22)
+        self._trc_entry = regs.add("TrcEntry", self.TrcEntryRegister(), offset=0x28)
 
         mmap = regs.as_memory_map()
         self._bridge = csr.Bridge(mmap)
@@ -177,28 +240,42 @@ class W65C816WishboneBridge(wiring.Component):
         #    figure out the state for ABORT.
         #    Address translation may take more than we have time (at 8MHz), in which
         #    case we delay the entry to state 4, stretching the clock.
-        # 4) At this point we wait for any ongoing write transaction to complete.
+        # 4) At this point we wait for any ongoing debugger write to complete.
         # 5) We bring the CPU clock up, after which the CPU will probe ABORT.
         # -) After point 5, we initiate a read transaction if the CPU is reading.
         #    We need to wait for a minimum amount of cycles, after which we stretch
         #    the clock until it completes before going back to point 1.
         # 5) If writing, the CPU outputs the write data on the data bus at this point.
-        #    We initiate the write transaction here.
+        #    We put the write into the write buffer here, from which it is
+        #    issued on the bus in the background (see below).
         # Timings for the various points (at 8MHz @ 3.3V):
         #  1 -> 2) tDHW & tDHR: min 10 ns (upper bound up to 1 -> 3 time)
         #  1 -> 3) tADS & tBAS: max 40 ns
         # 4? -> 5) tMDS: max 40 ns
+        #
+        # The bank address only becomes available at point 3, but the
+        # rest of the address is valid much earlier. With speculative
+        # translation enabled, we start an MMU lookup as soon as the low
+        # 16 bits are valid, guessing the bank address to be the same as
+        # in the previous cycle of the same kind (opcode/operand fetches
+        # use PBR, data accesses mostly use DBR). Once the bank address
+        # is known, we just check whether the guess was right.
+        # Additionally, the last translation for each kind of access is
+        # remembered, which lets us skip the MMU entirely for accesses
+        # within the same page.
 
         # Times in nanoseconds
         tDSR = 20 # Before falling edge, read setup time
         tDHR = 10 # From falling edge, read hold time
         tADS = 115 # From falling edge to when full address is available
+        tADL = 40 # From falling edge to when the low 16 address bits are available
         tMDS = 60 # From rising edge to when data bus has write data
 
         tPWL = 125 # Min time for clock to be low
         tPWH = 125 # Min time for clock to be high
 
         assert tDHR + tADS <= tPWL, "Min clock low time too short"
+        assert tADL <= tADS
 
         def ns_to_cycles(ns):
             return int((ns * platform.soc_clk) / 1000000000)
@@ -208,30 +285,40 @@ class W65C816WishboneBridge(wiring.Component):
         # intermediate state. This affects:
         # - the time we drive the data bus after the clock goes low,
         # - the time we wait before driving the clock high.
+        #
+        # The remaining times are measured from the last clock edge
+        # (edge_ctr), instead of having a counter per state. This way,
+        # the time spent translating the address or waiting for the bus
+        # counts towards the minimum pulse widths, and a half-cycle ends
+        # as soon as the access is done and tPWL/tPWH allow it. Accesses
+        # to fast targets (iram, CSRs) and internal cycles run at the
+        # shortest legal period, while slow ones (SDRAM misses) stretch
+        # the clock for only as long as they actually take.
 
         clks_latch_addr = ns_to_cycles(tADS - tDHR)
-        latch_addr_ctr = Signal(range(clks_latch_addr + 1))
         print(f'Will latch address after {clks_latch_addr} clocks')
 
+        clks_spec_addr = ns_to_cycles(tADL - tDHR)
+        if self._spec_xlat:
+            print(f'Will start speculative translation after {clks_spec_addr} clocks')
+
         clks_w_data_valid = ns_to_cycles(tMDS)
-        w_data_valid_ctr = Signal(range(clks_w_data_valid + 1))
         print(f'Will wait for w_data for {clks_w_data_valid} clocks')
 
-        clks_wait_noop = ns_to_cycles(tPWH)
-        wait_noop_ctr = Signal(range(clks_wait_noop + 1))
-        print(f'No-op cycles will wait for {clks_wait_noop} clocks')
-
-        clks_wait_read_cycle = ns_to_cycles(tPWH - tDSR)
-        wait_read_cycle_ctr = Signal(range(clks_wait_read_cycle + 1))
-        print(f'Read cycles will wait for {clks_wait_read_cycle} clocks before setup time')
+        clks_pwl = ns_to_cycles(tPWL)
+        clks_pwh = ns_to_cycles(tPWH)
+        print(f'Will hold clock low for at least {clks_pwl + 1} clocks, high for at least {clks_pwh + 1} clocks')
 
         clks_wait_read_setup = ns_to_cycles(tDSR)
         wait_read_setup_ctr = Signal(range(clks_wait_read_setup + 1))
         print(f'Read cycles will setup data {clks_wait_read_setup} clocks before next cycle')
 
-        clks_wait_write = ns_to_cycles(tPWH - tMDS)
-        wait_write_ctr = Signal(range(clks_wait_write + 1))
-        print(f'Write cycles will wait for {clks_wait_write} clocks')
+        # Cycles since the clock last changed level (saturating).
+        # A state toggling the clock resets it to 0.
+        clks_edge_max = max(clks_latch_addr + 1, clks_w_data_valid, clks_pwl, clks_pwh)
+        edge_ctr = Signal(range(clks_edge_max + 1))
+        with m.If(edge_ctr != clks_edge_max):
+            m.d.sync += edge_ctr.eq(edge_ctr + 1)
 
         clks_rst_low = ns_to_cycles(tPWL)
         rst_low_ctr = Signal(range(clks_rst_low + 1))
@@ -259,9 +346,13 @@ class W65C816WishboneBridge(wiring.Component):
 
         # Since our data bus is only 8 bits wide, SEL_O is just always 1.
         m.d.comb += self.wb_bus.sel.eq(1)
-        # Since we only perform one bus cycle per CPU cycle, CYC_O and
-        # STB_O are always the same.
-        m.d.comb += self.wb_bus.stb.eq(self.wb_bus.cyc)
+        # We only perform one bus cycle per CPU cycle, so STB_O is
+        # raised together with CYC_O, and dropped once the request is
+        # accepted. A retry raises it again.
+        with m.If(self.wb_bus.stb & ~self.wb_bus.stall):
+            m.d.sync += self.wb_bus.stb.eq(0)
+        with m.If(self.wb_bus.cyc & self.wb_bus.rty):
+            m.d.sync += self.wb_bus.stb.eq(1)
 
         clk_ctr = Signal(32)
         insn_ctr = Signal(32)
@@ -274,19 +365,94 @@ class W65C816WishboneBridge(wiring.Component):
         read_in_progress = Signal()
         write_in_progress = Signal()
 
+        # Posted writes
+        # ---
+        # Writes don't hold up the CPU, they go into a small FIFO, and
+        # are issued on the bus in the background, whenever the bridge
+        # isn't reading. Reads may go ahead of buffered writes, unless
+        # they're from the I/O range. A read from an address with a
+        # buffered write returns the youngest such write's data instead
+        # of going on the bus.
+        #
+        # Before translating the address of the next cycle after an I/O
+        # write, the buffer is drained entirely, so that writes to the
+        # MMU's CSRs take effect immediately.
+        wbuf_depth = self._wbuf_depth
+        wbuf_addr = Array(Signal(24, name=f"wbuf_addr_{i}") for i in range(wbuf_depth))
+        wbuf_data = Array(Signal(8, name=f"wbuf_data_{i}") for i in range(wbuf_depth))
+        wbuf_head = Signal(range(wbuf_depth))
+        wbuf_tail = Signal(range(wbuf_depth))
+        wbuf_level = Signal(range(wbuf_depth + 1))
+        wbuf_push = Signal()
+        wbuf_pop = Signal()
+        # The write at the head of the buffer is on the bus.
+        wbuf_busy = Signal()
+        wbuf_io_pending = Signal()
+
+        # The FSM starts a read on the bus this cycle.
+        read_issue = Signal()
+
+        # A CPU cycle just ended.
+        trace_record = Signal()
+
         dbg_en = self._dbg_config.f.dbg_enable.data
         trace_en = self._dbg_config.f.trace_enable.data
         trace_halted = self._dbg_config.f.trace_halted.data
 
         dbg_this_cycle = Signal()
+        # The test sequencer hasn't serviced this debug cycle yet.
+        seq_pending = Signal()
+
+        # Address being translated, and the result of the translation
+        # (from the MMU or the last translation cache).
+        vaddr = Signal(24)
+        xlat_need = Signal()
+        xlat_write = Signal()
+        xlat_ifetch = Signal()
+        xlat_paddr = Signal(24)
+
+        # Last bank address of opcode/operand fetches and data accesses,
+        # used as the guess for speculative translation.
+        code_bank = Signal(8)
+        data_bank = Signal(8)
+
+        # Last translation cache, indexed by whether the access is an
+        # instruction fetch.
+        ltc_valid = Array(Signal(name=f"ltc_valid_{i}") for i in range(2))
+        ltc_page = Array(Signal(12, name=f"ltc_page_{i}") for i in range(2))
+        ltc_pfn = Array(Signal(12, name=f"ltc_pfn_{i}") for i in range(2))
+        ltc_writable = Array(Signal(name=f"ltc_writable_{i}") for i in range(2))
+
+        def ltc_hit(vaddr, write, ifetch):
+            if not self._spec_xlat:
+                return C(0)
+            return (ltc_valid[ifetch] & (ltc_page[ifetch] == vaddr[12:])
+                    & (~write | ltc_writable[ifetch]))
+
+        def ltc_fill(vaddr, paddr, write, ifetch):
+            if not self._spec_xlat:
+                return
+            with m.If(ltc_valid[ifetch] & (ltc_page[ifetch] == vaddr[12:])):
+                m.d.sync += ltc_writable[ifetch].eq(ltc_writable[ifetch] | write)
+            with m.Else():
+                m.d.sync += [
+                    ltc_valid[ifetch].eq(1),
+                    ltc_page[ifetch].eq(vaddr[12:]),
+                    ltc_pfn[ifetch].eq(paddr[12:]),
+                    ltc_writable[ifetch].eq(write),
+                ]
 
-        with m.If(self.wb_bus.cyc & self.wb_bus.ack):
+        # An error terminates the cycle as well, so the CPU isn't stuck
+        # forever. Reads return whatever was on the bus.
+        with m.If(self.wb_bus.cyc & (self.wb_bus.ack | self.wb_bus.err)):
             m.d.sync += [
                 read_in_progress.eq(0),
-                write_in_progress.eq(0),
                 self.wb_bus.cyc.eq(0),
             ]
-            with m.If(read_in_progress):
+            with m.If(wbuf_busy):
+                m.d.sync += wbuf_busy.eq(0)
+                m.d.comb += wbuf_pop.eq(1)
+            with m.Else():
                 m.d.sync += [
                     cpu_io.r_data.eq(self.wb_bus.dat_r),
                     cpu_io.r_data_en.eq(1),
@@ -303,9 +469,103 @@ class W65C816WishboneBridge(wiring.Component):
         with m.If(dbg_this_cycle & self._dbg_wdata.f.data.r_stb):
             m.d.sync += write_in_progress.eq(0)
 
+        m.d.comb += [
+            self.test_seq.stb.eq(seq_pending),
+            self.test_seq.addr.eq(self._dbg_vaddr.f.addr.r_data),
+            self.test_seq.vpa.eq(self._dbg_bus.f.vpa.r_data),
+            self.test_seq.vda.eq(self._dbg_bus.f.vda.r_data),
+            self.test_seq.vpb.eq(self._dbg_bus.f.vpb.r_data),
+            self.test_seq.rwb.eq(self._dbg_bus.f.rwb.r_data),
+            self.test_seq.w_data.eq(self._dbg_wdata.f.data.r_data),
+        ]
+
+        with m.If(seq_pending & self.test_seq.ack):
+            m.d.sync += [
+                seq_pending.eq(0),
+                write_in_progress.eq(0),
+            ]
+            with m.If(read_in_progress):
+                m.d.sync += [
+                    read_in_progress.eq(0),
+                    cpu_io.r_data.eq(self.test_seq.r_data),
+                    cpu_io.r_data_en.eq(1),
+                ]
+
+        with m.If(read_issue):
+            m.d.sync += [
+                read_in_progress.eq(1),
+                self.wb_bus.cyc.eq(1),
+                self.wb_bus.stb.eq(1),
+                self.wb_bus.we.eq(0),
+                self.wb_bus.adr.eq(xlat_paddr),
+            ]
+        with m.Elif((wbuf_level != 0) & ~wbuf_busy & ~self.wb_bus.cyc):
+            m.d.sync += [
+                wbuf_busy.eq(1),
+                self.wb_bus.cyc.eq(1),
+                self.wb_bus.stb.eq(1),
+                self.wb_bus.we.eq(1),
+                self.wb_bus.adr.eq(wbuf_addr[wbuf_head]),
+                self.wb_bus.dat_w.eq(wbuf_data[wbuf_head]),
+            ]
+
+        with m.If(wbuf_push):
+            m.d.sync += [
+                wbuf_addr[wbuf_tail].eq(xlat_paddr),
+                wbuf_data[wbuf_tail].eq(cpu_io.w_data),
+                wbuf_tail.eq(wbuf_tail + 1),
+            ]
+        with m.If(wbuf_pop):
+            m.d.sync += wbuf_head.eq(wbuf_head + 1)
+        with m.If(wbuf_push & ~wbuf_pop):
+            m.d.sync += wbuf_level.eq(wbuf_level + 1)
+        with m.Elif(~wbuf_push & wbuf_pop):
+            m.d.sync += wbuf_level.eq(wbuf_level - 1)
+
+        with m.If((wbuf_level == 0) & ~wbuf_busy):
+            m.d.sync += wbuf_io_pending.eq(0)
+
+        def is_io(addr):
+            if self._io_range is None:
+                return C(1)
+            return (addr >= self._io_range.start) & (addr < self._io_range.stop)
+
+        xlat_io = is_io(xlat_paddr)
+
+        wbuf_fwd_hit = Signal()
+        wbuf_fwd_data = Signal(8)
+        # Later (younger) entries take priority.
+        for i in range(wbuf_depth):
+            idx = (wbuf_head + i)[:exact_log2(wbuf_depth)]
+            with m.If((i < wbuf_level) & (wbuf_addr[idx] == xlat_paddr) & ~xlat_io):
+                m.d.comb += [
+                    wbuf_fwd_hit.eq(1),
+                    wbuf_fwd_data.eq(wbuf_data[idx]),
+                ]
+
+        def start_read():
+            with m.If(dbg_en):
+                m.d.sync += [
+                    read_in_progress.eq(1),
+                    seq_pending.eq(self.test_seq.active),
+                ]
+                m.next = 'complete-read'
+            with m.Elif(wbuf_fwd_hit):
+                m.d.sync += [
+                    cpu_io.r_data.eq(wbuf_fwd_data),
+                    cpu_io.r_data_en.eq(1),
+                    self._dbg_trace_rdata.f.data.r_data.eq(wbuf_fwd_data),
+                ]
+                m.next = 'complete-read'
+            with m.Elif(~self.wb_bus.cyc & ~(xlat_io & (wbuf_level != 0))):
+                m.d.comb += read_issue.eq(1)
+                m.next = 'complete-read'
+            with m.Else():
+                m.next = 'initiate-read'
+
         reset_ctr = Signal(7)
 
-        with m.FSM():
+        with m.FSM() as fsm:
             with m.State('rst-clk-low'):
                 m.d.sync += [
                     cpu_io.rst.eq(0),
@@ -335,21 +595,39 @@ class W65C816WishboneBridge(wiring.Component):
                 with m.If(rst_low_ctr == clks_rst_low):
                     m.next = 'clk-falling-edge'
             with m.State('clk-falling-edge'):
-                m.d.sync += [
-                    cpu_io.clk.eq(0),
-                    clk_ctr.eq(clk_ctr + 1)
-                ]
-                m.next = 'clear-r_data_en'
+                with m.If((edge_ctr >= clks_pwh) & ~seq_pending):
+                    m.d.sync += [
+                        cpu_io.clk.eq(0),
+                        clk_ctr.eq(clk_ctr + 1),
+                        edge_ctr.eq(0),
+                    ]
+                    m.d.comb += [
+                        self.perf.cycle.eq(1),
+                        trace_record.eq(1),
+                    ]
+                    m.next = 'clear-r_data_en'
             with m.State('clear-r_data_en'):
                 m.d.sync += [
                     cpu_io.r_data_en.eq(0),
-                    latch_addr_ctr.eq(0),
                     abort_q.eq(0),
                 ]
                 m.next = 'latch-address'
             with m.State('latch-address'):
-                m.d.sync += latch_addr_ctr.eq(latch_addr_ctr + 1)
-                with m.If(latch_addr_ctr == clks_latch_addr):
+                # edge_ctr is 1 when entering this state.
+                if self._spec_xlat and clks_spec_addr < clks_latch_addr:
+                    spec_vaddr = Cat(cpu_io.addr_lo, Mux(cpu_io.vpa, code_bank, data_bank))
+                    spec_need = (cpu_io.vda | cpu_io.vpa) & ~aborted
+
+                    with m.If((edge_ctr == clks_spec_addr + 1) & spec_need & ~self.mmu.valid & ~wbuf_io_pending
+                              & ~ltc_hit(spec_vaddr, ~cpu_io.rw, cpu_io.vpa)):
+                        m.d.sync += [
+                            self.mmu.vaddr.eq(spec_vaddr),
+                            self.mmu.write.eq(~cpu_io.rw),
+                            self.mmu.ifetch.eq(cpu_io.vpa),
+                            self.mmu.spec.eq(1),
+                            self.mmu.stb.eq(1),
+                        ]
+                with m.If((edge_ctr >= clks_latch_addr + 1) & ~wbuf_io_pending):
                     m.d.sync += [
                         self._dbg_vaddr.f.addr.r_data.eq(Cat(cpu_io.addr_lo, cpu_io.addr_hi)),
                         self._dbg_bus.f.vpa.r_data.eq(cpu_io.vpa),
@@ -357,26 +635,92 @@ class W65C816WishboneBridge(wiring.Component):
                         self._dbg_bus.f.vpb.r_data.eq(cpu_io.vpb),
                         self._dbg_bus.f.rwb.r_data.eq(cpu_io.rw),
 
-                        self.mmu.vaddr.eq(Cat(cpu_io.addr_lo, cpu_io.addr_hi)),
-                        self.mmu.write.eq(~cpu_io.rw),
-                        self.mmu.ifetch.eq(cpu_io.vpa),
-                        self.mmu.stb.eq((cpu_io.vda | cpu_io.vpa) & ~aborted),
+                        vaddr.eq(Cat(cpu_io.addr_lo, cpu_io.addr_hi)),
+                        xlat_write.eq(~cpu_io.rw),
+                        xlat_ifetch.eq(cpu_io.vpa),
+                        xlat_need.eq((cpu_io.vda | cpu_io.vpa) & ~aborted),
                     ]
+                    with m.If(cpu_io.vpa):
+                        m.d.sync += code_bank.eq(cpu_io.addr_hi)
+                    with m.Elif(cpu_io.vda):
+                        m.d.sync += data_bank.eq(cpu_io.addr_hi)
                     with m.If(~cpu_io.vpb):
                         m.d.sync += rst_before_vp.eq(0)
                     with m.If(cpu_io.vpa & cpu_io.vda):
                         m.d.sync += insn_ctr.eq(insn_ctr + 1)
+                        m.d.comb += self.perf.insn.eq(1)
                         with m.If(self._dbg_config.f.dbg_en_next_insn.data):
                             m.d.comb += [
                                 self._dbg_config.f.dbg_enable.set.eq(1),
                                 self._dbg_config.f.dbg_en_next_insn.clear.eq(1),
                             ]
-                    m.next = 'mmu-wait-valid'
+                    if self._spec_xlat:
+                        m.next = 'translate'
+                    else:
+                        # Without speculation there's nothing to wait
+                        # for, so the lookup starts right away.
+                        m.d.sync += [
+                            self.mmu.vaddr.eq(Cat(cpu_io.addr_lo, cpu_io.addr_hi)),
+                            self.mmu.write.eq(~cpu_io.rw),
+                            self.mmu.ifetch.eq(cpu_io.vpa),
+                            self.mmu.spec.eq(0),
+                            self.mmu.stb.eq((cpu_io.vda | cpu_io.vpa) & ~aborted),
+                        ]
+                        m.next = 'mmu-wait-valid'
+            if self._spec_xlat:
+                with m.State('translate'):
+                    spec_ok = (self.mmu.valid & ~self.mmu.miss & (self.mmu.vaddr == vaddr)
+                               & (self.mmu.write == xlat_write) & (self.mmu.ifetch == xlat_ifetch))
+
+                    def strobe_mmu():
+                        m.d.sync += [
+                            self.mmu.vaddr.eq(vaddr),
+                            self.mmu.write.eq(xlat_write),
+                            self.mmu.ifetch.eq(xlat_ifetch),
+                            self.mmu.spec.eq(0),
+                            self.mmu.stb.eq(xlat_need),
+                        ]
+                        m.next = 'mmu-wait-valid'
+
+                    with m.If(self.mmu.stb & ~self.mmu.valid):
+                        # Wait for the speculative lookup to finish.
+                        pass
+                    with m.Elif(xlat_need & ltc_hit(vaddr, xlat_write, xlat_ifetch)):
+                        m.d.sync += [
+                            xlat_paddr.eq(Cat(vaddr[:12], ltc_pfn[xlat_ifetch])),
+                            self.mmu.stb.eq(0),
+                        ]
+                        m.next = 'mmu-wait-valid'
+                    with m.Elif(xlat_need & self.mmu.stb & spec_ok):
+                        # Guessed right.
+                        m.d.sync += [
+                            xlat_paddr.eq(self.mmu.paddr),
+                            self.mmu.stb.eq(0),
+                        ]
+                        ltc_fill(vaddr, self.mmu.paddr, xlat_write, xlat_ifetch)
+                        m.next = 'mmu-wait-valid'
+                    with m.Elif(self.mmu.stb):
+                        # Guessed wrong, the MMU needs to see STB go low
+                        # before starting the real lookup.
+                        m.d.sync += self.mmu.stb.eq(0)
+                        m.next = 'mmu-strobe'
+                    with m.Else():
+                        strobe_mmu()
+                with m.State('mmu-strobe'):
+                    with m.If(~self.mmu.valid):
+                        strobe_mmu()
             with m.State('mmu-wait-valid'):
                 with m.If(~self.mmu.stb | self.mmu.valid):
                     m.d.sync += self.mmu.stb.eq(0)
 
-                    with m.If(self.mmu.abort & self.mmu.stb):
+                    mmu_abort = self.mmu.stb & self.mmu.abort
+
+                    with m.If(self.mmu.stb):
+                        m.d.sync += xlat_paddr.eq(self.mmu.paddr)
+                        with m.If(~self.mmu.abort):
+                            ltc_fill(vaddr, self.mmu.paddr, xlat_write, xlat_ifetch)
+
+                    with m.If(mmu_abort):
                         m.d.sync += abort_q.eq(1)
                         m.d.sync += aborted.eq(1)
 
@@ -387,7 +731,7 @@ class W65C816WishboneBridge(wiring.Component):
 
                     with m.If(write_in_progress):
                         m.next = 'wait-write-completion'
-                    with m.Elif(self.mmu.abort):
+                    with m.Elif(mmu_abort):
                         m.next = 'abort-setup-wait'
                     with m.Else():
                         m.d.comb += self._dbg_config.f.trace_halted.set.eq(1)
@@ -402,62 +746,154 @@ class W65C816WishboneBridge(wiring.Component):
                     m.d.sync += abort_setup_ctr.eq(0)
                     m.next = 'clk-rising-edge'
             with m.State('clk-rising-edge'):
-                m.d.sync += [
-                    cpu_io.clk.eq(1),
-                    self.wb_bus.adr.eq(self.mmu.paddr),
-                    self._dbg_paddr.f.addr.r_data.eq(self.mmu.paddr),
-                    dbg_this_cycle.eq(dbg_en),
-                ]
-                with m.If(trace_en & trace_halted):
-                    pass
-                with m.Elif(~((cpu_io.vda | cpu_io.vpa) & ~aborted & ~aborted_q & ~rst_before_vp) & ~(dbg_en & ~cpu_io.rw)):
-                    m.d.sync += wait_noop_ctr.eq(0)
-                    m.next = 'noop-cycle'
-                with m.Elif(cpu_io.rw):
-                    m.next = 'initiate-read'
-                with m.Else():
-                    m.d.sync += w_data_valid_ctr.eq(0)
-                    m.next = 'initiate-write'
-
-            with m.State('noop-cycle'):
-                m.d.sync += wait_noop_ctr.eq(wait_noop_ctr + 1)
-                with m.If(wait_noop_ctr == clks_wait_noop):
-                    m.next = 'clk-falling-edge'
+                with m.If(edge_ctr >= clks_pwl):
+                    m.d.sync += [
+                        cpu_io.clk.eq(1),
+                        edge_ctr.eq(0),
+                        self._dbg_paddr.f.addr.r_data.eq(xlat_paddr),
+                        dbg_this_cycle.eq(dbg_en),
+                    ]
+                    with m.If(trace_en & trace_halted):
+                        pass
+                    with m.Elif(~((cpu_io.vda | cpu_io.vpa) & ~aborted & ~aborted_q & ~rst_before_vp) & ~(dbg_en & ~cpu_io.rw)):
+                        # Internal cycle, nothing to wait for other
+                        # than tPWH (and the test sequencer, which
+                        # logs it).
+                        m.d.sync += seq_pending.eq(dbg_en & self.test_seq.active)
+                        m.next = 'clk-falling-edge'
+                    with m.Elif(cpu_io.rw):
+                        # The address is already known, so the read
+                        # can start together with the clock edge.
+                        m.d.sync += wait_read_setup_ctr.eq(0)
+                        start_read()
+                    with m.Else():
+                        m.next = 'initiate-write'
 
             with m.State('initiate-read'):
-                m.d.sync += [
-                    wait_read_cycle_ctr.eq(0),
-                    wait_read_setup_ctr.eq(0),
-                    read_in_progress.eq(1),
-                    self.wb_bus.cyc.eq(~dbg_en),
-                    self.wb_bus.we.eq(0),
-                ]
-                m.next = 'complete-read'
+                # Waiting for the bus (or the write buffer) to be free.
+                start_read()
             with m.State('complete-read'):
-                with m.If(wait_read_cycle_ctr != clks_wait_read_cycle):
-                    m.d.sync += wait_read_cycle_ctr.eq(wait_read_cycle_ctr + 1)
-                with m.Elif(~read_in_progress):
+                with m.If(~read_in_progress):
                     with m.If(wait_read_setup_ctr != clks_wait_read_setup):
                         m.d.sync += wait_read_setup_ctr.eq(wait_read_setup_ctr + 1)
                     with m.Else():
                         m.next = 'clk-falling-edge'
 
             with m.State('initiate-write'):
-                with m.If(w_data_valid_ctr != clks_w_data_valid):
-                    m.d.sync += w_data_valid_ctr.eq(w_data_valid_ctr + 1)
-                with m.Elif(w_data_valid_ctr == clks_w_data_valid):
-                    m.d.sync += [
-                        write_in_progress.eq(1),
-                        wait_write_ctr.eq(0),
-                        self.wb_bus.cyc.eq(~dbg_en),
-                        self.wb_bus.we.eq(1),
-                        self.wb_bus.dat_w.eq(cpu_io.w_data),
-                        self._dbg_wdata.f.data.r_data.eq(cpu_io.w_data),
-                    ]
-                    m.next = 'complete-write'
-            with m.State('complete-write'):
-                m.d.sync += wait_write_ctr.eq(wait_write_ctr + 1)
-                with m.If(wait_write_ctr == clks_wait_write):
-                    m.next = 'clk-falling-edge'
+                with m.If(edge_ctr >= clks_w_data_valid):
+                    m.d.sync += self._dbg_wdata.f.data.r_data.eq(cpu_io.w_data)
+                    with m.If(dbg_en):
+                        # The debugger picks up the write, the next
+                        # cycle waits for it before its rising edge.
+                        m.d.sync += [
+                            write_in_progress.eq(1),
+                            seq_pending.eq(self.test_seq.active),
+                        ]
+                        m.next = 'clk-falling-edge'
+                    with m.Elif(wbuf_level != wbuf_depth):
+                        m.d.comb += wbuf_push.eq(1)
+                        with m.If(xlat_io):
+                            m.d.sync += wbuf_io_pending.eq(1)
+                        m.next = 'clk-falling-edge'
+
+        with m.If(self.mmu.inval):
+            m.d.sync += [valid.eq(0) for valid in ltc_valid]
+
+        # Bus trace buffer
+        # ---
+        # Once armed, every CPU cycle is recorded into a ring buffer, at
+        # full speed. Recording stops when the buffer is stopped from
+        # software, or TrcPostCount cycles after one of the enabled
+        # trigger conditions (virtual address match, opcode fetch,
+        # abort) happens.
+        #
+        # Once stopped, TrcCount holds the number of recorded entries,
+        # and successive reads of TrcEntry return them, oldest first.
+        trc_ctl = self._trc_control.f
+        trc_ptr_bits = exact_log2(self._trace_depth)
+
+        m.submodules.trace_mem = trace_mem = Memory(shape=TraceEntry, depth=self._trace_depth, init=[])
+        trace_wr = trace_mem.write_port()
+        trace_rd = trace_mem.read_port()
+
+        trc_wr_ptr = Signal(trc_ptr_bits)
+        trc_rd_idx = Signal(trc_ptr_bits)
+        trc_count = Signal(range(self._trace_depth + 1))
+        trc_post = Signal(16)
+        trc_armed_q = Signal()
+
+        cur_entry = Signal(TraceEntry)
+        m.d.comb += [
+            cur_entry.vaddr.eq(self._dbg_vaddr.f.addr.r_data),
+            cur_entry.paddr.eq(self._dbg_paddr.f.addr.r_data),
+            cur_entry.data.eq(Mux(self._dbg_bus.f.rwb.r_data, cpu_io.r_data, self._dbg_wdata.f.data.r_data)),
+            cur_entry.vpa.eq(self._dbg_bus.f.vpa.r_data),
+            cur_entry.vda.eq(self._dbg_bus.f.vda.r_data),
+            cur_entry.vpb.eq(self._dbg_bus.f.vpb.r_data),
+            cur_entry.rwb.eq(self._dbg_bus.f.rwb.r_data),
+            cur_entry.abort.eq(abort_q),
+        ]
+
+        trigger = (
+            (trc_ctl.trig_addr.data & (cur_entry.vaddr == self._trc_trig_addr.f.addr.data)) |
+            (trc_ctl.trig_ifetch.data & cur_entry.vpa & cur_entry.vda) |
+            (trc_ctl.trig_abort.data & cur_entry.abort)
+        )
+
+        m.d.sync += trc_armed_q.eq(trc_ctl.arm.data)
+        with m.If(trc_ctl.arm.data & ~trc_armed_q):
+            m.d.sync += [
+                trc_wr_ptr.eq(0),
+                trc_count.eq(0),
+                trc_rd_idx.eq(0),
+                trc_ctl.triggered.r_data.eq(0),
+            ]
+        with m.Elif(trc_ctl.arm.data & trace_record):
+            m.d.comb += [
+                trace_wr.addr.eq(trc_wr_ptr),
+                trace_wr.data.eq(cur_entry),
+                trace_wr.en.eq(1),
+            ]
+            m.d.sync += trc_wr_ptr.eq(trc_wr_ptr + 1)
+            with m.If(trc_count != self._trace_depth):
+                m.d.sync += trc_count.eq(trc_count + 1)
+
+            with m.If(trc_ctl.triggered.r_data):
+                m.d.sync += trc_post.eq(trc_post - 1)
+                with m.If(trc_post == 1):
+                    m.d.comb += trc_ctl.arm.clear.eq(1)
+            with m.Elif(trigger):
+                m.d.sync += [
+                    trc_ctl.triggered.r_data.eq(1),
+                    trc_post.eq(self._trc_post_count.f.count.data),
+                ]
+                with m.If(self._trc_post_count.f.count.data == 0):
+                    m.d.comb += trc_ctl.arm.clear.eq(1)
+
+        with m.If(trc_ctl.stop.w_stb & trc_ctl.stop.w_data):
+            m.d.comb += trc_ctl.arm.clear.eq(1)
+
+        with m.If(self._trc_entry.f.entry.r_stb):
+            m.d.sync += trc_rd_idx.eq(trc_rd_idx + 1)
+
+        m.d.comb += [
+            trace_rd.addr.eq(trc_wr_ptr - trc_count + trc_rd_idx),
+            self._trc_entry.f.entry.r_data.eq(trace_rd.data),
+            self._trc_count.f.count.r_data.eq(trc_count),
+        ]
+
+        def stretched(min_clks, *states):
+            return (edge_ctr >= min_clks) & Cat(fsm.ongoing(state) for state in states).any()
+
+        xlat_states = ['clear-r_data_en', 'latch-address', 'mmu-wait-valid', 'abort-setup-wait']
+        if self._spec_xlat:
+            xlat_states += ['translate', 'mmu-strobe']
+
+        m.d.comb += [
+            self.perf.stretch_xlat.eq(stretched(clks_pwl, *xlat_states)),
+            self.perf.stretch_dbg.eq(stretched(clks_pwl, 'wait-write-completion')),
+            self.perf.stretch_read.eq(stretched(clks_pwh, 'initiate-read', 'complete-read')),
+            self.perf.stretch_write.eq(stretched(clks_pwh, 'initiate-write')),
+        ]
 
         return m
@@ -50,30 +50,65 @@ class UARTDebugPhy(wiring.Component):
 # Ideally, I'd get rid of this code duplication.
 
 # An UART debug bridge providing remote access to the system bus. Has
-# a relatively simple interface:
+# a relatively simple interface. Commands are:
 #
-# Host always sends 5 bytes: command, 24 bit address, write data.
-# Target always responds with 1 byte: read data.
+# 'r'/'w': Host sends 5 bytes: command, 24 bit address, write data.
+#          Target responds with 1 byte: read data.
+#          For reads, write data is ignored, for writes, read data has
+#          an unspecified value.
+# 'R':     Block read. Host sends 6 bytes: command, 24 bit address,
+#          16 bit length. Target responds with length bytes of data,
+#          read from consecutive addresses.
+# 'W':     Block write. Host sends 6 bytes: command, 24 bit address,
+#          16 bit length, followed by length bytes of data, written to
+#          consecutive addresses. Target doesn't respond.
 #
-# For reads, write data is ignored, for writes, read data has an
-# unspecified value. All accesses have their associated side effects.
+# All multi-byte values are little endian. All accesses have their
+# associated side effects. Bus errors aren't reported, the read data
+# is unspecified in that case.
+#
+# Commands are processed in order, and the host doesn't need to wait
+# for the response to a command before sending the next one. Requests
+# are buffered (up to REQ_FIFO_DEPTH bytes) while the target is sending
+# the response to a read, and the host must not send more than that
+# before receiving the response.
 class UARTDebugBridge(wiring.Component):
-    wb_bus: Out(wishbone.Signature(addr_width=24, data_width=8))
+    wb_bus: Out(wishbone.Signature(addr_width=24, data_width=8, features={"err", "rty", "stall"}))
+
+    REQ_FIFO_DEPTH = 512
 
     def elaborate(self, platform):
         m = Module()
 
-        m.submodules.phy = phy = UARTDebugPhy(baudrate=2000000)
+        m.submodules.phy = phy = UARTDebugPhy(baudrate=2000000, rx_fifo_depth=self.REQ_FIFO_DEPTH)
 
         # Since our data bus is only 8 bits wide, SEL_O is just always 1.
         m.d.comb += self.wb_bus.sel.eq(1)
-        # Bus is held only for the duration of the command.
-        m.d.comb += self.wb_bus.stb.eq(self.wb_bus.cyc)
+        # Bus is held only for the duration of the command. STB_O is
+        # dropped once the request is accepted, and raised again on retry.
+        with m.If(self.wb_bus.stb & ~self.wb_bus.stall):
+            m.d.sync += self.wb_bus.stb.eq(0)
+        with m.If(self.wb_bus.cyc & self.wb_bus.rty):
+            m.d.sync += self.wb_bus.stb.eq(1)
 
         cmd = Signal(8)
         addr = Signal(24)
+        length = Signal(16)
         r_data, w_data = Signal(8), Signal(8)
 
+        block = (cmd == ord('R')) | (cmd == ord('W'))
+
+        # Advance to the next byte of a block command.
+        def next_byte(to_state):
+            m.d.sync += [
+                addr.eq(addr + 1),
+                length.eq(length - 1),
+            ]
+            with m.If(length == 1):
+                m.next = "recv-cmd"
+            with m.Else():
+                m.next = to_state
+
         with m.FSM():
             def rx_state(state, to_state, dest):
                 with m.State(state):
@@ -86,9 +121,26 @@ class UARTDebugBridge(wiring.Component):
             rx_state("recv-cmd", "recv-addr0", cmd)
             rx_state("recv-addr0", "recv-addr1", addr.bit_select(0, 8))
             rx_state("recv-addr1", "recv-addr2", addr.bit_select(8, 8))
-            rx_state("recv-addr2", "recv-w-data", addr.bit_select(16, 8))
+            rx_state("recv-addr2", "recv-addr-done", addr.bit_select(16, 8))
             rx_state("recv-w-data", "transaction", w_data)
 
+            rx_state("recv-len0", "recv-len1", length.bit_select(0, 8))
+            rx_state("recv-len1", "recv-len-done", length.bit_select(8, 8))
+
+            with m.State("recv-addr-done"):
+                with m.If(block):
+                    m.next = "recv-len0"
+                with m.Else():
+                    m.next = "recv-w-data"
+
+            with m.State("recv-len-done"):
+                with m.If(length == 0):
+                    m.next = "recv-cmd"
+                with m.Elif(cmd == ord('W')):
+                    m.next = "recv-w-data"
+                with m.Else():
+                    m.next = "transaction"
+
             with m.State("transaction"):
                 with m.If(~self.wb_bus.cyc):
                     # Not yet started.
@@ -96,21 +148,29 @@ class UARTDebugBridge(wiring.Component):
                         self.wb_bus.adr.eq(addr),
                         self.wb_bus.dat_w.eq(w_data),
                         self.wb_bus.cyc.eq(1),
-                        self.wb_bus.we.eq(cmd == ord('w')),
+                        self.wb_bus.stb.eq(1),
+                        self.wb_bus.we.eq((cmd == ord('w')) | (cmd == ord('W'))),
                     ]
-                with m.Elif(self.wb_bus.ack):
-                    # Completed.
+                with m.Elif(self.wb_bus.ack | self.wb_bus.err):
+                    # Completed (possibly with an error, in which case the
+                    # read data is meaningless).
                     m.d.sync += [
                         self.wb_bus.cyc.eq(0),
                         r_data.eq(self.wb_bus.dat_r),
                     ]
-                    m.next = "send-r-data"
+                    with m.If(cmd == ord('W')):
+                        next_byte("recv-w-data")
+                    with m.Else():
+                        m.next = "send-r-data"
 
             with m.State("send-r-data"):
                 m.d.comb += phy.resp_stream.valid.eq(1)
                 m.d.comb += phy.resp_stream.payload.eq(r_data)
 
                 with m.If(phy.resp_stream.ready & phy.resp_stream.valid):
-                    m.next = "recv-cmd"
+                    with m.If(cmd == ord('R')):
+                        next_byte("transaction")
+                    with m.Else():
+                        m.next = "recv-cmd"
 
         return m
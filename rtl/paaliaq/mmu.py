@@ -1,10 +1,13 @@
 from amaranth import *
-from amaranth.lib import data, wiring
+from amaranth.lib import data, enum, wiring
 from amaranth.lib.wiring import In, Out
 from amaranth.lib.memory import Memory
+from amaranth.utils import exact_log2
 from amaranth_soc import wishbone, event
 from amaranth_soc import csr
 
+from paaliaq.pmu import PerfEventSignature
+
 class MMUSignature(wiring.Signature):
     def __init__(self):
         super().__init__({
@@ -18,8 +21,16 @@ class MMUSignature(wiring.Signature):
             "write": In(1),
             "ifetch": In(1),
             "user": In(1),
+            # Speculative lookups only consult the TLB, and never walk
+            # the page table or record faults. If the translation is
+            # not readily available, "miss" is set instead.
+            "spec": In(1),
             # Output control signals.
             "abort": Out(1),
+            "miss": Out(1),
+            # Pulsed when previously returned translations may no
+            # longer be valid.
+            "inval": Out(1),
         })
 
 
@@ -31,15 +42,29 @@ class PageTableEntry(data.Struct):
     pfn:        12
 
 
-def initial_pts():
-    return [{'pfn': i, 'user': 1, 'executable': 1, 'writable': 1, 'present': 1} for i in range(1 << 11)]
+class TLBFlushMode(enum.Enum, shape=2):
+    FULL = 0
+    PAGE = 1
+    ASID = 2
+
 
+# The TLB is set-associative, with each entry tagged with the address
+# space identifier (ASID) that was current when it was filled, so
+# switching between address spaces does not require a flush. Entries
+# are filled by walking the page table at PtPointer on a miss, and
+# replaced round-robin (preferring invalid ways). Walks also prefetch
+# the neighbouring entries of the missing one into the TLB.
+#
+# Out of reset, translation is disabled, and the lower half of the
+# address space is identity mapped. The first TLB flush enables it.
 class MMU(wiring.Component):
     csr_bus: In(csr.Signature(addr_width=4, data_width=8))
-    wb_bus: Out(wishbone.Signature(addr_width=24, data_width=8))
+    wb_bus: Out(wishbone.Signature(addr_width=24, data_width=8, features={"err", "rty", "stall"}))
 
     iface: Out(MMUSignature())
 
+    perf: Out(PerfEventSignature(["tlb_hit", "tlb_miss", "walk"]))
+
 
     class FaultReasonRegister(csr.Register, access="r"):
         addr:        csr.Field(csr.action.R, 24)
@@ -57,15 +82,31 @@ class MMU(wiring.Component):
         _unused: csr.Field(csr.action.ResR0WA, 3)
         pfn:     csr.Field(csr.action.W, 12)
 
+    class AsidRegister(csr.Register, access="rw"):
+        asid: csr.Field(csr.action.RW, 8)
 
-    def __init__(self):
+    class TlbFlushAsidRegister(csr.Register, access="w"):
+        asid: csr.Field(csr.action.W, 8)
+
+
+    def __init__(self, *, tlb_ways=4, tlb_sets=256, pte_prefetch=2):
         super().__init__()
 
+        if pte_prefetch not in (1, 2, 4, 8):
+            raise ValueError(f"PTE prefetch must be 1, 2, 4 or 8, not {pte_prefetch}")
+
+        self._pte_prefetch = pte_prefetch
+
+        self._tlb_ways = tlb_ways
+        self._tlb_sets = tlb_sets
+
         regs = csr.Builder(addr_width=4, data_width=8)
 
         self._fault_reason = regs.add('FaultReason', self.FaultReasonRegister())
         self._pt_ptr    = regs.add('PtPointer', self.PtPointerRegister())
         self._tlb_flush = regs.add('TlbFlush', self.TlbFlushRegister())
+        self._asid      = regs.add('Asid', self.AsidRegister())
+        self._tlb_flush_asid = regs.add('TlbFlushAsid', self.TlbFlushAsidRegister())
 
         mmap = regs.as_memory_map()
         self._bridge = csr.Bridge(mmap)
@@ -78,42 +119,109 @@ class MMU(wiring.Component):
         m.submodules.bridge = self._bridge
         wiring.connect(m, wiring.flipped(self.csr_bus), self._bridge.bus)
 
-        m.submodules.tlb = tlb = Memory(
-            shape=PageTableEntry,
-            depth=(1 << 11),
-            init=initial_pts()
-        )
-        rd_port = tlb.read_port()
-        wr_port = tlb.write_port()
+        # Virtual page number (of the lower half of the address space)
+        # layout: [ tag | set ]
+        set_bits = exact_log2(self._tlb_sets)
+        tag_bits = 11 - set_bits
+
+        class TLBEntry(data.Struct):
+            valid: 1
+            asid:  8
+            tag:   tag_bits
+            pte:   PageTableEntry
+
+        vpn = self.iface.vaddr.bit_select(12, 11)
+        req_set = vpn[:set_bits]
+        req_tag = vpn[set_bits:]
+
+        cur_asid = self._asid.f.asid.data
+
+        tlb_rd, tlb_wr = [], []
+        for way in range(self._tlb_ways):
+            tlb = Memory(shape=TLBEntry, depth=self._tlb_sets, init=[])
+            m.submodules[f"tlb_{way}"] = tlb
+
+            tlb_rd.append(tlb.read_port())
+            tlb_wr.append(tlb.write_port())
+
+        tlb_rd_addr, tlb_wr_addr = Signal(set_bits), Signal(set_bits)
+        tlb_wr_data = Signal(TLBEntry)
+        for way in range(self._tlb_ways):
+            m.d.comb += [
+                tlb_rd[way].addr.eq(tlb_rd_addr),
+                tlb_wr[way].addr.eq(tlb_wr_addr),
+                tlb_wr[way].data.eq(tlb_wr_data),
+            ]
+
+        m.d.comb += tlb_rd_addr.eq(req_set)
+
+        hits = Signal(self._tlb_ways)
+        for way in range(self._tlb_ways):
+            entry = tlb_rd[way].data
+            m.d.comb += hits[way].eq(entry.valid & (entry.asid == cur_asid) & (entry.tag == req_tag))
 
-        m.d.comb += rd_port.addr.eq(self.iface.vaddr.bit_select(12, 11))
+        # Way to be replaced by the next fill.
+        fill_way = Signal(range(self._tlb_ways))
+        victim_ctr = Signal(range(self._tlb_ways))
+
+        enabled = Signal()
 
         # Fixed Wishbone signals (since we only do reads)
         m.d.comb += [
             self.wb_bus.sel.eq(1),
-            self.wb_bus.stb.eq(self.wb_bus.cyc),
             self.wb_bus.we.eq(0),
         ]
 
+        # STB_O is dropped once the last request is accepted (see the
+        # "walk" state).
+        with m.If(self.wb_bus.stb & ~self.wb_bus.stall):
+            m.d.sync += self.wb_bus.stb.eq(0)
+
         tlb_entry = Signal(PageTableEntry)
 
+        # Page walks fetch the whole (naturally aligned) group of
+        # pte_prefetch entries around the missing one, with all the
+        # byte reads in flight at once, starting from the missing entry.
+        group_bits = exact_log2(self._pte_prefetch)
+        walk_bytes = 2 * self._pte_prefetch
+
+        req_ctr = Signal(range(walk_bytes + 1))
+        resp_ctr = Signal(range(walk_bytes))
+
+        def walk_vpn(n):
+            return Cat((vpn[:group_bits] + n)[:group_bits], vpn[group_bits:]) if group_bits else vpn
+
+        def walk_addr(n):
+            return self._pt_ptr.f.ptr.data + Cat(n[0], walk_vpn(n[1:]))
+
         pt_low = Signal(8)
+        pt_err = Signal()
+        pt_rty = Signal()
+        walk_fault = Signal()
+        walk_retry = Signal()
 
         with m.If(self.iface.valid & ~self.iface.stb):
             m.d.sync += self.iface.valid.eq(0)
 
         pending_flush = Signal()
-        full_flush = Signal()
+        flush_mode = Signal(TLBFlushMode)
         flush_pfn = Signal(11)
+        flush_asid = Signal(8)
+        flush_set = Signal(set_bits)
 
-        with m.FSM():
+        with m.FSM() as fsm:
             with m.State("idle"):
                 with m.If(pending_flush):
-                    m.next = "flush"
+                    m.d.sync += [
+                        flush_set.eq(Mux(flush_mode == TLBFlushMode.PAGE, flush_pfn[:set_bits], 0)),
+                        enabled.eq(1),
+                    ]
+                    m.next = "flush-read"
                 with m.Elif(self.iface.stb & ~self.iface.valid):
-                    with m.If(self.iface.vaddr & 0x800000):
+                    with m.If((self.iface.vaddr & 0x800000) | ~enabled):
                         m.d.sync += [
                             tlb_entry.pfn.eq(self.iface.vaddr.bit_select(12, 12)),
+                            tlb_entry.user.eq(~self.iface.vaddr[23]),
                             tlb_entry.executable.eq(1),
                             tlb_entry.writable.eq(1),
                             tlb_entry.present.eq(1),
@@ -122,19 +230,33 @@ class MMU(wiring.Component):
                     with m.Else():
                         m.next = "fetch"
             with m.State("fetch"):
-                m.d.sync += tlb_entry.eq(rd_port.data)
+                m.d.comb += [
+                    self.perf.tlb_hit.eq(hits.any()),
+                    self.perf.tlb_miss.eq(~hits.any()),
+                ]
+
+                # A miss leaves a non-present entry, which makes us walk
+                # the page table.
+                m.d.sync += tlb_entry.eq(0)
+                for way in range(self._tlb_ways):
+                    with m.If(hits[way]):
+                        m.d.sync += tlb_entry.eq(tlb_rd[way].data.pte)
+
+                victim = Signal(range(self._tlb_ways))
+                m.d.comb += victim.eq(victim_ctr)
+                for way in reversed(range(self._tlb_ways)):
+                    with m.If(~tlb_rd[way].data.valid):
+                        m.d.comb += victim.eq(way)
+                m.d.sync += fill_way.eq(victim)
                 m.next = "act"
             with m.State("act"):
-                with m.If(wr_port.en):
-                    m.d.sync += wr_port.en.eq(0)
-
                 with m.If(tlb_entry.present):
                     abort_write  = self.iface.write  & ~tlb_entry.writable
                     abort_ifetch = self.iface.ifetch & ~tlb_entry.executable
                     abort_user   = self.iface.user   & ~tlb_entry.user
                     abort        = abort_write | abort_ifetch | abort_user
 
-                    with m.If(abort):
+                    with m.If(abort & ~self.iface.spec):
                         m.d.sync += [
                             # Fault reason register
                             self._fault_reason.f.addr.r_data.eq(self.iface.vaddr),
@@ -147,84 +269,173 @@ class MMU(wiring.Component):
                     m.d.sync += [
                         # CPU interface
                         self.iface.paddr.eq(Cat(self.iface.vaddr.bit_select(0, 12), tlb_entry.pfn)),
-                        self.iface.abort.eq(abort),
+                        self.iface.abort.eq(abort & ~self.iface.spec),
+                        self.iface.miss.eq(abort & self.iface.spec),
+                        self.iface.valid.eq(1),
+                    ]
+                    m.next = "idle"
+                with m.Elif(self.iface.spec):
+                    # TLB miss, but don't walk speculatively.
+                    m.d.sync += [
+                        self.iface.abort.eq(0),
+                        self.iface.miss.eq(1),
                         self.iface.valid.eq(1),
                     ]
                     m.next = "idle"
                 with m.Else():
                     # TLB miss
-                    # Begin fetching first byte of page table entry
-                    pt_entry = self.iface.vaddr.bit_select(12, 11) << 1
                     m.d.sync += [
-                        self.wb_bus.adr.eq(self._pt_ptr.f.ptr.data + pt_entry),
+                        self.wb_bus.adr.eq(walk_addr(C(0, group_bits + 1))),
                         self.wb_bus.cyc.eq(1),
+                        self.wb_bus.stb.eq(1),
+                        req_ctr.eq(1),
+                        resp_ctr.eq(0),
+                        walk_fault.eq(0),
+                        walk_retry.eq(0),
                     ]
-                    m.next = "wait-first-byte"
-            with m.State("wait-first-byte"):
-                with m.If(self.wb_bus.ack):
+                    m.next = "walk"
+            with m.State("walk"):
+                # The set of the entry being received is read, to find
+                # out if it's already in the TLB by the time it's filled.
+                m.d.comb += tlb_rd_addr.eq(walk_vpn(resp_ctr[1:])[:set_bits])
+
+                # Issue the next read as soon as the previous one is accepted.
+                with m.If(self.wb_bus.stb & ~self.wb_bus.stall & (req_ctr != walk_bytes)):
                     m.d.sync += [
-                        self.wb_bus.cyc.eq(0),
-                        pt_low.eq(self.wb_bus.dat_r),
+                        self.wb_bus.adr.eq(walk_addr(req_ctr)),
+                        self.wb_bus.stb.eq(1),
+                        req_ctr.eq(req_ctr + 1),
                     ]
-                    # Since the flags are in the low part of the entry, we can
-                    # avoid having to load the high byte if the entry is marked
-                    # as non-present anyway.
-                    with m.If(self.wb_bus.dat_r & 1):
-                        m.next = "fetch-second-byte"
-                    with m.Else():
-                        # PT miss
+
+                resp = self.wb_bus.ack | self.wb_bus.err | self.wb_bus.rty
+                requested = resp_ctr[1:] == 0
+
+                with m.If(resp):
+                    m.d.sync += resp_ctr.eq(resp_ctr + 1)
+
+                    with m.If(~resp_ctr[0]):
                         m.d.sync += [
-                            # CPU interface
-                            self.iface.abort.eq(1),
-                            self.iface.valid.eq(1),
-                            # Fault reason register
-                            self._fault_reason.f.addr.r_data.eq(self.iface.vaddr),
-                            self._fault_reason.f.non_present.r_data.eq(1),
-                            self._fault_reason.f.write.r_data.eq(self.iface.write),
-                            self._fault_reason.f.ifetch.r_data.eq(self.iface.ifetch),
-                            self._fault_reason.f.user.r_data.eq(self.iface.user),
+                            pt_low.eq(self.wb_bus.dat_r),
+                            pt_err.eq(self.wb_bus.err),
+                            pt_rty.eq(self.wb_bus.rty),
                         ]
-                        m.next = "idle"
-            with m.State("fetch-second-byte"):
-                m.d.sync += [
-                    self.wb_bus.adr.eq(self.wb_bus.adr + 1),
-                    self.wb_bus.cyc.eq(1),
-                ]
-                m.next = "wait-second-byte"
-            with m.State("wait-second-byte"):
-                with m.If(self.wb_bus.ack):
+                    with m.Else():
+                        pte = Signal(PageTableEntry)
+                        m.d.comb += pte.eq(Cat(pt_low, self.wb_bus.dat_r))
+
+                        fill_vpn = walk_vpn(resp_ctr[1:])
+                        fill = pte.present & self.wb_bus.ack & ~pt_err & ~pt_rty
+
+                        fill_hits = Signal(self._tlb_ways)
+                        for way in range(self._tlb_ways):
+                            entry = tlb_rd[way].data
+                            m.d.comb += fill_hits[way].eq(
+                                entry.valid & (entry.asid == cur_asid) & (entry.tag == fill_vpn[set_bits:]))
+
+                        with m.If(requested):
+                            m.d.sync += [
+                                tlb_entry.eq(pte),
+                                # A bus error while fetching the entry is
+                                # treated as a PT miss, a retry restarts the walk.
+                                walk_fault.eq(~pte.present | pt_err | self.wb_bus.err),
+                                walk_retry.eq(pt_rty | self.wb_bus.rty),
+                            ]
+
+                        # Insert all present entries. The requested one goes
+                        # into the way picked during lookup, prefetched ones
+                        # update the way they're already in, if any (a second
+                        # copy could shadow later updates of this one), or
+                        # replace round-robin.
+                        with m.If(fill):
+                            m.d.comb += [
+                                tlb_wr_addr.eq(fill_vpn[:set_bits]),
+                                tlb_wr_data.valid.eq(1),
+                                tlb_wr_data.asid.eq(cur_asid),
+                                tlb_wr_data.tag.eq(fill_vpn[set_bits:]),
+                                tlb_wr_data.pte.eq(pte),
+                            ]
+                            with m.If(~requested & fill_hits.any()):
+                                for way in range(self._tlb_ways):
+                                    m.d.comb += tlb_wr[way].en.eq(fill_hits[way])
+                            with m.Else():
+                                m.d.sync += victim_ctr.eq(Mux(victim_ctr == self._tlb_ways - 1, 0, victim_ctr + 1))
+                                for way in range(self._tlb_ways):
+                                    with m.If(Mux(requested, fill_way, victim_ctr) == way):
+                                        m.d.comb += tlb_wr[way].en.eq(1)
+
+                    with m.If(resp_ctr == walk_bytes - 1):
+                        m.d.sync += self.wb_bus.cyc.eq(0)
+                        m.next = "walk-done"
+            with m.State("walk-done"):
+                with m.If(walk_retry):
+                    m.d.sync += tlb_entry.eq(0)
+                    m.next = "act"
+                with m.Elif(walk_fault):
+                    # PT miss
                     m.d.sync += [
-                        self.wb_bus.cyc.eq(0),
-                        tlb_entry.eq(Cat(pt_low, self.wb_bus.dat_r)),
-                        wr_port.addr.eq(self.iface.vaddr.bit_select(12, 11)),
-                        wr_port.data.eq(Cat(pt_low, self.wb_bus.dat_r)),
-                        wr_port.en.eq(1),
+                        # CPU interface
+                        self.iface.abort.eq(1),
+                        self.iface.miss.eq(0),
+                        self.iface.valid.eq(1),
+                        # Fault reason register
+                        self._fault_reason.f.addr.r_data.eq(self.iface.vaddr),
+                        self._fault_reason.f.non_present.r_data.eq(1),
+                        self._fault_reason.f.write.r_data.eq(self.iface.write),
+                        self._fault_reason.f.ifetch.r_data.eq(self.iface.ifetch),
+                        self._fault_reason.f.user.r_data.eq(self.iface.user),
                     ]
+                    m.next = "idle"
+                with m.Else():
                     m.next = "act"
-            with m.State("flush"):
-                with m.If(~pending_flush):
-                    m.d.sync += wr_port.en.eq(0)
+            # Flushing reads each set, and then invalidates the matching
+            # entries in it.
+            with m.State("flush-read"):
+                m.d.comb += tlb_rd_addr.eq(flush_set)
+                m.next = "flush-write"
+            with m.State("flush-write"):
+                m.d.comb += [
+                    tlb_rd_addr.eq(flush_set),
+                    tlb_wr_addr.eq(flush_set),
+                    tlb_wr_data.eq(0),
+                ]
+                for way in range(self._tlb_ways):
+                    entry = tlb_rd[way].data
+                    with m.Switch(flush_mode):
+                        with m.Case(TLBFlushMode.FULL):
+                            m.d.comb += tlb_wr[way].en.eq(1)
+                        with m.Case(TLBFlushMode.PAGE):
+                            m.d.comb += tlb_wr[way].en.eq(entry.tag == flush_pfn[set_bits:])
+                        with m.Case(TLBFlushMode.ASID):
+                            m.d.comb += tlb_wr[way].en.eq(entry.asid == flush_asid)
+
+                m.d.sync += flush_set.eq(flush_set + 1)
+                with m.If((flush_mode == TLBFlushMode.PAGE) | (flush_set == self._tlb_sets - 1)):
+                    m.d.sync += pending_flush.eq(0)
                     m.next = "idle"
                 with m.Else():
-                    m.d.sync += [
-                        wr_port.data.eq(0),
-                        wr_port.addr.eq(flush_pfn),
-                        wr_port.en.eq(1),
-                        flush_pfn.eq(flush_pfn + 1),
-                    ]
-                    # If not flushing the whole TLB, stop after one write.
-                    with m.If(~full_flush):
-                        m.d.sync += pending_flush.eq(0)
-                    # If flushing the whole TLB, stop after the last TLB index.
-                    with m.Elif(flush_pfn == ((1 << 11) - 1)):
-                        m.d.sync += pending_flush.eq(0)
+                    m.next = "flush-read"
+
+        m.d.comb += self.iface.inval.eq(
+            self._pt_ptr.f.ptr.port.w_stb |
+            self._asid.f.asid.port.w_stb |
+            self._tlb_flush.f.full.w_stb |
+            self._tlb_flush_asid.f.asid.w_stb
+        )
 
         with m.If(self._tlb_flush.f.pfn.w_stb):
             m.d.sync += flush_pfn.eq(self._tlb_flush.f.pfn.w_data)
         with m.If(self._tlb_flush.f.full.w_stb):
             m.d.sync += [
-                full_flush.eq(self._tlb_flush.f.full.w_data),
+                flush_mode.eq(Mux(self._tlb_flush.f.full.w_data, TLBFlushMode.FULL, TLBFlushMode.PAGE)),
+                pending_flush.eq(1),
+            ]
+        with m.If(self._tlb_flush_asid.f.asid.w_stb):
+            m.d.sync += [
+                flush_asid.eq(self._tlb_flush_asid.f.asid.w_data),
+                flush_mode.eq(TLBFlushMode.ASID),
                 pending_flush.eq(1),
             ]
 
+        m.d.comb += self.perf.walk.eq(fsm.ongoing("walk") | fsm.ongoing("walk-done"))
+
         return m
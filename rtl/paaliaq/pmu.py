@@ -0,0 +1,100 @@
+from amaranth import *
+from amaranth.lib import wiring
+from amaranth.lib.wiring import In, Out
+from amaranth.utils import ceil_log2
+
+from amaranth_soc import csr
+
+
+# Performance events exported by a component. Each event is a 1-bit
+# signal, and is counted on every cycle it is high.
+class PerfEventSignature(wiring.Signature):
+    def __init__(self, names):
+        super().__init__({name: Out(1) for name in names})
+
+
+# Performance monitoring unit.
+# A bank of free-running counters, each of which counts one of the
+# events, selected at runtime from the list given at construction.
+#
+# Register layout:
+#   0x00        Control (freeze all counters, clear a set of counters)
+#   0x08 + i    EventSel of counter i (event index, enable)
+#   0x10 + 8*i  Counter i (32 or 48 bits)
+#
+# Counters wider than the bus are latched when their first byte is read.
+class PerfMonitor(wiring.Component):
+    class ControlRegister(csr.Register, access="rw"):
+        freeze:  csr.Field(csr.action.RW, 1)
+        _unused: csr.Field(csr.action.ResR0WA, 7)
+        clear:   csr.Field(csr.action.W, 8)
+
+    class EventSelRegister(csr.Register, access="rw"):
+        event:  csr.Field(csr.action.RW, 7)
+        enable: csr.Field(csr.action.RW, 1)
+
+
+    def __init__(self, events, *, counters=4, width=48):
+        if counters not in range(1, 9):
+            raise ValueError(f"Number of counters must be between 1 and 8, not {counters}")
+        if width not in (32, 48):
+            raise ValueError(f"Counter width must be 32 or 48, not {width}")
+        if len(events) > 128:
+            raise ValueError(f"Too many events ({len(events)}), at most 128 are supported")
+
+        self._events = list(events)
+        self._counters = counters
+        self._width = width
+
+        addr_width = ceil_log2(0x10 + 8 * counters)
+
+        super().__init__({
+            "csr_bus": In(csr.Signature(addr_width=addr_width, data_width=8)),
+            "events": In(len(self._events)),
+        })
+
+        regs = csr.Builder(addr_width=addr_width, data_width=8)
+
+        self._control = regs.add("Control", self.ControlRegister())
+        self._event_sel = [
+            regs.add(f"EventSel{i}", self.EventSelRegister(), offset=0x08 + i)
+            for i in range(counters)
+        ]
+        self._counter = [
+            regs.add(f"Counter{i}", csr.Register({"value": csr.Field(csr.action.R, width)}, access="r"),
+                     offset=0x10 + 8 * i)
+            for i in range(counters)
+        ]
+
+        mmap = regs.as_memory_map()
+        self._bridge = csr.Bridge(mmap)
+        self.csr_bus.memory_map = mmap
+
+    def event_index(self, name):
+        return self._events.index(name)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.bridge = self._bridge
+        wiring.connect(m, wiring.flipped(self.csr_bus), self._bridge.bus)
+
+        # Register the events, they come from all over the SoC.
+        events = Signal(len(self._events))
+        m.d.sync += events.eq(self.events)
+
+        freeze = self._control.f.freeze.data
+        clear = self._control.f.clear
+
+        for i in range(self._counters):
+            sel = self._event_sel[i].f
+            value = Signal(self._width)
+
+            with m.If(clear.w_stb & clear.w_data[i]):
+                m.d.sync += value.eq(0)
+            with m.Elif(sel.enable.data & ~freeze & (sel.event.data < len(self._events))):
+                m.d.sync += value.eq(value + events.bit_select(sel.event.data, 1))
+
+            m.d.comb += self._counter[i].f.value.r_data.eq(value)
+
+        return m
@@ -1,10 +1,13 @@
 from amaranth import *
 from amaranth.lib import wiring, io, enum, data
-from amaranth.lib.fifo import SyncFIFO, SyncFIFOBuffered
+from amaranth.lib.fifo import SyncFIFO
 from amaranth.lib.wiring import In, Out
+from amaranth.utils import exact_log2
 from amaranth_soc import wishbone
 from amaranth_soc.memory import MemoryMap
 
+from paaliaq.pmu import PerfEventSignature
+
 import math
 
 
@@ -15,6 +18,7 @@ class SDRAMSignature(wiring.Signature):
             'a':    Out(13),
             'dq_i': In(16),
             'dq_o': Out(16),
+            'dq_oe': Out(1),
             'dqm':  Out(2),
             'we':   Out(1),
             'ras':  Out(1),
@@ -54,7 +58,7 @@ class SDRAMConnector(wiring.Component):
             cs.o.eq(1),
             ba.o.eq(self.sdram.ba),
             a.o.eq(self.sdram.a),
-            dq.oe.eq(self.sdram.we),
+            dq.oe.eq(self.sdram.dq_oe),
             dq.o.eq(self.sdram.dq_o),
             dqm.o.eq(self.sdram.dqm),
             self.sdram.dq_i.eq(dq.i),
@@ -82,14 +86,44 @@ class Transaction(data.Struct):
     bank:   2
     row:    13
     column: 9
-
-
+    data:   16
+    mask:   2
+
+
+
+
+# SDRAM controller with burst support.
+#
+# The Wishbone bus is as wide as the SDRAM data bus, with byte lanes
+# mapped onto DQM. Incrementing bursts (CTI/BTE) are supported, during
+# which the controller reads ahead of the manager to keep the SDRAM
+# streaming one word per cycle.
+#
+# Accesses are queued, and the command scheduler looks at the head of
+# the queue every cycle. Accesses to consecutive columns of the burst in
+# progress don't need another READ/WRITE command. The command bus is
+# free during such cycles (and while waiting for read data), which lets
+# the scheduler precharge and activate a different bank while another
+# bank is busy transferring data.
+#
+# init_ns is how long to wait after power-up before initializing the
+# chip. Only worth shortening in simulation, where the chip doesn't
+# need the time.
 class SDRAMController(wiring.Component):
-    wb_bus: In(wishbone.Signature(addr_width=23, data_width=8))
+    wb_bus: In(wishbone.Signature(addr_width=22, data_width=16, granularity=8,
+                                  features={"cti", "bte"}))
+    perf: Out(PerfEventSignature(["row_hit", "row_miss", "refresh_stall"]))
+
+    def __init__(self, *, burst_len=4, prefetch_depth=8, init_ns=200000):
+        if burst_len not in (1, 2, 4, 8):
+            raise ValueError(f"Burst length must be 1, 2, 4 or 8, not {burst_len}")
 
-    def __init__(self):
         super().__init__()
 
+        self._burst_len = burst_len
+        self._prefetch_depth = prefetch_depth
+        self._init_ns = init_ns
+
         self.wb_bus.memory_map = MemoryMap(addr_width=23, data_width=8)
         self.wb_bus.memory_map.add_resource(self, name=('mem',), size=(1<<23))
         self.wb_bus.memory_map.freeze()
@@ -125,6 +159,7 @@ class SDRAMController(wiring.Component):
             with m.Case(Command.PRECHARGE_BANK):
                 m.d.sync += [
                     cmd_bits.eq(0b101),
+                    sdram_io.a.eq(0),
                     sdram_io.ba.eq(bank),
                 ]
             with m.Case(Command.PRECHARGE_ALL):
@@ -147,21 +182,20 @@ class SDRAMController(wiring.Component):
             with m.Case(Command.REFRESH):
                 m.d.sync += cmd_bits.eq(0b011)
 
-        m.submodules.tx_fifo = tx_fifo = SyncFIFOBuffered(width=Shape.cast(Transaction).width, depth=4)
+        m.submodules.tx_fifo = tx_fifo = SyncFIFO(width=Shape.cast(Transaction).width, depth=8)
         m.submodules.in_fifo = in_fifo = SyncFIFO(width=16, depth=32)
-        m.submodules.out_fifo = out_fifo = SyncFIFO(width=16, depth=32)
 
         # Memory controller
         # -----------------
 
-        cur_tx, next_tx = Signal(Transaction), Signal(Transaction)
-        m.d.comb += next_tx.eq(tx_fifo.r_data)
+        head = Signal(Transaction)
+        m.d.comb += head.eq(tx_fifo.r_data)
 
 
         def ns_to_clks(ns):
             return int(math.ceil(ns * platform.sdram_clk / 1000000000))
 
-        init_clks = ns_to_clks(200000)
+        init_clks = ns_to_clks(self._init_ns)
         init_ctr = Signal(range(init_clks + 1))
 
         precharge_clks = 3 # tRP
@@ -172,22 +206,19 @@ class SDRAMController(wiring.Component):
         init_refreshes = Signal(1)
 
         activate_clks = 3 # tRCD
-        activate_ctr = Signal(range(activate_clks + 1))
-
         write_clks = 2 # tDPL
-        write_ctr = Signal(range(write_clks + 1))
+        ras_clks = ns_to_clks(42) # tRAS
+        rrd_clks = 2 # tRRD
 
         cas_clks = 3 if platform.sdram_clk > 100e6 else 2
-        read_ctr = Signal(range(cas_clks + 2))
 
         tRES = 64000000
         refreshes_per_tRES = 8192
         time_between_refreshes = tRES // refreshes_per_tRES
         refresh_stb_clks = ns_to_clks(time_between_refreshes)
         refresh_stb_ctr = Signal(range(refresh_stb_clks + 1))
-        # Currently we can slip by 1 refresh if the time comes during
-        # a read/write.  If that happens, we will do one immediately
-        # after the operation completes.
+        # A refresh that comes due while accesses are in flight waits
+        # for them to drain before the banks are precharged.
 
         pending_refresh = Signal()
 
@@ -197,29 +228,104 @@ class SDRAMController(wiring.Component):
         with m.Else():
             m.d.sync += refresh_stb_ctr.eq(refresh_stb_ctr + 1)
 
-        burst_size = 1
-        word_ctr = Signal(3)
-        in_stb, out_stb = Signal(), Signal()
+        # Per-bank state. The timers hold the number of cycles left
+        # until the bank can be read from/written to (tRCD), activated
+        # (tRP), or precharged (tRAS, tDPL) respectively.
+        banks_active = Signal(4)
+        current_rows = Array([Signal(13, name=f"row_{i}") for i in range(4)])
+
+        rw_timer_list = [Signal(range(activate_clks + 2), name=f"rw_timer_{i}") for i in range(4)]
+        act_timer_list = [Signal(range(precharge_clks + 2), name=f"act_timer_{i}") for i in range(4)]
+        pre_timer_list = [Signal(range(max(ras_clks, write_clks + 1) + 1), name=f"pre_timer_{i}") for i in range(4)]
+        rw_timers, act_timers, pre_timers = Array(rw_timer_list), Array(act_timer_list), Array(pre_timer_list)
+
+        rrd_timer = Signal(range(rrd_clks + 1))
+
+        for timer in [*rw_timer_list, *act_timer_list, *pre_timer_list, rrd_timer]:
+            with m.If(timer != 0):
+                m.d.sync += timer.eq(timer - 1)
+
+        # Burst in progress. The SDRAM keeps going through the columns of
+        # a burst on its own, so an access to the column it's currently
+        # at needs no command. Sequential bursts wrap around within a
+        # block of burst_len columns.
+        bl = self._burst_len
+        bl_bits = exact_log2(bl)
+
+        def burst_next_col(col):
+            return Cat((col + 1)[:bl_bits], col[bl_bits:])
+
+        burst_left = Signal(range(bl))
+        burst_bank = Signal(2)
+        burst_col = Signal(9)
+        burst_write = Signal()
+
+        with m.If(burst_left != 0):
+            m.d.sync += [
+                burst_left.eq(burst_left - 1),
+                burst_col.eq(burst_next_col(burst_col)),
+            ]
+
+        # Read data comes back cas_clks cycles after the command, plus
+        # the registers on the way to and from the pins.
+        rd_beat, wr_beat = Signal(), Signal()
+        read_pipe = Signal(cas_clks + 3)
+
+        m.d.sync += read_pipe.eq(Cat(rd_beat, read_pipe))
 
         m.d.sync += in_fifo.w_en.eq(0)
-        m.d.sync += in_stb.eq(0)
-        with m.If(in_stb):
+        with m.If(read_pipe[-1]):
             m.d.sync += [
                 in_fifo.w_data.eq(sdram_io.dq_i),
                 in_fifo.w_en.eq(1),
             ]
 
-        m.d.sync += out_fifo.r_en.eq(0)
-        with m.If(out_stb):
-            m.d.sync += [
-                sdram_io.dq_o.eq(out_fifo.r_data),
-                out_fifo.r_en.eq(1),
-            ]
+        # The data bus must be free of read data before we start driving
+        # it for a write.
+        turnaround_clks = cas_clks + 3
+        turnaround_ctr = Signal(range(turnaround_clks + 1))
 
-        banks_active = Signal(4)
-        current_rows = Array([Signal(9) for _ in range(4)])
+        read_bursting = (burst_left != 0) & ~burst_write
+        reading = Signal()
+        m.d.comb += reading.eq(rd_beat | read_bursting)
 
-        with m.FSM():
+        with m.If(reading):
+            m.d.sync += turnaround_ctr.eq(turnaround_clks)
+        with m.Elif(turnaround_ctr != 0):
+            m.d.sync += turnaround_ctr.eq(turnaround_ctr - 1)
+
+        # Write data goes out together with the command. Beats of a write
+        # burst we have no data for are masked off, unless a read command
+        # interrupts the burst (DQM has a 2 cycle latency for reads).
+        write_bursting = (burst_left != 0) & burst_write
+
+        m.d.sync += [
+            sdram_io.dq_o.eq(head.data),
+            sdram_io.dq_oe.eq(wr_beat),
+        ]
+        with m.If(wr_beat):
+            m.d.sync += sdram_io.dqm.eq(~head.mask)
+        with m.Elif(write_bursting & ~rd_beat):
+            m.d.sync += sdram_io.dqm.eq(0b11)
+        with m.Else():
+            m.d.sync += sdram_io.dqm.eq(0b00)
+
+        banks_idle = Cat(timer == 0 for timer in pre_timer_list).all()
+
+        # Whether the row for the access at the head of the queue had
+        # to be opened (for the row hit/miss events).
+        head_activated = Signal()
+        with m.If(tx_fifo.r_en):
+            m.d.sync += head_activated.eq(0)
+        with m.If(current_cmd == Command.ACTIVATE):
+            m.d.sync += head_activated.eq(1)
+
+        m.d.comb += [
+            self.perf.row_hit.eq(tx_fifo.r_en & ~head_activated),
+            self.perf.row_miss.eq(tx_fifo.r_en & head_activated),
+        ]
+
+        with m.FSM() as fsm:
             with m.State("init-wait"):
                 m.d.sync += init_ctr.eq(init_ctr + 1)
                 with m.If(init_ctr == init_clks):
@@ -248,116 +354,113 @@ class SDRAMController(wiring.Component):
                         m.next = "init-refresh"
 
             with m.State("init-mrs"):
+                # Sequential bursts of burst_len, for both reads and writes.
                 m.d.comb += [
                     current_cmd.eq(Command.MRS),
-                    address.eq(cas_clks << 4),
+                    address.eq((cas_clks << 4) | bl_bits),
                 ]
                 m.next = "init-mrs-idle-1"
             with m.State("init-mrs-idle-1"):
                 m.next = "init-mrs-idle-2"
             with m.State("init-mrs-idle-2"):
                 m.d.sync += pending_refresh.eq(0)
-                m.next = "idle"
+                m.next = "run"
+
+            with m.State("run"):
+                target_bank = head.bank
+                bank_active = banks_active.bit_select(target_bank, 1)
+                row_hit = current_rows[target_bank] == head.row
+                continues_burst = (
+                    (burst_left != 0) &
+                    (burst_bank == target_bank) &
+                    (burst_write == head.write) &
+                    (burst_col == head.column)
+                )
 
-            with m.State("idle"):
                 with m.If(pending_refresh):
-                    m.d.sync += pending_refresh.eq(0)
-
-                    with m.If(banks_active):
-                        m.d.sync += banks_active.eq(0)
-                        m.next = "refresh-precharge"
-                    with m.Else():
-                        m.next = "refresh"
-                with m.Elif(tx_fifo.r_rdy):
-                    m.d.sync += cur_tx.eq(next_tx)
-                    m.d.comb += tx_fifo.r_en.eq(1)
-
-                    m.d.sync += [
-                        banks_active.bit_select(next_tx.bank, 1).eq(1),
-                        current_rows[next_tx.bank].eq(next_tx.row),
-                        word_ctr.eq(0),
-                        read_ctr.eq(0),
-                        write_ctr.eq(0),
-                    ]
-
-                    with m.If(banks_active.bit_select(next_tx.bank, 1)):
-                        with m.If(next_tx.row == current_rows[next_tx.bank]):
-                            # Target bank has the desired row already open.
-                            # Read/write immediately.
-                            with m.If(next_tx.write):
-                                m.next = "write"
-                            with m.Else():
-                                m.next = "read"
+                    # Stop issuing new accesses, and wait for the ones in
+                    # flight to finish before precharging all banks. A bank
+                    # precharged just before still needs tRP to pass, and
+                    # so does tRRD since the last activation.
+                    drained = (
+                        (burst_left == 0) &
+                        (read_pipe == 0) &
+                        (turnaround_ctr == 0) &
+                        banks_idle &
+                        Cat(timer == 0 for timer in act_timer_list).all() &
+                        (rrd_timer == 0)
+                    )
+                    with m.If(drained):
+                        m.d.sync += pending_refresh.eq(0)
+
+                        with m.If(banks_active):
+                            m.d.sync += banks_active.eq(0)
+                            m.next = "refresh-precharge"
                         with m.Else():
-                            # Target bank has the wrong row open.
-                            # Precharge, the activate, then read/write.
-                            m.next = "precharge"
-                    with m.Else():
-                        # Target bank is idle.
-                        # Activate, then read/write.
-                        m.next = "activate"
-
-            with m.State("precharge"):
-                m.d.comb += [
-                    current_cmd.eq(Command.PRECHARGE_BANK),
-                    bank.eq(cur_tx.bank),
-                ]
-                m.d.sync += precharge_ctr.eq(0)
-                m.next = "precharge-wait"
-            with m.State("precharge-wait"):
-                m.d.sync += precharge_ctr.eq(precharge_ctr + 1)
-                with m.If(precharge_ctr == precharge_clks):
-                    m.next = "activate"
+                            m.next = "refresh"
+                with m.Elif(tx_fifo.r_rdy & bank_active & row_hit):
+                    # Target bank has the desired row already open.
+                    # Read/write once tRCD has elapsed (and, for writes,
+                    # the data bus is ours).
+                    with m.If((rw_timers[target_bank] == 0) &
+                              ~(head.write & (turnaround_ctr != 0))):
+                        m.d.comb += tx_fifo.r_en.eq(1)
+
+                        with m.If(head.write):
+                            m.d.comb += wr_beat.eq(1)
+
+                            with m.If(pre_timers[target_bank] < write_clks + 1):
+                                m.d.sync += pre_timers[target_bank].eq(write_clks + 1)
+                        with m.Else():
+                            m.d.comb += rd_beat.eq(1)
 
-            with m.State("activate"):
-                m.d.comb += [
-                    current_cmd.eq(Command.ACTIVATE),
-                    bank.eq(cur_tx.bank),
-                    address.eq(cur_tx.row),
-                ]
-                m.d.sync += activate_ctr.eq(0)
-                m.next = "activate-wait"
-            with m.State("activate-wait"):
-                m.d.sync += activate_ctr.eq(activate_ctr + 1)
-                with m.If(activate_ctr == activate_clks):
-                    with m.If(next_tx.write):
-                        m.next = "write"
-                    with m.Else():
-                        m.next = "read"
-
-            with m.State("write"):
-                with m.If(word_ctr == 0):
-                    m.d.comb += [
-                        current_cmd.eq(Command.WRITE),
-                        bank.eq(cur_tx.bank),
-                        address.eq(cur_tx.column),
-                    ]
-
-                m.d.comb += out_stb.eq(1)
-                m.d.sync += word_ctr.eq(word_ctr + 1)
-                with m.If(word_ctr == burst_size - 1):
-                    m.next = "write-wait"
-            with m.State("write-wait"):
-                m.d.sync += write_ctr.eq(write_ctr + 1)
-                with m.If(write_ctr == write_clks):
-                    m.next = "idle"
-
-            with m.State("read"):
-                with m.If(read_ctr == 0):
-                    m.d.comb += [
-                        current_cmd.eq(Command.READ),
-                        bank.eq(cur_tx.bank),
-                        address.eq(cur_tx.column),
-                    ]
-
-                m.d.sync += read_ctr.eq(read_ctr + 1)
-                with m.If(read_ctr == cas_clks + 1):
-                    m.next = "read-data"
-            with m.State("read-data"):
-                m.d.sync += in_stb.eq(1)
-                m.d.sync += word_ctr.eq(word_ctr + 1)
-                with m.If(word_ctr == burst_size - 1):
-                    m.next = "idle"
+                        with m.If(~continues_burst):
+                            with m.If(head.write):
+                                m.d.comb += current_cmd.eq(Command.WRITE)
+                            with m.Else():
+                                m.d.comb += current_cmd.eq(Command.READ)
+
+                            m.d.comb += [
+                                bank.eq(target_bank),
+                                address.eq(head.column),
+                            ]
+                            m.d.sync += [
+                                burst_left.eq(bl - 1),
+                                burst_bank.eq(target_bank),
+                                burst_col.eq(burst_next_col(head.column)),
+                                burst_write.eq(head.write),
+                            ]
+                with m.Elif(tx_fifo.r_rdy & bank_active):
+                    # Target bank has the wrong row open.
+                    # Precharge, then activate, then read/write.
+                    with m.If(pre_timers[target_bank] == 0):
+                        m.d.comb += [
+                            current_cmd.eq(Command.PRECHARGE_BANK),
+                            bank.eq(target_bank),
+                        ]
+                        m.d.sync += [
+                            banks_active.bit_select(target_bank, 1).eq(0),
+                            act_timers[target_bank].eq(precharge_clks + 1),
+                        ]
+                        # Precharging terminates the burst.
+                        with m.If(burst_bank == target_bank):
+                            m.d.sync += burst_left.eq(0)
+                with m.Elif(tx_fifo.r_rdy):
+                    # Target bank is idle.
+                    # Activate, then read/write.
+                    with m.If((act_timers[target_bank] == 0) & (rrd_timer == 0)):
+                        m.d.comb += [
+                            current_cmd.eq(Command.ACTIVATE),
+                            bank.eq(target_bank),
+                            address.eq(head.row),
+                        ]
+                        m.d.sync += [
+                            banks_active.bit_select(target_bank, 1).eq(1),
+                            current_rows[target_bank].eq(head.row),
+                            rw_timers[target_bank].eq(activate_clks + 1),
+                            pre_timers[target_bank].eq(ras_clks),
+                            rrd_timer.eq(rrd_clks),
+                        ]
 
             with m.State("refresh-precharge"):
                 m.d.comb += current_cmd.eq(Command.PRECHARGE_ALL)
@@ -375,54 +478,111 @@ class SDRAMController(wiring.Component):
             with m.State("refresh-wait"):
                 m.d.sync += refresh_ctr.eq(refresh_ctr + 1)
                 with m.If(refresh_ctr == refresh_clks):
-                    m.next = "idle"
+                    m.next = "run"
 
         # Wishbone interface
         # ------------------
 
-        with m.FSM():
-            with m.State("idle"):
-                with m.If(self.wb_bus.cyc & self.wb_bus.stb & self.wb_bus.sel):
-                    column = self.wb_bus.adr.bit_select(0, 9)
-                    bank = self.wb_bus.adr.bit_select(9, 2)
-                    row = self.wb_bus.adr.bit_select(11, 12)
-
-                    new_tx = Signal(Transaction)
-
-                    m.d.comb += [
-                        new_tx.write.eq(self.wb_bus.we),
-                        new_tx.column.eq(column),
-                        new_tx.bank.eq(bank),
-                        new_tx.row.eq(row),
-                        tx_fifo.w_data.eq(new_tx),
-                        tx_fifo.w_en.eq(1),
-                    ]
-
-                    with m.If(self.wb_bus.we):
-                        m.d.comb += [
-                            out_fifo.w_data.eq(self.wb_bus.dat_w),
-                            out_fifo.w_en.eq(1),
-                        ]
-                        m.next = "write"
-                    with m.Else():
-                        m.next = "read"
-
-            with m.State("read"):
-                with m.If(in_fifo.r_rdy):
-                    m.d.comb += in_fifo.r_en.eq(1)
-                    m.d.sync += [
-                        self.wb_bus.dat_r.eq(in_fifo.r_data),
-                        self.wb_bus.ack.eq(1),
-                    ]
-                    m.next = "complete"
-
-            with m.State("write"):
-                with m.If(out_fifo.w_level == 0):
-                    m.d.sync += self.wb_bus.ack.eq(1)
-                    m.next = "complete"
-
-            with m.State("complete"):
-                m.d.sync += self.wb_bus.ack.eq(0)
-                m.next = "idle"
+        # Writes are posted, and acknowledged as soon as they are queued.
+        # Reads are acknowledged once the data comes back. During
+        # incrementing bursts, up to prefetch_depth reads are queued
+        # ahead of the manager. Reads still in flight once the burst
+        # ends are discarded.
+
+        bus_req = self.wb_bus.cyc & self.wb_bus.stb
+        incr_burst = self.wb_bus.cti == wishbone.CycleType.INCR_BURST
+
+        wrap_mask = Signal(22)
+        with m.Switch(self.wb_bus.bte):
+            with m.Case(wishbone.BurstTypeExt.WRAP_4):
+                m.d.comb += wrap_mask.eq(0b11)
+            with m.Case(wishbone.BurstTypeExt.WRAP_8):
+                m.d.comb += wrap_mask.eq(0b111)
+            with m.Case(wishbone.BurstTypeExt.WRAP_16):
+                m.d.comb += wrap_mask.eq(0b1111)
+
+        def burst_next_adr(adr):
+            return Mux(wrap_mask == 0, adr + 1, (adr & ~wrap_mask) | ((adr + 1) & wrap_mask))
+
+        rd_inflight = Signal(range(self._prefetch_depth + 1))
+        rd_discard = Signal(range(in_fifo.depth + 1))
+        rd_next_adr = Signal(22)
+
+        push_adr = Signal(22)
+        new_tx = Signal(Transaction)
+
+        m.d.comb += [
+            new_tx.write.eq(self.wb_bus.we),
+            new_tx.column.eq(push_adr.bit_select(0, 9)),
+            new_tx.bank.eq(push_adr.bit_select(9, 2)),
+            new_tx.row.eq(push_adr.bit_select(11, 11)),
+            new_tx.data.eq(self.wb_bus.dat_w),
+            new_tx.mask.eq(self.wb_bus.sel),
+            tx_fifo.w_data.eq(new_tx),
+        ]
+
+        with m.If(bus_req & self.wb_bus.we):
+            m.d.comb += [
+                push_adr.eq(self.wb_bus.adr),
+                tx_fifo.w_en.eq(1),
+            ]
+        with m.Elif(bus_req & (rd_inflight == 0)):
+            # First (or only) beat of a read.
+            m.d.comb += [
+                push_adr.eq(self.wb_bus.adr),
+                tx_fifo.w_en.eq(1),
+            ]
+            with m.If(tx_fifo.w_rdy):
+                m.d.sync += rd_next_adr.eq(burst_next_adr(self.wb_bus.adr))
+        with m.Elif(bus_req & incr_burst & (rd_inflight != self._prefetch_depth)):
+            # Read ahead of the manager.
+            m.d.comb += [
+                push_adr.eq(rd_next_adr),
+                tx_fifo.w_en.eq(1),
+            ]
+            with m.If(tx_fifo.w_rdy):
+                m.d.sync += rd_next_adr.eq(burst_next_adr(rd_next_adr))
+
+        pushed_rd = tx_fifo.w_en & tx_fifo.w_rdy & ~self.wb_bus.we
+
+        acked_rd, discarded = Signal(), Signal()
+
+        with m.If(rd_discard != 0):
+            m.d.comb += [
+                discarded.eq(in_fifo.r_rdy),
+                in_fifo.r_en.eq(1),
+            ]
+        with m.Elif(bus_req & ~self.wb_bus.we & (rd_inflight != 0)):
+            m.d.comb += [
+                acked_rd.eq(in_fifo.r_rdy),
+                in_fifo.r_en.eq(1),
+            ]
+
+        m.d.comb += [
+            self.wb_bus.dat_r.eq(in_fifo.r_data),
+            self.wb_bus.ack.eq(acked_rd | (bus_req & self.wb_bus.we & tx_fifo.w_rdy)),
+        ]
+
+        with m.If(~self.wb_bus.cyc & (rd_inflight != 0)):
+            # Manager gave up on the cycle.
+            m.d.sync += [
+                rd_inflight.eq(0),
+                rd_discard.eq(rd_discard - discarded + rd_inflight),
+            ]
+        with m.Elif(acked_rd & ~incr_burst):
+            # Last beat of the cycle.
+            m.d.sync += [
+                rd_inflight.eq(0),
+                rd_discard.eq(rd_inflight - 1),
+            ]
+        with m.Else():
+            m.d.sync += [
+                rd_inflight.eq(rd_inflight + pushed_rd - acked_rd),
+                rd_discard.eq(rd_discard - discarded),
+            ]
+
+        # Accesses waiting on a refresh.
+        refreshing = ~fsm.ongoing("run") | pending_refresh
+        m.d.comb += self.perf.refresh_stall.eq(tx_fifo.r_rdy & refreshing)
 
         return m
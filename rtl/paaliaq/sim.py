@@ -1,59 +1,625 @@
+# Whole-SoC simulation
+#
+# Runs the SoC under the Amaranth simulator, with behavioral models of
+# everything that sits outside of the FPGA: the CPU (the bus-cycle model
+# from scripts/w65c816.py, behind the W65C816BusSignature pins), the
+# SDRAM chip and the UARTs. Useful for benchmarking changes to the
+# interconnect or the MMU without building a bitstream.
+#
+#   python -m paaliaq.sim --boot-rom ../build/boot0.bin --cycles 1000000
+#
+# Getting through the boot ROM and the firmware setup takes a while, so
+# the state of the simulation can be saved once that's done, and later
+# runs picked up from there:
+#
+#   python -m paaliaq.sim --cycles 5000000 --save-checkpoint booted.ckpt
+#   python -m paaliaq.sim --resume booted.ckpt --cycles 1000000
+#
+# For speed, the same top can be emitted as Verilog, for the Verilator
+# based co-simulation in sim/ (driven from Python by scripts/cosim.py):
+#
+#   python -m paaliaq.sim --verilog ../build/sim_top.v
+
+import argparse
+import pickle
+import queue
+import sys
+import threading
+import time
+
+from collections import namedtuple
+from pathlib import Path
+from types import SimpleNamespace
+
 from amaranth import *
-from amaranth.lib import wiring
+from amaranth.hdl import Fragment, MemoryInstance
+from amaranth.lib import io, wiring
 from amaranth.lib.wiring import In, Out
+from amaranth.sim import Simulator
 
 from paaliaq.soc import SoC
-from paaliaq.cpu import P65C816SoftCore
+from paaliaq.cpu import W65C816BusSignature
 from paaliaq.sdram import SDRAMSignature
+from paaliaq.spi import SPISignature
+
+# The CPU model lives with the test scripts.
+sys.path.append(str(Path(__file__).resolve().parents[2] / "scripts"))
+from w65c816 import W65C816
+
+
+UARTPins = namedtuple("UARTPins", "rx, tx")
+
+
+def _uart_pins(name):
+    return UARTPins(
+        SimpleNamespace(i=Signal(init=1, name=f"{name}_rx")),
+        SimpleNamespace(o=Signal(init=1, name=f"{name}_tx")),
+    )
+
+
+# Stands in for the board platform (see artix7/platform.py). The IOs
+# the SoC asks for are plain signals, driven by the models below, or
+# simulation ports for the ones nothing looks at (HDMI, GMII).
+class SimPlatform:
+    def __init__(self, *, soc_clk):
+        self._soc_clk = soc_clk
+
+        self.sdram = SDRAMSignature().create(path=("sdram",))
+        self.w65c816 = W65C816BusSignature().create(path=("w65c816",))
+        self.spi = SPISignature().create(path=("spi",))
+        self.uart = _uart_pins("uart")
+        self.debug_uart = _uart_pins("debug_uart")
+
+        self._resources = {
+            "hdmi": SimpleNamespace(
+                clk=io.SimulationPort("o", 1, name="hdmi_clk"),
+                data=io.SimulationPort("o", 3, name="hdmi_data"),
+            ),
+            "gmii": SimpleNamespace(
+                phyrst=io.SimulationPort("o", 1, name="gmii_phyrst"),
+                rx_clk=io.SimulationPort("i", 1, name="gmii_rx_clk"),
+                gtx_clk=io.SimulationPort("o", 1, name="gmii_gtx_clk"),
+                tx_en=io.SimulationPort("o", 1, name="gmii_tx_en"),
+                tx_er=io.SimulationPort("o", 1, name="gmii_tx_er"),
+                txd=io.SimulationPort("o", 8, name="gmii_txd"),
+                rx_dv=io.SimulationPort("i", 1, name="gmii_rx_dv"),
+                rx_er=io.SimulationPort("i", 1, name="gmii_rx_er"),
+                rxd=io.SimulationPort("i", 8, name="gmii_rxd"),
+            ),
+        }
+
+    @property
+    def soc_clk(self):
+        return self._soc_clk
+
+    @property
+    def sdram_clk(self):
+        return self._soc_clk
 
+    def request(self, name, number=0, *, dir):
+        return self._resources[name]
 
-class TopLevel(wiring.Component):
-    tx: Out(1)
-    sdram: Out(SDRAMSignature())
-    sdram_clk: Out(1)
+    def get_sdram_ios(self):
+        return self.sdram
+
+    def get_w65c816_ios(self):
+        return self.w65c816
+
+    def get_uart(self):
+        return self.uart
+
+    def get_spi(self):
+        return self.spi
+
+    def get_debug_uart(self):
+        return self.debug_uart
+
+    # Amaranth can't simulate DDR buffers (the HDMI output goes through
+    # them), so those only pass on the first of the two bits. Nothing
+    # looks at them anyway.
+    def get_io_buffer(self, buffer):
+        if isinstance(buffer, io.DDRBuffer):
+            assert buffer.direction is io.Direction.Output
+            m = Module()
+            m.d[buffer.o_domain] += buffer.port.o.eq(buffer.o[0])
+            return m
+
+        return buffer.elaborate(None)
+
+
+class SimTop(Elaboratable):
+    def __init__(self, *, boot_rom_path, fast_init=True):
+        super().__init__()
+        self._boot_rom_path = boot_rom_path
+        self._fast_init = fast_init
 
     def elaborate(self, platform):
         m = Module()
 
-        m.submodules.soc = soc = SoC(target_clk=115200 * 10)
+        m.domains.sync = ClockDomain("sync")
+        m.domains.pixel = ClockDomain("pixel")
+        m.domains.tmds = ClockDomain("tmds")
+
+        m.submodules.soc = SoC(boot_rom_path=self._boot_rom_path, fast_init=self._fast_init)
+
+        return m
+
 
-        m.submodules.cpu = cpu = P65C816SoftCore()
-        wiring.connect(m, cpu.iface, soc.cpu)
+# Top level for the Verilator build in sim/. The clocks come from the
+# outside, and the pins the models drive are brought out as ports,
+# under flat names (Verilator mangles the double underscores Amaranth
+# would use for interface members).
+class VerilatorTop(wiring.Component):
+    def __init__(self, *, boot_rom_path, fast_init=True):
+        members = {
+            "clk": In(1),
+            "pixel_clk": In(1),
+            "tmds_clk": In(1),
+            "uart_rx": In(1),
+            "uart_tx": Out(1),
+            "debug_uart_rx": In(1),
+            "debug_uart_tx": Out(1),
+        }
+        for name, member in SDRAMSignature().members.items():
+            members[f"sdram_{name}"] = member
+        # The CPU is on the other side of these.
+        for name, member in W65C816BusSignature().members.items():
+            members[f"cpu_{name}"] = member.flip()
 
-        m.d.comb += self.tx.eq(soc.tx)
-        m.d.comb += soc.rx.eq(1)
+        super().__init__(members)
+        self._boot_rom_path = boot_rom_path
+        self._fast_init = fast_init
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.top = SimTop(boot_rom_path=self._boot_rom_path, fast_init=self._fast_init)
 
         m.d.comb += [
-            self.sdram.ba.eq(soc.sdram.ba),
-            self.sdram.a.eq(soc.sdram.a),
-            self.sdram.dq_o.eq(soc.sdram.dq_o),
-            soc.sdram.dq_i.eq(self.sdram.dq_i),
-            self.sdram.we.eq(~soc.sdram.we),
-            self.sdram.ras.eq(~soc.sdram.ras),
-            self.sdram.cas.eq(~soc.sdram.cas),
-            self.sdram_clk.eq(~ClockSignal("sync")),
+            ClockSignal("sync").eq(self.clk),
+            ClockSignal("pixel").eq(self.pixel_clk),
+            ClockSignal("tmds").eq(self.tmds_clk),
         ]
 
+        def bring_out(prefix, iface, soc_flow):
+            for (name,), member, value in iface.signature.flatten(iface):
+                port = getattr(self, f"{prefix}_{name}")
+                if member.flow == soc_flow:
+                    m.d.comb += port.eq(value)
+                else:
+                    m.d.comb += value.eq(port)
+
+        bring_out("sdram", platform.sdram, Out)
+        bring_out("cpu", platform.w65c816, In)
+
+        m.d.comb += [
+            platform.uart.rx.i.eq(self.uart_rx),
+            self.uart_tx.eq(platform.uart.tx.o),
+            platform.debug_uart.rx.i.eq(self.debug_uart_rx),
+            self.debug_uart_tx.eq(platform.debug_uart.tx.o),
+        ]
 
         return m
 
 
+# Behavioral models
+# -----------------
+
+# Drives the CPU pins from the bus-cycle model. The model runs in its
+# own thread, and is handed the outcome of each bus cycle when the
+# bridge brings the CPU clock down, at which point it's let go on to
+# the next one.
+#
+# Between instructions, the state of the model is just that of the CPU,
+# which is when checkpoints are taken: on_boundary is called with it
+# (from the testbench) before the first cycle of the next instruction.
+# A model constructed with such a state skips the reset, and picks up
+# from that cycle.
+class CPUModel:
+    def __init__(self, iface, *, state=None):
+        self._iface = iface
+        self._cycles = queue.SimpleQueue()
+        self._results = queue.SimpleQueue()
+        self.cpu = W65C816(self)
+
+        self._resumed = state is not None
+        if self._resumed:
+            self.cpu.load_state(state)
+
+        self.on_boundary = None
+        self._step_state = None
+
+    # Bus callbacks, called from the model's thread.
+    def _cycle(self, addr, vpa, vda, vpb, rwb, value):
+        self._cycles.put((addr, vpa, vda, vpb, rwb, value, self._step_state))
+        self._step_state = None
+        return self._results.get()
+
+    def read(self, addr, vpa, vda, vpb):
+        return self._cycle(addr, vpa, vda, vpb, True, None)
+
+    def write(self, addr, vpa, vda, vpb, value):
+        self._cycle(addr, vpa, vda, vpb, False, value)
+
+    def noop(self, addr, vpb, rwb, value):
+        self._cycle(addr, False, False, vpb, rwb, value)
+
+    def _run(self):
+        if not self._resumed:
+            self.cpu.reset()
+        while True:
+            if self.on_boundary is not None:
+                self._step_state = self.cpu.state()
+            self.cpu.step()
+
+    async def testbench(self, ctx):
+        iface = self._iface
+
+        if not self._resumed:
+            await ctx.tick().until(iface.rst)
+            await ctx.negedge(iface.clk)
+        threading.Thread(target=self._run, daemon=True).start()
+
+        while True:
+            addr, vpa, vda, vpb, rwb, value, state = self._cycles.get()
+            if state is not None and self.on_boundary is not None:
+                self.on_boundary(ctx, state)
+                self.on_boundary = None
+
+            ctx.set(iface.addr_lo, addr & 0xFFFF)
+            ctx.set(iface.addr_hi, addr >> 16)
+            ctx.set(iface.rw, rwb)
+            ctx.set(iface.vda, vda)
+            ctx.set(iface.vpa, vpa)
+            ctx.set(iface.vpb, vpb)
+            if value is not None:
+                ctx.set(iface.w_data, value)
+
+            await ctx.negedge(iface.clk)
+
+            # The interrupt lines are looked at before the model goes on
+            # to the next instruction.
+            self.cpu.irq = not ctx.get(iface.irq)
+            self.cpu.nmi = not ctx.get(iface.nmi)
+            # The CPU latches read data as the clock goes down.
+            self._results.put(ctx.get(iface.r_data) if rwb else None)
+
+
+# Models the SDRAM chip, as seen from the controller, which expects
+# registers on the way to and from the pins (see SDRAMConnector). The
+# contents are kept in a dict keyed by bank, row and column.
+class SDRAMModel:
+    def __init__(self, ios):
+        self._ios = ios
+        self.mem = {}
+
+        self._cas_latency = 2
+        self._burst_len = 1
+        self._rows = [None] * 4
+
+        self._tick = 0
+        # Read data to put on the bus, by tick.
+        self._read_data = {}
+        # Columns left in the write burst in progress.
+        self._write_burst = None
+
+    # For checkpoints, with the ticks counted from the moment it's taken.
+    def state(self):
+        return {
+            "mem": self.mem,
+            "cas_latency": self._cas_latency,
+            "burst_len": self._burst_len,
+            "rows": list(self._rows),
+            "read_data": {tick - self._tick: data for tick, data in self._read_data.items()},
+            "write_burst": list(self._write_burst) if self._write_burst is not None else None,
+        }
+
+    def load_state(self, state):
+        self.mem = state["mem"]
+        self._cas_latency = state["cas_latency"]
+        self._burst_len = state["burst_len"]
+        self._rows = state["rows"]
+        self._tick = 0
+        self._read_data = state["read_data"]
+        self._write_burst = state["write_burst"]
+
+    @staticmethod
+    def _key(bank, row, col):
+        return (bank << 22) | (row << 9) | col
+
+    def _burst_keys(self, bank, col):
+        row = self._rows[bank]
+        bl = self._burst_len
+        base = col & ~(bl - 1)
+        return [self._key(bank, row, base | ((col + i) % bl)) for i in range(bl)]
+
+    async def process(self, ctx):
+        ios = self._ios
+
+        async for _, _, ras, cas, we, ba, a, dq_o, dqm in ctx.tick().sample(
+                ios.ras, ios.cas, ios.we, ios.ba, ios.a, ios.dq_o, ios.dqm):
+            self._tick += 1
+            tick = self._tick
+
+            # Beats of a write burst, until another command interrupts it.
+            if self._write_burst and not cas and not (ras and we):
+                keys = self._write_burst
+                self._write(keys.pop(0), dq_o, dqm)
+
+            match (ras, cas, we):
+                case (1, 1, 1): # MRS
+                    self._cas_latency = (a >> 4) & 0b111
+                    self._burst_len = 1 << (a & 0b111)
+                case (1, 0, 0): # ACTIVATE
+                    self._rows[ba] = a
+                case (1, 0, 1): # PRECHARGE
+                    self._write_burst = None
+                    if a & (1 << 10):
+                        self._rows = [None] * 4
+                    else:
+                        self._rows[ba] = None
+                case (0, 1, 0): # READ
+                    self._write_burst = None
+                    # One tick each for the registers to and from the pins.
+                    start = tick + self._cas_latency + 1
+                    for i, key in enumerate(self._burst_keys(ba, a & 0x1FF)):
+                        self._read_data[start + i] = self.mem.get(key, 0)
+                case (0, 1, 1): # WRITE
+                    keys = self._burst_keys(ba, a & 0x1FF)
+                    self._write(keys.pop(0), dq_o, dqm)
+                    self._write_burst = keys
+                    for t in [t for t in self._read_data if t > tick]:
+                        del self._read_data[t]
+
+            if tick in self._read_data:
+                ctx.set(ios.dq_i, self._read_data.pop(tick))
+
+    def _write(self, key, data, dqm):
+        old = self.mem.get(key, 0)
+        mask = (0x00FF if not dqm & 1 else 0) | (0xFF00 if not dqm & 2 else 0)
+        self.mem[key] = (old & ~mask) | (data & mask)
+
+
+# Receives what the SoC sends on a UART, and sends it bytes.
+class UARTModel:
+    def __init__(self, pins, divisor, on_byte):
+        self._pins = pins
+        self._divisor = divisor
+        self._on_byte = on_byte
+        self._tx_bytes = queue.SimpleQueue()
+
+    def send(self, data):
+        for byte in data:
+            self._tx_bytes.put(byte)
+
+    async def rx_testbench(self, ctx):
+        while True:
+            await ctx.negedge(self._pins.tx.o)
+            # Sample in the middle of each bit.
+            await ctx.tick().repeat(self._divisor + self._divisor // 2)
+            byte = 0
+            for i in range(8):
+                byte |= ctx.get(self._pins.tx.o) << i
+                await ctx.tick().repeat(self._divisor)
+            self._on_byte(byte)
+
+    async def tx_testbench(self, ctx):
+        while True:
+            try:
+                byte = self._tx_bytes.get_nowait()
+            except queue.Empty:
+                await ctx.tick().repeat(self._divisor)
+                continue
+
+            for bit in [0, *((byte >> i) & 1 for i in range(8)), 1]:
+                ctx.set(self._pins.rx.i, bit)
+                await ctx.tick().repeat(self._divisor)
+
+
+def _print_byte(byte):
+    sys.stdout.write(chr(byte))
+    sys.stdout.flush()
+
+
+# Checkpoints
+# -----------
+
+# Finds everything that holds state in the design: the signals driven
+# from clocked domains (including the registered memory read ports),
+# and the contents of the memories. There's no public way of going over
+# a design like this, hence the poking at Amaranth internals.
+def _design_state(fragment):
+    registers = {}
+    memories = []
+
+    def walk(fragment):
+        if isinstance(fragment, MemoryInstance):
+            memories.append(fragment._data)
+            for port in fragment._read_ports:
+                if port._domain != "comb":
+                    registers[id(port._data)] = port._data
+
+        for domain, statements in fragment.statements.items():
+            if domain == "comb":
+                continue
+            for stmt in statements:
+                for signal in stmt._lhs_signals():
+                    registers[id(signal)] = signal
+
+        for subfragment, _, _ in fragment.subfragments:
+            walk(subfragment)
+
+    walk(fragment)
+    return list(registers.values()), memories
+
+
+class SoCSimulation:
+    # fast_init skips the SDRAM power-up wait. checkpoint is the path of
+    # a checkpoint to resume from, saved by save_checkpoint with the
+    # same boot ROM and soc_clk.
+    def __init__(self, *, boot_rom_path, soc_clk=75e6, video=True,
+                 uart_baudrate=115200, debug_baudrate=2000000,
+                 fast_init=True, checkpoint=None):
+        self.platform = SimPlatform(soc_clk=soc_clk)
+        self.period = 1 / soc_clk
+
+        top = SimTop(boot_rom_path=boot_rom_path, fast_init=fast_init)
+        fragment = Fragment.get(top, self.platform)
+        self.sim = Simulator(fragment)
+
+        # The pins the models drive are part of the state too.
+        registers, self._memories = _design_state(fragment)
+        w65c816 = self.platform.w65c816
+        self._registers = registers + [
+            self.platform.sdram.dq_i,
+            w65c816.addr_lo, w65c816.addr_hi, w65c816.w_data,
+            w65c816.rw, w65c816.vda, w65c816.vpa, w65c816.vpb,
+            self.platform.uart.rx.i, self.platform.debug_uart.rx.i,
+        ]
+
+        self._checkpoint = None
+        if checkpoint is not None:
+            with open(checkpoint, "rb") as f:
+                self._checkpoint = pickle.load(f)
+
+        # Checkpoints are taken on an edge of every clock, so when
+        # resuming, the first edges are a whole period in.
+        def add_clock(period, domain):
+            phase = period if self._checkpoint is not None else None
+            self.sim.add_clock(period, phase=phase, domain=domain)
+
+        add_clock(self.period, "sync")
+        # Nothing looks at the video output, but the terminal only takes
+        # characters as fast as the pixel domain processes them.
+        if video:
+            add_clock(self.period, "pixel")
+            add_clock(self.period / 5, "tmds")
+
+        self.cpu = CPUModel(self.platform.w65c816,
+                            state=self._checkpoint["cpu"] if self._checkpoint is not None else None)
+        self.sdram = SDRAMModel(self.platform.sdram)
+        if self._checkpoint is not None:
+            self.sdram.load_state(self._checkpoint["sdram"])
+        self.uart = UARTModel(self.platform.uart, int(soc_clk // uart_baudrate), _print_byte)
+        self.debug_uart = UARTModel(self.platform.debug_uart, int(soc_clk // debug_baudrate),
+                                    lambda byte: None)
+
+        # The SDRAM model acts on what the controller registered in each
+        # cycle, the others watch and drive pins, like testbenches do.
+        self.cycles = 0
+        self.sim.add_process(self._count_cycles)
+        self.sim.add_process(self.sdram.process)
+        for testbench in [self._cpu_testbench,
+                          self.uart.rx_testbench, self.uart.tx_testbench,
+                          self.debug_uart.rx_testbench, self.debug_uart.tx_testbench]:
+            self.sim.add_testbench(testbench, background=True)
+
+    async def _count_cycles(self, ctx):
+        async for _ in ctx.tick():
+            self.cycles += 1
+
+    # Runs for the given number of SoC clock cycles.
+    def run(self, cycles):
+        until = self.cycles + cycles
+        while self.cycles < until:
+            self.sim.advance()
+
+    # The design is put back in the checkpointed state before the CPU
+    # model starts, at the very beginning.
+    async def _cpu_testbench(self, ctx):
+        if self._checkpoint is not None:
+            self._load_design_state(ctx, self._checkpoint)
+        await self.cpu.testbench(ctx)
+
+    def _save_design_state(self, ctx):
+        return {
+            "registers": [(signal.name, ctx.get(signal)) for signal in self._registers],
+            "memories": [[ctx.get(Value.cast(memory[i])) for i in range(memory.depth)]
+                         for memory in self._memories],
+        }
+
+    def _load_design_state(self, ctx, state):
+        registers, memories = state["registers"], state["memories"]
+        if ([name for name, _ in registers] != [signal.name for signal in self._registers] or
+                [len(rows) for rows in memories] != [memory.depth for memory in self._memories]):
+            raise ValueError("Checkpoint was saved from a different design")
+
+        for signal, (_, value) in zip(self._registers, registers):
+            ctx.set(signal, value)
+        for memory, rows in zip(self._memories, memories):
+            for i, value in enumerate(rows):
+                ctx.set(Value.cast(memory[i]), value)
+
+    # Runs until the CPU is about to start an instruction, and saves the
+    # state of the design and the models there. Whatever the UARTs are
+    # in the middle of sending or receiving is not saved.
+    def save_checkpoint(self, path):
+        checkpoint = None
+
+        def save(ctx, cpu_state):
+            nonlocal checkpoint
+            checkpoint = {
+                **self._save_design_state(ctx),
+                "cpu": cpu_state,
+                "sdram": self.sdram.state(),
+            }
+
+        self.cpu.on_boundary = save
+        while checkpoint is None:
+            self.sim.advance()
+
+        with open(path, "wb") as f:
+            pickle.dump(checkpoint, f)
+
+
 if __name__ == '__main__':
-    from amaranth.back import verilog
-
-    class SimPlatform:
-        target_clk_frequency = 115200 * 10
-
-    with open("sim_top.v", "w") as f:
-        top = TopLevel()
-        f.write(verilog.convert(top, platform=SimPlatform(), ports=[
-            top.tx,
-            top.sdram_clk,
-            top.sdram.ba,
-            top.sdram.a,
-            top.sdram.dq_i,
-            top.sdram.dq_o,
-            top.sdram.we,
-            top.sdram.ras,
-            top.sdram.cas,
-        ]))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--boot-rom", type=str, default="../build/boot0.bin")
+    parser.add_argument("--cycles", type=int, default=1000000)
+    parser.add_argument("--target-clk", type=int, default=75,
+                        help="SoC clock in MHz, which the timings of the peripherals are derived from")
+    parser.add_argument("--no-video", action="store_true",
+                        help="leave the video clocks stopped, faster but the terminal will stall")
+    parser.add_argument("--full-init", action="store_true",
+                        help="wait for as long as the board would for the SDRAM to power up")
+    parser.add_argument("--save-checkpoint", type=str, default=None,
+                        help="save a checkpoint at the end of the run")
+    parser.add_argument("--resume", type=str, default=None,
+                        help="resume from a checkpoint")
+    parser.add_argument("--vcd", type=str, default=None)
+    parser.add_argument("--verilog", type=str, default=None,
+                        help="write out the top for the Verilator build instead of simulating")
+
+    args = parser.parse_args()
+
+    if args.verilog:
+        from amaranth.back import verilog
+
+        top = VerilatorTop(boot_rom_path=args.boot_rom, fast_init=not args.full_init)
+        with open(args.verilog, "w") as f:
+            f.write(verilog.convert(top, platform=SimPlatform(soc_clk=args.target_clk * 1e6)))
+        sys.exit(0)
+
+    soc_sim = SoCSimulation(
+        boot_rom_path=args.boot_rom,
+        soc_clk=args.target_clk * 1e6,
+        video=not args.no_video,
+        fast_init=not args.full_init,
+        checkpoint=args.resume,
+    )
+
+    start_ts = time.monotonic()
+    if args.vcd:
+        with soc_sim.sim.write_vcd(args.vcd):
+            soc_sim.run(args.cycles)
+    else:
+        soc_sim.run(args.cycles)
+    end_ts = time.monotonic()
+
+    if args.save_checkpoint:
+        soc_sim.save_checkpoint(args.save_checkpoint)
+
+    duration = end_ts - start_ts
+    print()
+    print(f"Simulated {args.cycles} cycles ({soc_sim.cpu.cpu.cycles} CPU cycles) in {duration:.2f} seconds")
+    print(f"  {args.cycles / duration:.0f} cycles/second, {soc_sim.cpu.cpu.cycles / duration:.0f} CPU cycles/second")
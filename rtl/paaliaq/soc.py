@@ -15,7 +15,9 @@ from paaliaq.uart import UARTPeripheral
 from paaliaq.sdram import SDRAMController
 from paaliaq.mmu import MMU
 
-from paaliaq.wb_cut import WishboneCut
+from paaliaq.wb_cut import WishbonePipelinedCut
+from paaliaq.wb_width import WishboneWidthConverter
+from paaliaq.cache import WishboneCache
 
 from paaliaq.video import TextAnsiTerminal
 
@@ -25,6 +27,10 @@ from paaliaq.info import SystemInfo
 
 from paaliaq.gmii import GMIIMac
 
+from paaliaq.pmu import PerfMonitor
+
+from paaliaq.testseq import TestSequencer
+
 from amaranth_soc import csr
 from amaranth_soc.csr.wishbone import WishboneCSRBridge
 from amaranth_soc.csr.event import EventMonitor
@@ -105,31 +111,53 @@ def print_memory_map(memory_map, depth=0):
         print(f' - [{resource.start:#010x}, {resource.end:#010x}) - {path}')
 
 
+def print_perf_events(events):
+    print('Performance events:')
+    for i, name in enumerate(events):
+        print(f' - {i:3} - {name}')
+
+
 class SoC(Elaboratable):
-    def __init__(self, *, boot_rom_path):
+    # fast_init skips the waits that are only there for the sake of the
+    # hardware on the board, for simulation.
+    def __init__(self, *, boot_rom_path, sdram_cache=True, fast_init=False):
         super().__init__()
         self._boot_rom = generate_boot_ram_contents(boot_rom_path)
+        self._sdram_cache = sdram_cache
+        self._fast_init = fast_init
 
     def elaborate(self, platform):
         m = Module()
         evt_map = event.EventMap()
 
-        m.submodules.wb_arb = wb_arb = wishbone.Arbiter(addr_width=24, data_width=8)
+        # The system bus is pipelined end-to-end, managers may have
+        # multiple requests in flight, and see errors and retries.
+        wb_features = {"err", "rty", "stall"}
 
-        m.submodules.cpu_bridge = cpu_bridge = W65C816WishboneBridge()
+        m.submodules.wb_arb = wb_arb = wishbone.Arbiter(addr_width=24, data_width=8, features=wb_features)
+
+        # Only the CSRs and the terminal windows (which latch and commit
+        # whole cells like CSRs do) have side effects on access. The test
+        # sequencer's scratch memory between them doesn't, but it's only
+        # accessed by the host.
+        m.submodules.cpu_bridge = cpu_bridge = W65C816WishboneBridge(io_range=range(0x010000, 0x040000))
         wb_arb.add(cpu_bridge.wb_bus)
 
         m.submodules.uart_debug = uart_debug = UARTDebugBridge()
         wb_arb.add(uart_debug.wb_bus)
 
-        m.submodules.wb_dec = wb_dec = wishbone.Decoder(addr_width=24, data_width=8)
+        m.submodules.wb_dec = wb_dec = wishbone.Decoder(addr_width=24, data_width=8, features=wb_features)
 
         m.submodules.iram = iram = WishboneSRAM(size=0x10000, data_width=8, init=self._boot_rom)
-        m.submodules.iram_cut = iram_cut = WishboneCut(iram.wb_bus)
+        m.submodules.iram_cut = iram_cut = WishbonePipelinedCut(iram.wb_bus)
         wb_dec.add(iram_cut.wb_bus, addr=0x000000, name='iram')
 
-        m.submodules.sdram_ctrl = sdram_ctrl = SDRAMController()
-        m.submodules.sdram_cut = sdram_cut = WishboneCut(sdram_ctrl.wb_bus)
+        m.submodules.sdram_ctrl = sdram_ctrl = SDRAMController(init_ns=1000 if self._fast_init else 200000)
+        if self._sdram_cache:
+            m.submodules.sdram_cache = sdram_front = WishboneCache(sdram_ctrl.wb_bus)
+        else:
+            m.submodules.sdram_conv = sdram_front = WishboneWidthConverter(sdram_ctrl.wb_bus)
+        m.submodules.sdram_cut = sdram_cut = WishbonePipelinedCut(sdram_front.wb_bus)
         wb_dec.add(sdram_cut.wb_bus, addr=0x800000, name='sdram')
 
         m.submodules.csr_dec = csr_dec = csr.Decoder(addr_width=12, data_width=8, alignment=8)
@@ -151,8 +179,18 @@ class SoC(Elaboratable):
 
         csr_dec.add(cpu_bridge.csr_bus, name='dbg')
 
+        m.submodules.test_seq = test_seq = TestSequencer()
+        m.submodules.test_seq_cut = test_seq_cut = WishbonePipelinedCut(test_seq.wb_bus)
+        wb_dec.add(test_seq_cut.wb_bus, addr=0x020000, name='testseq')
+        wiring.connect(m, cpu_bridge.test_seq, test_seq.svc)
+
         m.submodules.terminal = terminal = TextAnsiTerminal()
         csr_dec.add(terminal.csr_bus, name="terminal")
+        m.submodules.terminal_cut = terminal_cut = WishbonePipelinedCut(terminal.wb_bus)
+        wb_dec.add(terminal_cut.wb_bus, addr=0x030000, name="terminal")
+        m.submodules.terminal_text_cut = terminal_text_cut = WishbonePipelinedCut(terminal.text_bus)
+        wb_dec.add(terminal_text_cut.wb_bus, addr=0x038000, name="terminal_text")
+        wb_arb.add(terminal.dma_bus)
 
         m.submodules.spi = spi = SPIController()
         csr_dec.add(spi.csr_bus, name="spi")
@@ -163,9 +201,41 @@ class SoC(Elaboratable):
         m.submodules.gmii = gmii = GMIIMac()
         csr_dec.add(gmii.csr_bus, name="gmii")
 
+        if self._sdram_cache:
+            csr_dec.add(sdram_front.csr_bus, name="cache")
+
+        perf_events = {"clk": C(1)}
+
+        def add_perf_events(prefix, port):
+            for name in port.signature.members:
+                perf_events[f"{prefix}.{name}"] = getattr(port, name)
+
+        add_perf_events("cpu", cpu_bridge.perf)
+        add_perf_events("mmu", mmu.perf)
+        add_perf_events("sdram", sdram_ctrl.perf)
+        add_perf_events("uart", uart.perf)
+        add_perf_events("spi", spi.perf)
+
+        # The arbiter grants the bus to one manager at a time, any other
+        # manager with CYC raised is waiting for it.
+        wb_managers = [cpu_bridge.wb_bus, uart_debug.wb_bus, mmu.wb_bus, terminal.dma_bus]
+        bus_contention = Signal()
+        m.d.comb += bus_contention.eq(sum(bus.cyc for bus in wb_managers) > 1)
+        perf_events["bus.contention"] = bus_contention
+
+        m.submodules.pmu = pmu = PerfMonitor(list(perf_events))
+        m.d.comb += pmu.events.eq(Cat(perf_events.values()))
+        # Pinned, since the cache CSRs before them are optional, and the
+        # host tools (scripts/debug.py) hardcode their addresses.
+        csr_dec.add(pmu.csr_bus, name="pmu", addr=0xa00)
+
+        csr_dec.add(test_seq.csr_bus, name="testseq", addr=0xb00)
+
+        print_perf_events(perf_events)
+
         # This freezes the CSR memory map.
         m.submodules.csr_wb = csr_wb = WishboneCSRBridge(csr_dec.bus)
-        m.submodules.csr_cut = csr_cut = WishboneCut(csr_wb.wb_bus)
+        m.submodules.csr_cut = csr_cut = WishbonePipelinedCut(csr_wb.wb_bus)
 
         wb_dec.add(csr_cut.wb_bus, addr=0x010000, name='csr')
 
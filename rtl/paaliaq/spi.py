@@ -4,6 +4,8 @@ from amaranth.lib.fifo import SyncFIFOBuffered
 from amaranth.lib.wiring import In, Out
 from amaranth_soc import csr
 
+from paaliaq.pmu import PerfEventSignature
+
 
 class SPISignature(wiring.Signature):
     def __init__(self):
@@ -106,6 +108,7 @@ class Segment(data.Struct):
 
 class SPIController(wiring.Component):
     csr_bus: In(csr.Signature(addr_width=4, data_width=8))
+    perf: Out(PerfEventSignature(["tx_full", "tx_empty", "rx_full", "rx_empty"]))
 
 
     class ConfigRegister(csr.Register, access="rw"):
@@ -158,6 +161,13 @@ class SPIController(wiring.Component):
         )
 
         cur_segment, next_segment = Signal(Segment), Signal(Segment)
+        m.d.comb += [
+            self.perf.tx_full.eq(~tx_fifo.w_rdy),
+            self.perf.tx_empty.eq(~tx_fifo.r_rdy),
+            self.perf.rx_full.eq(~rx_fifo.w_rdy),
+            self.perf.rx_empty.eq(~rx_fifo.r_rdy),
+        ]
+
         m.d.comb += next_segment.eq(segment_fifo.r_data)
 
         m.d.comb += [
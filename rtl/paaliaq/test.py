@@ -1,7 +1,12 @@
 # Test utilities
 
 import inspect
+import weakref
 
+from collections import deque
+
+from amaranth import *
+from amaranth.lib import wiring
 from amaranth.sim import Simulator
 
 
@@ -23,6 +28,52 @@ async def stream_put(ctx, stream, payload):
     ctx.set(stream.valid, 0)
 
 
+# Registers wider than the bus are accessed one chunk at a time, least
+# significant first, as the CSR multiplexer expects.
+async def csr_write(ctx, bus, addr, value, width=1):
+    for i in range(width):
+        ctx.set(bus.addr, addr + i)
+        ctx.set(bus.w_data, (value >> (i * 8)) & 0xff)
+        ctx.set(bus.w_stb, 1)
+        await ctx.tick()
+    ctx.set(bus.w_stb, 0)
+
+
+async def csr_read(ctx, bus, addr, width=1):
+    value = 0
+    for i in range(width):
+        ctx.set(bus.addr, addr + i)
+        ctx.set(bus.r_stb, 1)
+        await ctx.tick()
+        ctx.set(bus.r_stb, 0)
+        value |= ctx.get(bus.r_data) << (i * 8)
+    return value
+
+
+async def wb_write(ctx, bus, addr, data):
+    ctx.set(bus.adr, addr)
+    ctx.set(bus.dat_w, data)
+    ctx.set(bus.sel, (1 << len(bus.sel)) - 1)
+    ctx.set(bus.we, 1)
+    ctx.set(bus.cyc, 1)
+    ctx.set(bus.stb, 1)
+    await ctx.tick().until(bus.ack)
+    ctx.set(bus.cyc, 0)
+    ctx.set(bus.stb, 0)
+    ctx.set(bus.we, 0)
+
+
+async def wb_read(ctx, bus, addr):
+    ctx.set(bus.adr, addr)
+    ctx.set(bus.sel, (1 << len(bus.sel)) - 1)
+    ctx.set(bus.cyc, 1)
+    ctx.set(bus.stb, 1)
+    data, = await ctx.tick().sample(bus.dat_r).until(bus.ack)
+    ctx.set(bus.cyc, 0)
+    ctx.set(bus.stb, 0)
+    return data
+
+
 def timeout_process(ticks):
     async def inner(ctx):
         await ctx.tick().repeat(ticks)
@@ -31,11 +82,88 @@ def timeout_process(ticks):
     return inner
 
 
-def prepare_sim(dut, timeout=100, period=1e-6):
+# Keeps the last depth cycles of the given signals (a dict of names to
+# values, or a list of name and value pairs) while the simulation runs,
+# to be written out if it fails. Repeated names get a number appended.
+# With a trigger, capturing stops depth // 2 cycles after the trigger is
+# first seen asserted, so the window is centered on it.
+class WaveformCapture:
+    def __init__(self, signals, *, depth=1024, trigger=None, period=1e-6):
+        if isinstance(signals, dict):
+            signals = signals.items()
+
+        self._names, self._values = [], []
+        for name, value in signals:
+            unique_name, suffix = name, 0
+            while unique_name in self._names:
+                suffix += 1
+                unique_name = f"{name}_{suffix}"
+            self._names.append(unique_name)
+            self._values.append(Value.cast(value))
+
+        self._trigger = trigger
+        self._depth = depth
+        self._period = period
+
+        self._samples = deque(maxlen=depth)
+        self.triggered_at = None
+
+    async def process(self, ctx):
+        values = self._values
+        if self._trigger is not None:
+            values = [*values, self._trigger]
+
+        tick = 0
+        async for _, _, *sampled in ctx.tick().sample(*values):
+            if self._trigger is not None:
+                *sampled, trigger = sampled
+                if trigger and self.triggered_at is None:
+                    self.triggered_at = tick
+
+            self._samples.append((tick, sampled))
+            tick += 1
+
+            if self.triggered_at is not None and tick - self.triggered_at > self._depth // 2:
+                return
+
+    def write_vcd(self, path):
+        from vcd import VCDWriter
+
+        with open(path, "w") as f, VCDWriter(f, timescale="1 ns") as writer:
+            variables = [writer.register_var("top", name, "wire", size=len(value))
+                         for name, value in zip(self._names, self._values)]
+
+            for tick, sampled in self._samples:
+                timestamp = round(tick * self._period * 1e9)
+                for variable, value, data in zip(variables, self._values, sampled):
+                    writer.change(variable, timestamp, data & ((1 << len(value)) - 1))
+
+
+_captures = weakref.WeakKeyDictionary()
+
+
+# The signals to capture for run_sim are given by trace, either as a
+# list of values or a dict of names to values, and default to the
+# ports of the DUT. Listed values that aren't signals are named v0, v1
+# and so on, by their position. With trace={}, nothing is captured, and
+# a failing simulation gets rerun with a VCD writer instead.
+def prepare_sim(dut, timeout=100, period=1e-6, *, trace=None, trace_depth=1024, trigger=None):
     sim = Simulator(dut)
-    sim.add_clock(1e-6)
+    sim.add_clock(period)
     sim.add_process(timeout_process(timeout))
 
+    if trace is None and isinstance(dut, wiring.Component):
+        trace = {"__".join(map(str, path)): value
+                 for path, _, value in dut.signature.flatten(dut)}
+    elif trace is not None and not isinstance(trace, dict):
+        trace = [(getattr(Value.cast(value), "name", None) or f"v{i}", value)
+                 for i, value in enumerate(trace)]
+
+    if trace:
+        capture = WaveformCapture(trace, depth=trace_depth, trigger=trigger, period=period)
+        sim.add_process(capture.process)
+        _captures[sim] = capture
+
     return sim
 
 
@@ -46,6 +174,10 @@ def run_sim(sim, test_name=None):
     try:
         sim.run()
     except:
+        if sim in _captures:
+            _captures[sim].write_vcd(f"fail-{test_name}.vcd")
+            raise
+
         sim.reset()
         with sim.write_vcd(f"fail-{test_name}.vcd"):
             sim.run()
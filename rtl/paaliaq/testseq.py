@@ -0,0 +1,381 @@
+from amaranth import *
+from amaranth.lib import wiring, data, enum
+from amaranth.lib.wiring import In, Out
+from amaranth.lib.memory import Memory
+
+from amaranth_soc import wishbone, csr
+from amaranth_soc.memory import MemoryMap
+
+
+# Debug cycles serviced by the test sequencer instead of the debugger.
+# From the point of view of the CPU bridge: STB is raised once per
+# debug cycle, once its address, bus flags and write data are known,
+# and the bridge holds the CPU clock until ACK.
+class TestSeqSignature(wiring.Signature):
+    def __init__(self):
+        super().__init__({
+            'active': In(1),
+            'stb': Out(1),
+            'addr': Out(24),
+            'vpa': Out(1),
+            'vda': Out(1),
+            'vpb': Out(1),
+            'rwb': Out(1),
+            'w_data': Out(8),
+            'ack': In(1),
+            'r_data': In(8),
+        })
+
+
+class TestMemEntry(data.Struct):
+    addr: 24
+    data: 8
+
+
+class TestLogEntry(data.Struct):
+    addr: 24
+    data: 8
+    vpa:  1
+    vda:  1
+    vpb:  1
+    rwb:  1
+    _unused: 28
+
+
+class TestPhase(enum.Enum, shape=2):
+    IDLE = 0
+    INIT = 1
+    TEST = 2
+    FINI = 3
+
+
+# Hardware sequencer for single-step CPU tests.
+# Services the bridge's debug cycles at full speed, the same way the
+# drivers in scripts/run-test.py do from the host: a test consists of
+# an init phase (code setting up the initial CPU state), the test
+# itself (reads and writes go to a sparse memory image), and a fini
+# phase (code dumping the final CPU state). Every cycle of the three
+# phases is recorded into a log, which is read back in bulk once the
+# test is done, and replayed through the drivers on the host.
+#
+# Outside of a test, opcode fetches return JMP (0x5C) and everything
+# else returns 0, so the CPU spins in a JMP $000000 loop. A test
+# starts at the first opcode fetch after it's started.
+#
+# Scratch memory layout (on the Wishbone bus):
+#   0x0000      Init code (up to 512 bytes)
+#   0x0200      Fini code (up to 512 bytes)
+#   0x0400      Memory image, 4 bytes per entry (TestMemEntry)
+#   0x1000      Log, 8 bytes per entry (TestLogEntry)
+#
+# The memory image is searched linearly, youngest entry first, and
+# writes done by the test are appended to it. If the image or the log
+# fill up, the test keeps going, but Overflow is set.
+#
+# The code and the memory image share their ports with the sequencer,
+# and are only accessible while it's not busy.
+class TestSequencer(wiring.Component):
+    csr_bus: In(csr.Signature(addr_width=4, data_width=8))
+    wb_bus: In(wishbone.Signature(addr_width=13, data_width=8))
+    svc: In(TestSeqSignature())
+
+
+    class ControlRegister(csr.Register, access="rw"):
+        enable:   csr.Field(csr.action.RW, 1)
+        start:    csr.Field(csr.action.W, 1)
+        busy:     csr.Field(csr.action.R, 1)
+        done:     csr.Field(csr.action.R, 1)
+        overflow: csr.Field(csr.action.R, 1)
+        _unused:  csr.Field(csr.action.ResR0WA, 3)
+
+    class LengthRegister(csr.Register, access="rw"):
+        len: csr.Field(csr.action.RW, 16)
+
+    class MemCountRegister(csr.Register, access="rw"):
+        count: csr.Field(csr.action.RW, 8)
+
+    class LogCountRegister(csr.Register, access="r"):
+        count: csr.Field(csr.action.R, 16)
+
+
+    CODE_DEPTH = 512
+    MEM_DEPTH = 128
+    LOG_DEPTH = 512
+
+    def __init__(self):
+        super().__init__()
+
+        regs = csr.Builder(addr_width=4, data_width=8)
+
+        self._control = regs.add("Control", self.ControlRegister())
+        self._init_len = regs.add("InitLen", self.LengthRegister(), offset=0x2)
+        self._fini_len = regs.add("FiniLen", self.LengthRegister(), offset=0x4)
+        self._mem_count = regs.add("MemCount", self.MemCountRegister(), offset=0x6)
+        self._cycles = regs.add("Cycles", self.LengthRegister(), offset=0x8)
+        self._log_count = regs.add("LogCount", self.LogCountRegister(), offset=0xa)
+
+        mmap = regs.as_memory_map()
+        self._bridge = csr.Bridge(mmap)
+        self.csr_bus.memory_map = mmap
+
+        self.wb_bus.memory_map = MemoryMap(addr_width=13, data_width=8)
+        self.wb_bus.memory_map.add_resource(self, name=('scratch',), size=(1<<13))
+        self.wb_bus.memory_map.freeze()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.bridge = self._bridge
+        wiring.connect(m, wiring.flipped(self.csr_bus), self._bridge.bus)
+
+        m.submodules.code_mem = code_mem = Memory(shape=8, depth=2 * self.CODE_DEPTH, init=[])
+        # Plain words, so that the host can write single bytes.
+        m.submodules.image_mem = image_mem = Memory(shape=TestMemEntry.as_shape().size, depth=self.MEM_DEPTH, init=[])
+        m.submodules.log_mem = log_mem = Memory(shape=TestLogEntry, depth=self.LOG_DEPTH, init=[])
+
+        # Scratch memory
+        # ---
+        # Written by the host before the test, and read back after it.
+        # Writes to the log are ignored.
+        wb = self.wb_bus
+
+        code_w = code_mem.write_port()
+        code_r = code_mem.read_port()
+        image_w = image_mem.write_port(granularity=8)
+        image_r = image_mem.read_port()
+        log_wb_r = log_mem.read_port()
+
+        phase = Signal(TestPhase)
+        seq_owns_mem = phase != TestPhase.IDLE
+
+        wb_req = wb.cyc & wb.stb & ~wb.ack
+        in_code = wb.adr[10:] == 0
+        in_image = wb.adr[9:] == 0b0010
+        in_log = wb.adr[12]
+
+        with m.If(~seq_owns_mem):
+            m.d.comb += [
+                code_w.addr.eq(wb.adr[:10]),
+                code_w.data.eq(wb.dat_w),
+                code_w.en.eq(wb_req & wb.we & in_code),
+                code_r.addr.eq(wb.adr[:10]),
+
+                image_w.addr.eq(wb.adr[2:9]),
+                image_w.data.eq(wb.dat_w.replicate(4)),
+                image_w.en.eq(Mux(wb_req & wb.we & in_image, 1 << wb.adr[:2], 0)),
+                image_r.addr.eq(wb.adr[2:9]),
+            ]
+
+        m.d.comb += log_wb_r.addr.eq(wb.adr[3:12])
+
+        wb_lane = Signal(3)
+        wb_in_image = Signal()
+        wb_in_log = Signal()
+
+        m.d.sync += wb.ack.eq(wb_req)
+        with m.If(wb_req):
+            m.d.sync += [
+                wb_lane.eq(wb.adr[:3]),
+                wb_in_image.eq(in_image),
+                wb_in_log.eq(in_log),
+            ]
+
+        with m.If(wb_in_log):
+            m.d.comb += wb.dat_r.eq(log_wb_r.data.as_value().word_select(wb_lane, 8))
+        with m.Elif(wb_in_image):
+            m.d.comb += wb.dat_r.eq(image_r.data.word_select(wb_lane[:2], 8))
+        with m.Else():
+            m.d.comb += wb.dat_r.eq(code_r.data)
+
+        # Sequencer
+        # ---
+        svc = self.svc
+        ctl = self._control.f
+
+        image_r_entry = TestMemEntry(image_r.data)
+        image_w_entry = TestMemEntry(image_w.data)
+        log_w = log_mem.write_port()
+
+        start_pending = Signal()
+        done = Signal()
+        overflow = Signal()
+
+        # Position in the init or fini code.
+        code_pos = Signal(range(self.CODE_DEPTH + 1))
+        ifetch_done = Signal()
+        cycle_ctr = Signal(16)
+        image_count = Signal(range(self.MEM_DEPTH + 1))
+        search_idx = Signal(range(self.MEM_DEPTH))
+        log_count = Signal(range(self.LOG_DEPTH + 1))
+
+        # Data returned for the current cycle, and whether it is the
+        # last cycle of the current phase.
+        resp_data = Signal(8)
+        resp_last = Signal()
+
+        m.d.comb += [
+            svc.active.eq(ctl.enable.data),
+            svc.r_data.eq(resp_data),
+
+            ctl.busy.r_data.eq(start_pending | (phase != TestPhase.IDLE)),
+            ctl.done.r_data.eq(done),
+            ctl.overflow.r_data.eq(overflow),
+            self._log_count.f.count.r_data.eq(log_count),
+        ]
+
+        with m.If(seq_owns_mem):
+            m.d.comb += [
+                code_r.addr.eq(Cat(code_pos[:-1], phase == TestPhase.FINI)),
+                image_r.addr.eq(search_idx),
+            ]
+
+        with m.If(ctl.start.w_stb & ctl.start.w_data):
+            m.d.sync += [
+                start_pending.eq(1),
+                done.eq(0),
+            ]
+
+        ifetch = svc.vpa & svc.vda
+        mem_access = svc.vpa | svc.vda
+
+        log_entry = Signal(TestLogEntry)
+        m.d.comb += [
+            log_entry.addr.eq(svc.addr),
+            log_entry.data.eq(Mux(svc.rwb, resp_data, svc.w_data)),
+            log_entry.vpa.eq(svc.vpa),
+            log_entry.vda.eq(svc.vda),
+            log_entry.vpb.eq(svc.vpb),
+            log_entry.rwb.eq(svc.rwb),
+
+            log_w.addr.eq(log_count),
+            log_w.data.eq(log_entry),
+        ]
+
+        with m.If(seq_owns_mem):
+            m.d.comb += [
+                image_w.addr.eq(image_count),
+                image_w_entry.addr.eq(svc.addr),
+                image_w_entry.data.eq(svc.w_data),
+            ]
+
+        with m.FSM():
+            with m.State('wait'):
+                with m.If(svc.stb):
+                    with m.Switch(phase):
+                        with m.Case(TestPhase.IDLE):
+                            with m.If(start_pending & ifetch):
+                                # Handle this cycle as the first one of
+                                # the init phase, once the code read port
+                                # has caught up with code_pos.
+                                m.d.sync += [
+                                    start_pending.eq(0),
+                                    phase.eq(TestPhase.INIT),
+                                    code_pos.eq(0),
+                                    ifetch_done.eq(0),
+                                    image_count.eq(self._mem_count.f.count.data),
+                                    log_count.eq(0),
+                                    overflow.eq(0),
+                                ]
+                                m.next = 'settle'
+                            with m.Else():
+                                m.d.sync += resp_data.eq(Mux(ifetch, 0x5C, 0x00))
+                                m.next = 'ack'
+
+                        with m.Case(TestPhase.INIT, TestPhase.FINI):
+                            code_len = Mux(phase == TestPhase.FINI,
+                                           self._fini_len.f.len.data, self._init_len.f.len.data)
+                            m.d.sync += resp_last.eq(code_pos == code_len - 1)
+
+                            # Until the first opcode fetch, reads return
+                            # 0xFF and don't consume any code.
+                            with m.If(ifetch):
+                                m.d.sync += ifetch_done.eq(1)
+                            with m.If(svc.rwb & mem_access):
+                                with m.If(ifetch | ifetch_done):
+                                    m.d.sync += [
+                                        resp_data.eq(code_r.data),
+                                        code_pos.eq(code_pos + 1),
+                                    ]
+                                with m.Else():
+                                    m.d.sync += resp_data.eq(0xFF)
+                            m.next = 'respond'
+
+                        with m.Case(TestPhase.TEST):
+                            # Once the given number of cycles has run,
+                            # the next opcode fetch gets a NOP, and
+                            # ends the test.
+                            terminating = (cycle_ctr >= self._cycles.f.len.data) & ifetch
+                            m.d.sync += [
+                                resp_last.eq(terminating),
+                                cycle_ctr.eq(cycle_ctr + 1),
+                                resp_data.eq(0),
+                            ]
+                            m.next = 'respond'
+
+                            with m.If(svc.rwb & mem_access):
+                                with m.If(terminating):
+                                    m.d.sync += resp_data.eq(0xEA)
+                                with m.Elif(image_count != 0):
+                                    m.d.sync += search_idx.eq(image_count - 1)
+                                    m.next = 'search'
+                            with m.Elif(mem_access):
+                                with m.If(image_count == self.MEM_DEPTH):
+                                    m.d.sync += overflow.eq(1)
+                                with m.Else():
+                                    m.d.comb += image_w.en.eq(0b1111)
+                                    m.d.sync += image_count.eq(image_count + 1)
+
+            with m.State('search'):
+                # image_r.addr was just set to search_idx.
+                m.next = 'search-compare'
+            with m.State('search-compare'):
+                with m.If(image_r_entry.addr == svc.addr):
+                    m.d.sync += resp_data.eq(image_r_entry.data)
+                    m.next = 'respond'
+                with m.Elif(search_idx == 0):
+                    m.next = 'respond'
+                with m.Else():
+                    m.d.sync += search_idx.eq(search_idx - 1)
+                    m.next = 'search'
+
+            with m.State('respond'):
+                m.d.comb += svc.ack.eq(1)
+
+                with m.If(log_count == self.LOG_DEPTH):
+                    m.d.sync += overflow.eq(1)
+                with m.Else():
+                    m.d.comb += log_w.en.eq(1)
+                    m.d.sync += log_count.eq(log_count + 1)
+
+                with m.If(resp_last):
+                    with m.Switch(phase):
+                        with m.Case(TestPhase.INIT):
+                            m.d.sync += [
+                                phase.eq(TestPhase.TEST),
+                                cycle_ctr.eq(0),
+                            ]
+                        with m.Case(TestPhase.TEST):
+                            m.d.sync += [
+                                phase.eq(TestPhase.FINI),
+                                code_pos.eq(0),
+                                ifetch_done.eq(0),
+                            ]
+                        with m.Case(TestPhase.FINI):
+                            m.d.sync += [
+                                phase.eq(TestPhase.IDLE),
+                                done.eq(1),
+                            ]
+                    # The code read port still has the data for the
+                    # previous phase.
+                    m.next = 'settle'
+                with m.Else():
+                    m.next = 'wait'
+
+            with m.State('settle'):
+                m.next = 'wait'
+
+            with m.State('ack'):
+                m.d.comb += svc.ack.eq(1)
+                m.next = 'wait'
+
+        return m
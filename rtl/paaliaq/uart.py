@@ -7,11 +7,14 @@ from amaranth_soc import csr
 
 from amaranth_stdio import serial
 
+from paaliaq.pmu import PerfEventSignature
+
 
 # TODO: Take pins from UARTResource? That way the FFSychronizer stuff
 # is done for us by serial.AsyncSerial.
 class UARTPeripheral(wiring.Component):
     bus: In(csr.Signature(addr_width=3, data_width=8))
+    perf: Out(PerfEventSignature(["tx_full", "tx_empty", "rx_full", "rx_empty"]))
 
     class ConfigRegister(csr.Register, access="rw"):
         _unused: csr.Field(csr.action.ResR0WA, 8)
@@ -96,4 +99,11 @@ class UARTPeripheral(wiring.Component):
             rx_fifo.r_en.eq(self._rx_data.f.data.r_stb)
         ]
 
+        m.d.comb += [
+            self.perf.tx_full.eq(~tx_fifo.w_rdy),
+            self.perf.tx_empty.eq(~tx_fifo.r_rdy),
+            self.perf.rx_full.eq(~rx_fifo.w_rdy),
+            self.perf.rx_empty.eq(~rx_fifo.r_rdy),
+        ]
+
         return m
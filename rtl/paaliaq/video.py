@@ -1,6 +1,6 @@
 from amaranth import *
 from amaranth.lib import wiring, io, memory, data, enum, stream
-from amaranth.lib.fifo import AsyncFIFOBuffered
+from amaranth.lib.fifo import AsyncFIFO, AsyncFIFOBuffered, SyncFIFOBuffered
 from amaranth.lib.wiring import In, Out
 from amaranth_soc import csr, wishbone
 from amaranth_soc.memory import MemoryMap
@@ -57,29 +57,22 @@ class Opcode(enum.Enum, shape=4):
     # Put a character at the current cursor position and advance.
     # Also handles characters such as \t, \b, \n, \r etc.
     PUT_CHAR    = 0
-    # Set the foreground color for the next characters.
-    SET_FG      = 1
-    # Set the background color for the next characters.
-    SET_BG      = 2
-    # Set the attribute flags for the next characters.
-    SET_ATTR    = 3
-    # Clear the attribute flags for the next characters.
-    CLEAR_ATTR  = 4
+    # Combined effect of a whole SGR sequence: optionally reset attributes and colors,
+    # then set the colors and set/clear the attribute flags.
+    SET_STYLE   = 1
     # Scroll the display in the specified direction by the specified amount of lines.
-    SCROLL      = 5
+    SCROLL      = 2
     # Move the cursor to the specified absolute position.
-    MOVE_CURSOR_ABS = 6
+    MOVE_CURSOR_ABS = 3
     # Move the cursor by the specified relative amounts.
     # May optionally reset the other coordinate.
-    MOVE_CURSOR_REL = 7
+    MOVE_CURSOR_REL = 4
     # Erase a part of the line before and/or after the cursor.
-    ERASE_LINE = 8
+    ERASE_LINE = 5
     # Erase a part of the display before and/or after the cursor.
-    ERASE_DISPLAY = 9
+    ERASE_DISPLAY = 6
     # Clears the display and resets the cursor position, current color and attributes.
-    RESET = 10
-    # Reset attributes and colors to defaults, keep cursor position and display contents.
-    RESET_ATTRS = 11
+    RESET = 7
 
 
 class Attributes(enum.Flag, shape=8):
@@ -102,8 +95,6 @@ class Attributes(enum.Flag, shape=8):
 class Command(data.Struct):
     class Params(data.Union):
         char: unsigned(8)
-        attr: Attributes
-        color: unsigned(8)
         abs_pos: data.StructLayout({
             "x": unsigned(7),
             "y": unsigned(6),
@@ -119,6 +110,15 @@ class Command(data.Struct):
             "before": unsigned(1),
             "after": unsigned(1),
         })
+        style: data.StructLayout({
+            "reset": unsigned(1),
+            "set_fg": unsigned(1),
+            "set_bg": unsigned(1),
+            "fg": unsigned(8),
+            "bg": unsigned(8),
+            "set_attr": Attributes,
+            "clear_attr": Attributes,
+        })
 
     opcode: Opcode
     params: Params
@@ -131,16 +131,24 @@ class CharacterCell(data.Struct):
     attr: Attributes
 
 
+# Text memory rows hold multiple cells, so that erasing can clear a whole row
+# per cycle. Cells in a row are written individually using the write enables.
+TextWord = data.ArrayLayout(CharacterCell, 4)
+
+
 def saturate(v, maxv):
     return Mux(v < 0, 0, Mux(v > maxv, maxv, v))
 
 
+# The framebuffer is a ring of lines, with start_line being the physical line
+# shown at the top of the display. Scrolling moves start_line and clears the
+# lines that come into view, instead of moving the contents around.
 class TextCommandProcessor(wiring.Component):
     commands: In(stream.Signature(Command))
-    fb_read: In(memory.ReadPort.Signature(addr_width=13, shape=CharacterCell))
-    fb_write: In(memory.WritePort.Signature(addr_width=13, shape=CharacterCell))
+    fb_write: In(memory.WritePort.Signature(addr_width=11, shape=TextWord, granularity=1))
     cursor_x: Out(7)
     cursor_y: Out(6)
+    start_line: Out(range(48))
 
     def elaborate(self, platform):
         m = Module()
@@ -156,20 +164,38 @@ class TextCommandProcessor(wiring.Component):
 
         cur_fg, cur_bg, cur_attr = Signal(8, init=DEFAULT_FG), Signal(8, init=DEFAULT_BG), Signal(Attributes)
 
+        start_line = Signal(range(48))
+        m.d.comb += self.start_line.eq(start_line)
+
+        # Addresses below are cell addresses relative to the top of the display,
+        # and wrap around the end of the framebuffer. Lines start on a row
+        # boundary, so the offset doesn't move cells within a row.
         mem_addr = Signal(13)
+        mem_cells = Signal(TextWord.length)
+        mem_char = Signal(8)
+        phys_addr = mem_addr + start_line * 128
+        phys_addr_wrapped = Mux(phys_addr >= 128 * 48, phys_addr - 128 * 48, phys_addr)
 
-        m.d.comb += self.fb_read.addr.eq(mem_addr)
-        m.d.comb += self.fb_write.addr.eq(mem_addr)
+        m.d.comb += self.fb_write.addr.eq(phys_addr_wrapped >> 2)
+        m.d.comb += self.fb_write.en.eq(mem_cells)
 
-        m.d.comb += self.fb_write.data.fg.eq(cur_fg)
-        m.d.comb += self.fb_write.data.bg.eq(cur_bg)
-        m.d.comb += self.fb_write.data.attr.eq(cur_attr)
+        for cell in self.fb_write.data:
+            m.d.comb += cell.char.eq(mem_char)
+            m.d.comb += cell.fg.eq(cur_fg)
+            m.d.comb += cell.bg.eq(cur_bg)
+            m.d.comb += cell.attr.eq(cur_attr)
 
+        cur_command = Signal(Command)
+
+        # Erasing clears the cells of a row between erase_cur and erase_goal
+        # (inclusive) every cycle.
         erase_cur, erase_goal = Signal(13), Signal(13)
-        scroll_src, scroll_dst, scroll_fwd, scroll_ctr = Signal(signed(15)), Signal(signed(15)), Signal(), Signal(13)
-        scroll_blank = Signal()
+        erase_row = Cat(C(0, 2), erase_cur[2:])
+
+        scroll_delta = cur_command.params.rel_pos.delta
+        scroll_up = Mux(scroll_delta > 48, 48, scroll_delta)
+        scroll_down = Mux(scroll_delta < -48, 48, -scroll_delta)
 
-        cur_command = Signal(Command)
         with m.FSM():
             with m.State("idle"):
                 with m.If(self.commands.valid):
@@ -178,14 +204,6 @@ class TextCommandProcessor(wiring.Component):
                     with m.Switch(self.commands.payload.opcode):
                         with m.Case(Opcode.PUT_CHAR):
                             m.next = "handle-PUT_CHAR"
-                        with m.Case(Opcode.SET_FG):
-                            m.next = "handle-SET_FG"
-                        with m.Case(Opcode.SET_BG):
-                            m.next = "handle-SET_BG"
-                        with m.Case(Opcode.SET_ATTR):
-                            m.next = "handle-SET_ATTR"
-                        with m.Case(Opcode.CLEAR_ATTR):
-                            m.next = "handle-CLEAR_ATTR"
                         with m.Case(Opcode.SCROLL):
                             m.next = "handle-SCROLL"
                         with m.Case(Opcode.MOVE_CURSOR_ABS):
@@ -198,8 +216,8 @@ class TextCommandProcessor(wiring.Component):
                             m.next = "handle-ERASE_DISPLAY"
                         with m.Case(Opcode.RESET):
                             m.next = "handle-RESET"
-                        with m.Case(Opcode.RESET_ATTRS):
-                            m.next = "handle-RESET_ATTRS"
+                        with m.Case(Opcode.SET_STYLE):
+                            m.next = "handle-SET_STYLE"
 
             with m.State("handle-PUT_CHAR"):
                 with m.Switch(cur_command.params.char):
@@ -208,11 +226,7 @@ class TextCommandProcessor(wiring.Component):
                         m.d.sync += cursor_x.eq(0)
                     with m.Case(ord("\n")):
                         with m.If(cursor_y == 47):
-                            m.d.sync += scroll_src.eq(128)
-                            m.d.sync += scroll_dst.eq(0)
-                            m.d.sync += scroll_ctr.eq(128 * 48)
-                            m.d.sync += scroll_fwd.eq(1)
-                            m.next = "do-scroll-read"
+                            m.next = "do-scroll-line"
                         with m.Else():
                             m.d.sync += cursor_y.eq(cursor_y + 1)
                     with m.Case(ord("\t")):
@@ -227,9 +241,9 @@ class TextCommandProcessor(wiring.Component):
                         with m.Else():
                             m.d.sync += cursor_x.eq(cursor_x - 1)
                     with m.Default():
-                        m.d.comb += self.fb_write.en.eq(1)
                         m.d.comb += mem_addr.eq(cursor_addr)
-                        m.d.comb += self.fb_write.data.char.eq(cur_command.params.char)
+                        m.d.comb += mem_cells.eq(C(1, TextWord.length) << cursor_addr[:2])
+                        m.d.comb += mem_char.eq(cur_command.params.char)
 
                         # TODO: There is an unhandled edge case here:
                         # When the last cell of the line is empty, writing a character will keep the
@@ -237,41 +251,27 @@ class TextCommandProcessor(wiring.Component):
                         with m.If(cursor_x == 127):
                             with m.If(cursor_y == 47):
                                 m.d.sync += cursor_x.eq(0)
-                                m.d.sync += scroll_src.eq(128)
-                                m.d.sync += scroll_dst.eq(0)
-                                m.d.sync += scroll_ctr.eq(128 * 48)
-                                m.d.sync += scroll_fwd.eq(1)
-                                m.next = "do-scroll-read"
+                                m.next = "do-scroll-line"
                             with m.Else():
                                 m.d.sync += cursor_x.eq(0)
                                 m.d.sync += cursor_y.eq(cursor_y + 1)
                         with m.Else():
                             m.d.sync += cursor_x.eq(cursor_x + 1)
-            with m.State("handle-SET_FG"):
-                m.d.sync += cur_fg.eq(cur_command.params.color)
-                m.next = "idle"
-            with m.State("handle-SET_BG"):
-                m.d.sync += cur_bg.eq(cur_command.params.color)
-                m.next = "idle"
-            with m.State("handle-SET_ATTR"):
-                m.d.sync += cur_attr.eq(cur_attr | cur_command.params.attr)
-                m.next = "idle"
-            with m.State("handle-CLEAR_ATTR"):
-                m.d.sync += cur_attr.eq(cur_attr & (~cur_command.params.attr))
-                m.next = "idle"
             with m.State("handle-SCROLL"):
-                with m.If(cur_command.params.rel_pos.delta > 0):
-                    m.d.sync += scroll_src.eq(128 * cur_command.params.rel_pos.delta)
-                    m.d.sync += scroll_dst.eq(0)
-                    m.d.sync += scroll_ctr.eq(128 * 48)
-                    m.d.sync += scroll_fwd.eq(1)
-                    m.next = "do-scroll-read"
-                with m.Elif(cur_command.params.rel_pos.delta < 0):
-                    m.d.sync += scroll_src.eq(128 * 48 - 1)
-                    m.d.sync += scroll_dst.eq(128 * 48 - 1 + (-cur_command.params.rel_pos.delta) * 128)
-                    m.d.sync += scroll_ctr.eq(128 * (48 + (-cur_command.params.rel_pos.delta)))
-                    m.d.sync += scroll_fwd.eq(0)
-                    m.next = "do-scroll-read"
+                # Lines scrolled past the top come back in at the bottom,
+                # and vice versa, and need to be cleared.
+                with m.If(scroll_delta > 0):
+                    new_start = start_line + scroll_up
+                    m.d.sync += start_line.eq(Mux(new_start >= 48, new_start - 48, new_start))
+                    m.d.sync += erase_cur.eq((48 - scroll_up) * 128)
+                    m.d.sync += erase_goal.eq(128 * 48 - 1)
+                    m.next = "do-erase"
+                with m.Elif(scroll_delta < 0):
+                    new_start = start_line - scroll_down
+                    m.d.sync += start_line.eq(Mux(new_start < 0, new_start + 48, new_start))
+                    m.d.sync += erase_cur.eq(0)
+                    m.d.sync += erase_goal.eq(scroll_down * 128 - 1)
+                    m.next = "do-erase"
                 with m.Else():
                     m.next = "idle"
             with m.State("handle-MOVE_CURSOR_ABS"):
@@ -301,8 +301,8 @@ class TextCommandProcessor(wiring.Component):
                 disp_start = 0
                 disp_end = 128 * 48 - 1
 
-                m.d.sync += erase_cur.eq(Mux(cur_command.params.erase.before, line_start, cursor_addr))
-                m.d.sync += erase_goal.eq(Mux(cur_command.params.erase.after, line_end, cursor_addr))
+                m.d.sync += erase_cur.eq(Mux(cur_command.params.erase.before, disp_start, cursor_addr))
+                m.d.sync += erase_goal.eq(Mux(cur_command.params.erase.after, disp_end, cursor_addr))
                 m.next = "do-erase"
             with m.State("handle-RESET"):
                 m.d.sync += cursor_x.eq(0)
@@ -310,51 +310,34 @@ class TextCommandProcessor(wiring.Component):
                 m.d.sync += cur_fg.eq(DEFAULT_FG)
                 m.d.sync += cur_bg.eq(DEFAULT_BG)
                 m.d.sync += cur_attr.eq(0)
+                m.d.sync += start_line.eq(0)
                 m.d.sync += erase_cur.eq(0)
                 m.d.sync += erase_goal.eq(128 * 48 - 1)
                 m.next = "do-erase"
-            with m.State("handle-RESET_ATTRS"):
-                m.d.sync += cur_fg.eq(DEFAULT_FG)
-                m.d.sync += cur_bg.eq(DEFAULT_BG)
-                m.d.sync += cur_attr.eq(0)
+            with m.State("handle-SET_STYLE"):
+                style = cur_command.params.style
+                base_fg = Mux(style.reset, DEFAULT_FG, cur_fg)
+                base_bg = Mux(style.reset, DEFAULT_BG, cur_bg)
+                base_attr = Mux(style.reset, 0, cur_attr.as_value())
+                m.d.sync += cur_fg.eq(Mux(style.set_fg, style.fg, base_fg))
+                m.d.sync += cur_bg.eq(Mux(style.set_bg, style.bg, base_bg))
+                m.d.sync += cur_attr.eq((base_attr & ~style.clear_attr.as_value()) | style.set_attr.as_value())
                 m.next = "idle"
             with m.State("do-erase"):
-                with m.If(erase_cur == erase_goal):
+                with m.If(erase_goal - erase_row < TextWord.length):
                     m.next = "idle"
-                m.d.sync += erase_cur.eq(erase_cur + 1)
-                m.d.comb += self.fb_write.en.eq(1)
+                m.d.sync += erase_cur.eq(erase_row + TextWord.length)
                 m.d.comb += mem_addr.eq(erase_cur)
-                m.d.comb += self.fb_write.data.char.eq(ord(" "))
-            with m.State("do-scroll-read"):
-                with m.If((scroll_src < 0) | (scroll_src >= 128 * 48)):
-                    m.d.sync += scroll_blank.eq(1)
-                with m.Else():
-                    m.d.sync += scroll_blank.eq(0)
-                    m.d.comb += self.fb_read.en.eq(1)
-                    m.d.comb += mem_addr.eq(scroll_src)
-                with m.If(scroll_fwd):
-                    m.d.sync += scroll_src.eq(scroll_src + 1)
-                with m.Else():
-                    m.d.sync += scroll_src.eq(scroll_src - 1)
-                m.next = "do-scroll-write"
-            with m.State("do-scroll-write"):
-                with m.If((scroll_dst >= 0) & (scroll_dst < 128 * 48)):
-                    m.d.comb += self.fb_write.en.eq(1)
-                    m.d.comb += mem_addr.eq(scroll_dst)
-                    with m.If(scroll_blank):
-                        m.d.comb += self.fb_write.data.char.eq(ord(" "))
-                    with m.Else():
-                        m.d.comb += self.fb_write.data.eq(self.fb_read.data)
-                with m.If(scroll_fwd):
-                    m.d.sync += scroll_dst.eq(scroll_dst + 1)
-                with m.Else():
-                    m.d.sync += scroll_dst.eq(scroll_dst - 1)
-                m.d.sync += scroll_ctr.eq(scroll_ctr - 1)
-
-                with m.If(scroll_ctr == 1):
-                    m.next = "idle"
-                with m.Else():
-                    m.next = "do-scroll-read"
+                m.d.comb += mem_cells.eq(Cat(
+                    (erase_row + i >= erase_cur) & (erase_row + i <= erase_goal)
+                    for i in range(TextWord.length)
+                ))
+                m.d.comb += mem_char.eq(ord(" "))
+            with m.State("do-scroll-line"):
+                m.d.sync += start_line.eq(Mux(start_line == 47, 0, start_line + 1))
+                m.d.sync += erase_cur.eq(47 * 128)
+                m.d.sync += erase_goal.eq(128 * 48 - 1)
+                m.next = "do-erase"
 
         return m
 
@@ -370,322 +353,346 @@ class TextAnsiEscProcessor(wiring.Component):
         # ESC (\[ \?? (NUMBER(;NUMBER)*)?)? LETTER
         #
         # Numbers appear to go into the thousands (e.g. CSI ? 2004 h), so we should saturate them.
-        # For the commands we're interested in, we only need 3 numbers (CSI 48;5;<fg> m)
+        # Other than SGR, the commands we're interested in only need 2 numbers (CSI <y>;<x> H).
+        # SGR arguments are applied as they are parsed (including CSI 38;5;<fg> m and friends), and
+        # the whole sequence results in a single SET_STYLE command.
         #
         # ? can be treated as a flag and simply ignored (for now at least)
         #
         # Unrecognized sequences we'll just ignore and not show.
         # On parse error we abandon parsing and just dump out the crap to screen.
+        #
+        # A character is consumed every cycle, and results in at most one command. Commands are
+        # queued up in a FIFO, so that parsing isn't held up while the command processor is busy.
+
+        m.submodules.cmd_fifo = cmd_fifo = SyncFIFOBuffered(width=Command.as_shape().size, depth=16)
+
+        m.d.comb += [
+            self.commands.valid.eq(cmd_fifo.r_rdy),
+            self.commands.payload.eq(cmd_fifo.r_data),
+            cmd_fifo.r_en.eq(self.commands.ready),
+        ]
+
+        cmd = Signal(Command)
+        m.d.comb += cmd_fifo.w_data.eq(cmd)
+
+        def emit(opcode, **params):
+            m.d.comb += cmd_fifo.w_en.eq(1)
+            m.d.comb += cmd.opcode.eq(opcode)
+            for name, value in params.items():
+                if isinstance(value, dict):
+                    for field, field_value in value.items():
+                        m.d.comb += getattr(getattr(cmd.params, name), field).eq(field_value)
+                else:
+                    m.d.comb += getattr(cmd.params, name).eq(value)
+
+        char = self.chars.payload
+        char_is_digit = (char >= ord("0")) & (char <= ord("9"))
 
         csi_question_mark = Signal()
+        # Whether any numbers or separators were seen.
+        csi_has_args = Signal()
+
+        # Arguments before the current one, the rest are only needed for SGR.
+        cur_num = Signal(16)
+        args = [Signal(16) for _ in range(2)]
+        num_args = Signal(range(len(args) + 1))
+
+        final_num_args = Mux(csi_has_args, num_args + 1, 0)
+        final_args = [Mux(num_args == i, cur_num, arg) for i, arg in enumerate(args)]
+
+        def arg_val(n, default):
+            return Mux(n >= final_num_args, default, final_args[n])
+
+        # ---
+        # SGR
+
+        class SGRMode(enum.Enum, shape=3):
+            NORMAL = 0
+            # After 38 or 48, expecting 5 (palette) or 2 (RGB).
+            FG_SELECT = 1
+            BG_SELECT = 2
+            # After 38;5 or 48;5, expecting the palette index.
+            FG_INDEX = 3
+            BG_INDEX = 4
+            # Skipping the RGB color after 38;2 or 48;2, which we can't display.
+            SKIP = 5
+
+        style = Signal(cmd.params.style.shape())
+        sgr_mode = Signal(SGRMode)
+        sgr_skip = Signal(range(3))
+
+        # Effect of the current argument.
+        next_style = Signal(cmd.params.style.shape())
+        next_sgr_mode = Signal(SGRMode)
+        next_sgr_skip = Signal(range(3))
 
-        max_args = 16
-        num_args = Array([Signal(16) for _ in range(max_args + 1)])
-        num_idx = Signal(range(max_args + 1))
+        m.d.comb += [
+            next_style.eq(style),
+            next_sgr_mode.eq(SGRMode.NORMAL),
+            next_sgr_skip.eq(sgr_skip),
+        ]
 
-        cur_num = num_args[num_idx]
+        def set_fg(color):
+            m.d.comb += next_style.set_fg.eq(1)
+            m.d.comb += next_style.fg.eq(color)
+
+        def set_bg(color):
+            m.d.comb += next_style.set_bg.eq(1)
+            m.d.comb += next_style.bg.eq(color)
+
+        def set_attr(attr):
+            m.d.comb += next_style.set_attr.eq(style.set_attr | attr)
+            m.d.comb += next_style.clear_attr.eq(style.clear_attr & ~attr)
+
+        def clear_attr(attr):
+            m.d.comb += next_style.set_attr.eq(style.set_attr & ~attr)
+            m.d.comb += next_style.clear_attr.eq(style.clear_attr | attr)
+
+        def sgr_normal(v):
+            with m.Switch(v):
+                # Colors
+                with m.Case(*range(30, 38)):
+                    set_fg(v - 30)
+                with m.Case(39):
+                    set_fg(15)
+                with m.Case(*range(90, 98)):
+                    set_fg(v - 90 + 8)
+                with m.Case(38):
+                    m.d.comb += next_sgr_mode.eq(SGRMode.FG_SELECT)
+                with m.Case(*range(40, 48)):
+                    set_bg(v - 40)
+                with m.Case(49):
+                    set_bg(0)
+                with m.Case(*range(100, 108)):
+                    set_bg(v - 100 + 8)
+                with m.Case(48):
+                    m.d.comb += next_sgr_mode.eq(SGRMode.BG_SELECT)
+                # Attributes
+                with m.Case(0):
+                    # Overrides everything that came before it.
+                    m.d.comb += next_style.as_value().eq(0)
+                    m.d.comb += next_style.reset.eq(1)
+                with m.Case(1):
+                    set_attr(Attributes.BOLD)
+                with m.Case(2):
+                    # TODO: Faint
+                    pass
+                with m.Case(3):
+                    set_attr(Attributes.ITALIC)
+                with m.Case(4):
+                    set_attr(Attributes.UNDERLINE)
+                with m.Case(5, 6):
+                    set_attr(Attributes.BLINK)
+                with m.Case(7):
+                    set_attr(Attributes.INVERT)
+                with m.Case(9):
+                    set_attr(Attributes.STRIKE)
+                with m.Case(22):
+                    clear_attr(Attributes.BOLD)
+                with m.Case(23):
+                    clear_attr(Attributes.ITALIC)
+                with m.Case(24):
+                    clear_attr(Attributes.UNDERLINE)
+                with m.Case(25):
+                    clear_attr(Attributes.BLINK)
+                with m.Case(27):
+                    clear_attr(Attributes.INVERT)
+                with m.Case(29):
+                    clear_attr(Attributes.STRIKE)
+                with m.Case(53):
+                    set_attr(Attributes.OVERLINE)
+                with m.Case(55):
+                    clear_attr(Attributes.OVERLINE)
+
+        with m.Switch(sgr_mode):
+            with m.Case(SGRMode.NORMAL):
+                sgr_normal(cur_num)
+            with m.Case(SGRMode.FG_SELECT, SGRMode.BG_SELECT):
+                with m.If(cur_num == 5):
+                    m.d.comb += next_sgr_mode.eq(Mux(sgr_mode == SGRMode.FG_SELECT, SGRMode.FG_INDEX, SGRMode.BG_INDEX))
+                with m.Elif(cur_num == 2):
+                    m.d.comb += next_sgr_mode.eq(SGRMode.SKIP)
+                    m.d.comb += next_sgr_skip.eq(2)
+                with m.Else():
+                    sgr_normal(cur_num)
+            with m.Case(SGRMode.FG_INDEX):
+                set_fg(cur_num)
+            with m.Case(SGRMode.BG_INDEX):
+                set_bg(cur_num)
+            with m.Case(SGRMode.SKIP):
+                with m.If(sgr_skip != 0):
+                    m.d.comb += next_sgr_mode.eq(SGRMode.SKIP)
+                    m.d.comb += next_sgr_skip.eq(sgr_skip - 1)
 
-        sgr_in_progress = Signal()
-        sgr_pos = Signal(range(max_args + 1))
+        # ---
+        # Parser
 
         utf8_continuations = Signal(range(3))
         utf8_codepoint = Signal(21)
 
-        def arg_val(n, default):
-            return Mux(n >= num_idx, default, num_args[n])
+        m.d.comb += self.chars.ready.eq(cmd_fifo.w_rdy)
 
-        with m.If(self.commands.valid):
-            with m.If(self.commands.ready):
-                m.d.sync += self.commands.valid.eq(0)
-        with m.Elif(self.chars.valid & ~sgr_in_progress):
+        with m.If(self.chars.valid & cmd_fifo.w_rdy):
             with m.FSM():
                 with m.State("idle"):
-                    m.d.comb += self.chars.ready.eq(1)
-                    with m.If(self.chars.payload == 0x1B):
+                    with m.If(char == 0x1B):
                         m.next = "esc"
-                    with m.Elif(self.chars.payload & 0x80):
-                        with m.If((self.chars.payload & 0b11100000) == 0b11000000):
+                    with m.Elif(char & 0x80):
+                        with m.If((char & 0b11100000) == 0b11000000):
                             m.d.sync += utf8_continuations.eq(0)
-                            m.d.sync += utf8_codepoint.eq(self.chars.payload & 0b00011111)
+                            m.d.sync += utf8_codepoint.eq(char & 0b00011111)
                             m.next = "utf8-continuation"
-                        with m.Elif((self.chars.payload & 0b11110000) == 0b11100000):
+                        with m.Elif((char & 0b11110000) == 0b11100000):
                             m.d.sync += utf8_continuations.eq(1)
-                            m.d.sync += utf8_codepoint.eq(self.chars.payload & 0b00001111)
+                            m.d.sync += utf8_codepoint.eq(char & 0b00001111)
                             m.next = "utf8-continuation"
-                        with m.Elif((self.chars.payload & 0b11111000) == 0b11110000):
+                        with m.Elif((char & 0b11111000) == 0b11110000):
                             m.d.sync += utf8_continuations.eq(2)
-                            m.d.sync += utf8_codepoint.eq(self.chars.payload & 0b00000111)
+                            m.d.sync += utf8_codepoint.eq(char & 0b00000111)
                             m.next = "utf8-continuation"
                         with m.Else():
                             # TODO: Put replacement character
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.PUT_CHAR)
-                            m.d.sync += self.commands.payload.params.char.eq(0xFE)
+                            emit(Opcode.PUT_CHAR, char=0xFE)
                     with m.Else():
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.PUT_CHAR)
-                        m.d.sync += self.commands.payload.params.char.eq(self.chars.payload)
+                        emit(Opcode.PUT_CHAR, char=char)
                 with m.State("utf8-continuation"):
-                    with m.If((self.chars.payload & 0b11000000) == 0b10000000):
-                        m.d.comb += self.chars.ready.eq(1)
+                    with m.If((char & 0b11000000) == 0b10000000):
                         m.d.sync += utf8_continuations.eq(utf8_continuations - 1)
-                        codepoint = (utf8_codepoint << 6) | (self.chars.payload & 0b00111111)
+                        codepoint = (utf8_codepoint << 6) | (char & 0b00111111)
                         m.d.sync += utf8_codepoint.eq(codepoint)
                         with m.If(utf8_continuations == 0):
                             with m.If((codepoint < 0x100) | (codepoint > 0x10FFFF)):
                                 # Out of bounds
                                 # TODO: Put replacement character
-                                m.d.sync += self.commands.valid.eq(1)
-                                m.d.sync += self.commands.payload.opcode.eq(Opcode.PUT_CHAR)
-                                m.d.sync += self.commands.payload.params.char.eq(0xFE)
+                                emit(Opcode.PUT_CHAR, char=0xFE)
                             with m.Else():
                                 # TODO: Proper handling
-                                m.d.sync += self.commands.valid.eq(1)
-                                m.d.sync += self.commands.payload.opcode.eq(Opcode.PUT_CHAR)
-                                m.d.sync += self.commands.payload.params.char.eq(0xFE)
+                                emit(Opcode.PUT_CHAR, char=0xFE)
                             m.next = "idle"
                     with m.Else():
-                        # Abandon invalid sequences
+                        # Abandon invalid sequences, the character is handled again in idle.
                         # TODO: Put replacement character
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.PUT_CHAR)
-                        m.d.sync += self.commands.payload.params.char.eq(0xFE)
+                        m.d.comb += self.chars.ready.eq(0)
+                        emit(Opcode.PUT_CHAR, char=0xFE)
                         m.next = "idle"
                 with m.State("esc"):
-                    m.d.comb += self.chars.ready.eq(1)
                     m.next = "idle"
-                    with m.Switch(self.chars.payload):
+                    with m.Switch(char):
                         with m.Case(ord("[")):
-                            m.d.sync += csi_question_mark.eq(0)
-                            m.next = "csi-begin"
+                            m.d.sync += [
+                                csi_question_mark.eq(0),
+                                csi_has_args.eq(0),
+                                cur_num.eq(0),
+                                num_args.eq(0),
+                                style.as_value().eq(0),
+                                sgr_mode.eq(SGRMode.NORMAL),
+                            ]
+                            m.next = "csi"
                         with m.Case(ord("c")):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.RESET)
+                            emit(Opcode.RESET)
                         with m.Default():
                             pass
-                with m.State("csi-begin"):
-                    with m.If((self.chars.payload == ord("?")) & ~csi_question_mark):
-                        m.d.comb += self.chars.ready.eq(1)
+                with m.State("csi"):
+                    with m.If(char_is_digit):
+                        m.d.sync += csi_has_args.eq(1)
+                        m.d.sync += cur_num.eq(saturate(cur_num * 10 + char - ord("0"), 65535))
+                    with m.Elif(char == ord(";")):
+                        m.d.sync += csi_has_args.eq(1)
+                        m.d.sync += cur_num.eq(0)
+                        for i, arg in enumerate(args):
+                            with m.If(num_args == i):
+                                m.d.sync += arg.eq(cur_num)
+                        with m.If(num_args != len(args)):
+                            m.d.sync += num_args.eq(num_args + 1)
+                        m.d.sync += [
+                            style.eq(next_style),
+                            sgr_mode.eq(next_sgr_mode),
+                            sgr_skip.eq(next_sgr_skip),
+                        ]
+                    with m.Elif((char == ord("?")) & ~csi_has_args & ~csi_question_mark):
                         m.d.sync += csi_question_mark.eq(1)
-                    with m.Elif((self.chars.payload >= ord("0")) & (self.chars.payload <= ord("9"))):
-                        m.d.sync += num_idx.eq(0)
-                        m.d.sync += num_args[0].eq(0)
-                        m.next = "csi-numarg"
-                    with m.Else():
-                        m.d.sync += num_idx.eq(0)
-                        m.d.sync += num_args[0].eq(0)
-                        m.next = "csi-act"
-                with m.State("csi-numarg"):
-                    with m.If((self.chars.payload >= ord("0")) & (self.chars.payload <= ord("9"))):
-                        m.d.comb += self.chars.ready.eq(1)
-                        m.d.sync += cur_num.eq(saturate(cur_num * 10 + self.chars.payload - ord("0"), 65535))
-                    with m.Elif(self.chars.payload == ord(";")):
-                        m.d.comb += self.chars.ready.eq(1)
-                        m.d.sync += num_idx.eq(num_idx + 1)
-                        m.d.sync += num_args[num_idx + 1].eq(0)
                     with m.Else():
-                        m.d.sync += num_idx.eq(num_idx + 1)
-                        m.next = "csi-act"
-                with m.State("csi-act"):
-                    m.next = "idle"
-                    m.d.comb += self.chars.ready.eq(1)
-                    with m.Switch(self.chars.payload):
-                        with m.Case(ord("A")):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.MOVE_CURSOR_REL)
-                            m.d.sync += self.commands.payload.params.rel_pos.x_axis.eq(0)
-                            m.d.sync += self.commands.payload.params.rel_pos.reset_other.eq(0)
-                            m.d.sync += self.commands.payload.params.rel_pos.delta.eq(-arg_val(0, 1))
-                        with m.Case(ord("B")):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.MOVE_CURSOR_REL)
-                            m.d.sync += self.commands.payload.params.rel_pos.x_axis.eq(0)
-                            m.d.sync += self.commands.payload.params.rel_pos.reset_other.eq(0)
-                            m.d.sync += self.commands.payload.params.rel_pos.delta.eq(arg_val(0, 1))
-                        with m.Case(ord("C")):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.MOVE_CURSOR_REL)
-                            m.d.sync += self.commands.payload.params.rel_pos.x_axis.eq(1)
-                            m.d.sync += self.commands.payload.params.rel_pos.reset_other.eq(0)
-                            m.d.sync += self.commands.payload.params.rel_pos.delta.eq(arg_val(0, 1))
-                        with m.Case(ord("D")):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.MOVE_CURSOR_REL)
-                            m.d.sync += self.commands.payload.params.rel_pos.x_axis.eq(1)
-                            m.d.sync += self.commands.payload.params.rel_pos.reset_other.eq(0)
-                            m.d.sync += self.commands.payload.params.rel_pos.delta.eq(-arg_val(0, 1))
-                        with m.Case(ord("E")):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.MOVE_CURSOR_REL)
-                            m.d.sync += self.commands.payload.params.rel_pos.x_axis.eq(0)
-                            m.d.sync += self.commands.payload.params.rel_pos.reset_other.eq(1)
-                            m.d.sync += self.commands.payload.params.rel_pos.delta.eq(arg_val(0, 1))
-                        with m.Case(ord("F")):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.MOVE_CURSOR_REL)
-                            m.d.sync += self.commands.payload.params.rel_pos.x_axis.eq(0)
-                            m.d.sync += self.commands.payload.params.rel_pos.reset_other.eq(1)
-                            m.d.sync += self.commands.payload.params.rel_pos.delta.eq(-arg_val(0, 1))
-                        with m.Case(ord("G")):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.MOVE_CURSOR_ABS)
-                            m.d.sync += self.commands.payload.params.abs_pos.x.eq(saturate(arg_val(0, 1) - 1, 127))
-                            m.d.sync += self.commands.payload.params.abs_pos.set_x.eq(1)
-                            m.d.sync += self.commands.payload.params.abs_pos.set_y.eq(0)
-                        with m.Case(ord("H"), ord("f")):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.MOVE_CURSOR_ABS)
-                            m.d.sync += self.commands.payload.params.abs_pos.x.eq(saturate(arg_val(1, 1) - 1, 127))
-                            m.d.sync += self.commands.payload.params.abs_pos.y.eq(saturate(arg_val(0, 1) - 1, 47))
-                            m.d.sync += self.commands.payload.params.abs_pos.set_x.eq(1)
-                            m.d.sync += self.commands.payload.params.abs_pos.set_y.eq(1)
-                        with m.Case(ord("J")):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.ERASE_DISPLAY)
-                            m.d.sync += self.commands.payload.params.erase.before.eq((arg_val(0, 0) == 1) | (arg_val(0, 0) == 2))
-                            m.d.sync += self.commands.payload.params.erase.after.eq((arg_val(0, 0) == 0) | (arg_val(0, 0) == 2))
-                        with m.Case(ord("K")):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.ERASE_LINE)
-                            m.d.sync += self.commands.payload.params.erase.before.eq((arg_val(0, 0) == 1) | (arg_val(0, 0) == 2))
-                            m.d.sync += self.commands.payload.params.erase.after.eq((arg_val(0, 0) == 0) | (arg_val(0, 0) == 2))
-                        with m.Case(ord("S")):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.SCROLL)
-                            m.d.sync += self.commands.payload.params.rel_pos.delta.eq(arg_val(0, 1))
-                        with m.Case(ord("T")):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.SCROLL)
-                            m.d.sync += self.commands.payload.params.rel_pos.delta.eq(-arg_val(0, 1))
-                        with m.Case(ord("m")):
-                            m.d.sync += sgr_pos.eq(0)
-                            m.d.sync += sgr_in_progress.eq(1)
-
-        with m.If(~self.commands.valid & sgr_in_progress):
-            with m.If(sgr_pos >= num_idx - 1):
-                m.d.sync += sgr_in_progress.eq(0)
-
-            m.d.sync += sgr_pos.eq(sgr_pos + 1)
-
-            def sgr_val(off=0):
-                return arg_val(sgr_pos + off, 0)
-
-            with m.If((sgr_pos < num_idx) | (sgr_pos == 0)):
-                with m.Switch(sgr_val()):
-                    # Colors
-                    with m.Case(*range(30, 38)):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_FG)
-                        m.d.sync += self.commands.payload.params.color.eq(sgr_val() - 30)
-                    with m.Case(39):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_FG)
-                        m.d.sync += self.commands.payload.params.color.eq(15)
-                    with m.Case(*range(90, 98)):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_FG)
-                        m.d.sync += self.commands.payload.params.color.eq(sgr_val() - 90 + 8)
-                    with m.Case(38):
-                        with m.If(sgr_val(1) == 5):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_FG)
-                            m.d.sync += self.commands.payload.params.color.eq(sgr_val(2))
-                            m.d.sync += sgr_pos.eq(sgr_pos + 3)
-                        with m.Elif(sgr_val(1) == 2):
-                            m.d.sync += sgr_pos.eq(sgr_pos + 5)
-                    with m.Case(*range(40, 48)):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_BG)
-                        m.d.sync += self.commands.payload.params.color.eq(sgr_val() - 40)
-                    with m.Case(49):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_BG)
-                        m.d.sync += self.commands.payload.params.color.eq(0)
-                    with m.Case(*range(100, 108)):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_BG)
-                        m.d.sync += self.commands.payload.params.color.eq(sgr_val() - 100 + 8)
-                    with m.Case(48):
-                        with m.If(sgr_val(1) == 5):
-                            m.d.sync += self.commands.valid.eq(1)
-                            m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_BG)
-                            m.d.sync += self.commands.payload.params.color.eq(sgr_val(2))
-                            m.d.sync += sgr_pos.eq(sgr_pos + 3)
-                        with m.Elif(sgr_val(1) == 2):
-                            m.d.sync += sgr_pos.eq(sgr_pos + 5)
-                            # Attributes
-                    with m.Case(0):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.RESET_ATTRS)
-                    with m.Case(1):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.BOLD)
-                        # TODO: Bold
-                        pass
-                    with m.Case(2):
-                        # TODO: Faint
-                        pass
-                    with m.Case(3):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.ITALIC)
-                    with m.Case(4):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.UNDERLINE)
-                    with m.Case(5, 6):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.BLINK)
-                    with m.Case(7):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.INVERT)
-                    with m.Case(9):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.STRIKE)
-                    with m.Case(22):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.CLEAR_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.BOLD)
-                    with m.Case(23):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.CLEAR_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.ITALIC)
-                    with m.Case(24):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.CLEAR_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.UNDERLINE)
-                    with m.Case(25):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.CLEAR_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.BLINK)
-                    with m.Case(27):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.CLEAR_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.INVERT)
-                    with m.Case(29):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.CLEAR_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.STRIKE)
-                    with m.Case(53):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.SET_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.OVERLINE)
-                    with m.Case(55):
-                        m.d.sync += self.commands.valid.eq(1)
-                        m.d.sync += self.commands.payload.opcode.eq(Opcode.CLEAR_ATTR)
-                        m.d.sync += self.commands.payload.params.attr.eq(Attributes.OVERLINE)
+                        m.next = "idle"
+                        with m.Switch(char):
+                            with m.Case(ord("A")):
+                                emit(Opcode.MOVE_CURSOR_REL, rel_pos={
+                                    "x_axis": 0,
+                                    "reset_other": 0,
+                                    "delta": -arg_val(0, 1),
+                                })
+                            with m.Case(ord("B")):
+                                emit(Opcode.MOVE_CURSOR_REL, rel_pos={
+                                    "x_axis": 0,
+                                    "reset_other": 0,
+                                    "delta": arg_val(0, 1),
+                                })
+                            with m.Case(ord("C")):
+                                emit(Opcode.MOVE_CURSOR_REL, rel_pos={
+                                    "x_axis": 1,
+                                    "reset_other": 0,
+                                    "delta": arg_val(0, 1),
+                                })
+                            with m.Case(ord("D")):
+                                emit(Opcode.MOVE_CURSOR_REL, rel_pos={
+                                    "x_axis": 1,
+                                    "reset_other": 0,
+                                    "delta": -arg_val(0, 1),
+                                })
+                            with m.Case(ord("E")):
+                                emit(Opcode.MOVE_CURSOR_REL, rel_pos={
+                                    "x_axis": 0,
+                                    "reset_other": 1,
+                                    "delta": arg_val(0, 1),
+                                })
+                            with m.Case(ord("F")):
+                                emit(Opcode.MOVE_CURSOR_REL, rel_pos={
+                                    "x_axis": 0,
+                                    "reset_other": 1,
+                                    "delta": -arg_val(0, 1),
+                                })
+                            with m.Case(ord("G")):
+                                emit(Opcode.MOVE_CURSOR_ABS, abs_pos={
+                                    "x": saturate(arg_val(0, 1) - 1, 127),
+                                    "set_x": 1,
+                                    "set_y": 0,
+                                })
+                            with m.Case(ord("H"), ord("f")):
+                                emit(Opcode.MOVE_CURSOR_ABS, abs_pos={
+                                    "x": saturate(arg_val(1, 1) - 1, 127),
+                                    "y": saturate(arg_val(0, 1) - 1, 47),
+                                    "set_x": 1,
+                                    "set_y": 1,
+                                })
+                            with m.Case(ord("J")):
+                                emit(Opcode.ERASE_DISPLAY, erase={
+                                    "before": (arg_val(0, 0) == 1) | (arg_val(0, 0) == 2),
+                                    "after": (arg_val(0, 0) == 0) | (arg_val(0, 0) == 2),
+                                })
+                            with m.Case(ord("K")):
+                                emit(Opcode.ERASE_LINE, erase={
+                                    "before": (arg_val(0, 0) == 1) | (arg_val(0, 0) == 2),
+                                    "after": (arg_val(0, 0) == 0) | (arg_val(0, 0) == 2),
+                                })
+                            with m.Case(ord("S")):
+                                emit(Opcode.SCROLL, rel_pos={
+                                    "delta": arg_val(0, 1),
+                                })
+                            with m.Case(ord("T")):
+                                emit(Opcode.SCROLL, rel_pos={
+                                    "delta": -arg_val(0, 1),
+                                })
+                            with m.Case(ord("m")):
+                                emit(Opcode.SET_STYLE, style=next_style)
 
         return m
 
 
 class TextFramebuffer(wiring.Component):
-    fb_read: In(memory.ReadPort.Signature(addr_width=13, shape=CharacterCell))
+    fb_read: In(memory.ReadPort.Signature(addr_width=11, shape=TextWord))
     cursor_x: In(7)
     cursor_y: In(6)
+    start_line: In(range(48))
 
     def elaborate(self, platform):
         m = Module()
@@ -732,16 +739,26 @@ class TextFramebuffer(wiring.Component):
                 m.d.sync += blink_ctr.eq(0)
                 m.d.sync += blink_state.eq(~blink_state)
 
+        # Only pick up scrolling between frames, to avoid tearing.
+        frame_start_line = Signal(range(48))
+        with m.If(seq.v_start):
+            m.d.sync += frame_start_line.eq(self.start_line)
+
         # Stage 1 - read character cell from screen memory
-        m.d.comb += self.fb_read.addr.eq((seq.h_pos >> 3) + (seq.v_pos >> 4) * 128)
+        fb_line = (seq.v_pos >> 4) + frame_start_line
+        fb_line_wrapped = Mux(fb_line >= 48, fb_line - 48, fb_line)
+        fb_addr = (seq.h_pos >> 3) + fb_line_wrapped * 128
+        m.d.comb += self.fb_read.addr.eq(fb_addr >> 2)
+
+        fb_cell = self.fb_read.data[delayed(fb_addr[:2], 1)]
 
-        fg = delayed(self.fb_read.data.fg, 1)
-        bg = delayed(self.fb_read.data.bg, 1)
-        attr = delayed(self.fb_read.data.attr, 1)
+        fg = delayed(fb_cell.fg, 1)
+        bg = delayed(fb_cell.bg, 1)
+        attr = delayed(fb_cell.attr, 1)
 
         # Stage 2 - read glyph from font memory
         font_rd = font.read_port(domain="pixel")
-        m.d.comb += font_rd.addr.eq(self.fb_read.data.char * 16 + (seq.v_pos & 15))
+        m.d.comb += font_rd.addr.eq(fb_cell.char * 16 + (seq.v_pos & 15))
 
         pixel_x = delayed(seq.h_pos, 2)
         pixel_y = seq.v_pos
@@ -776,8 +793,31 @@ class TextFramebuffer(wiring.Component):
         return m
 
 
+# Characters are sent to the terminal through a FIFO, which can be fed in
+# three ways:
+#  - one character at a time, through the Char register,
+#  - through the write window on wb_bus, where writes to any address push a
+#    character (so that block moves and indexed stores work), and are held
+#    until there is room in the FIFO,
+#  - by DMA, which reads DmaLen characters starting from the (physical)
+#    address DmaAddr over dma_bus, and pushes them into the FIFO.
+# Level is the number of characters in the FIFO, which holds up to
+# CHAR_FIFO_DEPTH characters, so software can write as many characters as
+# there is room for without checking Status in between.
+#
+# The cells on the display can also be accessed directly through text_bus,
+# 4 bytes per cell (char, fg, bg and attr), row after row, starting from the
+# top of the display. Like with multi-byte CSRs, a cell is read as a whole
+# when its first byte is read, and written as a whole when its last byte is
+# written. Accesses are ordered with respect to each other, but not with
+# respect to characters going through the FIFO.
 class TextAnsiTerminal(wiring.Component):
     csr_bus: wiring.In(csr.Signature(addr_width=4, data_width=8))
+    wb_bus: wiring.In(wishbone.Signature(addr_width=8, data_width=8))
+    text_bus: wiring.In(wishbone.Signature(addr_width=15, data_width=8))
+    dma_bus: wiring.Out(wishbone.Signature(addr_width=24, data_width=8, features={"err", "rty", "stall"}))
+
+    CHAR_FIFO_DEPTH = 256
 
     class CharRegister(csr.Register, access="w"):
         char: csr.Field(csr.action.W, 8)
@@ -786,17 +826,60 @@ class TextAnsiTerminal(wiring.Component):
         reserved: csr.Field(csr.action.ResR0WA, 7)
         ready: csr.Field(csr.action.R, 1)
 
+    class LevelRegister(csr.Register, access="r"):
+        level: csr.Field(csr.action.R, 16)
+
+    class DmaAddrRegister(csr.Register, access="rw"):
+        addr: csr.Field(csr.action.RW, 24)
+
+    class DmaLenRegister(csr.Register, access="rw"):
+        len: csr.Field(csr.action.RW, 16)
+
+    class DmaControlRegister(csr.Register, access="rw"):
+        start: csr.Field(csr.action.W, 1)
+        busy: csr.Field(csr.action.R, 1)
+        error: csr.Field(csr.action.R, 1)
+        reserved: csr.Field(csr.action.ResR0WA, 5)
+
     def __init__(self):
         super().__init__()
 
         regs = csr.Builder(addr_width=4, data_width=8)
         self._char = regs.add("Char", self.CharRegister())
         self._status = regs.add("Status", self.StatusRegister())
+        self._level = regs.add("Level", self.LevelRegister(), offset=0x2)
+        self._dma_addr = regs.add("DmaAddr", self.DmaAddrRegister(), offset=0x4)
+        self._dma_len = regs.add("DmaLen", self.DmaLenRegister(), offset=0x8)
+        self._dma_control = regs.add("DmaControl", self.DmaControlRegister(), offset=0xa)
         mmap = regs.as_memory_map()
 
         self._bridge = csr.Bridge(mmap)
         self.csr_bus.memory_map = mmap
 
+        self.wb_bus.memory_map = MemoryMap(addr_width=8, data_width=8)
+        self.wb_bus.memory_map.add_resource(self, name=("chars",), size=(1<<8))
+        self.wb_bus.memory_map.freeze()
+
+        blank = {
+            "char": ord(" "),
+            "fg": 15,
+            "bg": 0,
+        }
+
+        init = []
+        for i in range(128 * 48 // TextWord.length):
+            init.append(TextWord.const([blank] * TextWord.length))
+
+        self._text = memory.Memory(
+            shape=TextWord,
+            depth=128*48 // TextWord.length,
+            init=init,
+        )
+
+        self.text_bus.memory_map = MemoryMap(addr_width=15, data_width=8)
+        self.text_bus.memory_map.add_resource(self._text, name=("cells",), size=128 * 48 * 4)
+        self.text_bus.memory_map.freeze()
+
     def elaborate(self, platform):
         m = Module()
 
@@ -809,48 +892,239 @@ class TextAnsiTerminal(wiring.Component):
 
         m.d.comb += fb.cursor_x.eq(cmd.cursor_x)
         m.d.comb += fb.cursor_y.eq(cmd.cursor_y)
+        m.d.comb += fb.start_line.eq(cmd.start_line)
 
         # ---
         # Framebuffer memory
 
-        init = []
-        for i in range(128 * 48):
-            init.append(CharacterCell.const({
-                "char": ord(" "),
-                "fg": 15,
-                "bg": 0,
-            }))
-
-        m.submodules.text = text = memory.Memory(
-            shape=CharacterCell,
-            depth=128*48,
-            init=init,
-        )
+        m.submodules.text = text = self._text
 
         text_fb_rd = text.read_port(domain="pixel")
         wiring.connect(m, text_fb_rd, fb.fb_read)
 
-        text_cmd_rd = text.read_port(domain="pixel")
-        text_cmd_wr = text.write_port(domain="pixel")
-        wiring.connect(m, text_cmd_rd, cmd.fb_read)
-        wiring.connect(m, text_cmd_wr, cmd.fb_write)
+        # Shared by the command processor and text_bus, which gets the cycles
+        # where the command processor isn't writing. The read port uses the
+        # same address, so that the two can be mapped onto one RAM port.
+        text_wr = text.write_port(domain="pixel", granularity=1)
+        text_bus_rd = text.read_port(domain="pixel")
+
+        m.d.comb += [
+            text_wr.addr.eq(cmd.fb_write.addr),
+            text_wr.data.eq(cmd.fb_write.data),
+            text_wr.en.eq(cmd.fb_write.en),
+            text_bus_rd.addr.eq(text_wr.addr),
+        ]
 
         # ---
         # Character input processing
 
         m.submodules.char_cdc_fifo = char_cdc_fifo = AsyncFIFOBuffered(
             width=8,
-            depth=256,
+            depth=self.CHAR_FIFO_DEPTH,
             w_domain="sync",
             r_domain="pixel")
 
         m.d.comb += [
-            char_cdc_fifo.w_data.eq(self._char.f.char.w_data),
-            char_cdc_fifo.w_en.eq(self._char.f.char.w_stb),
             self._status.f.ready.r_data.eq(char_cdc_fifo.w_rdy),
+            self._level.f.level.r_data.eq(char_cdc_fifo.w_level),
         ]
 
+        # Register writes can't be held off, so they take priority over the
+        # write window, which takes priority over DMA.
+        wb = self.wb_bus
+        wb_req = wb.cyc & wb.stb & ~wb.ack
+        wb_push = wb_req & wb.we & ~self._char.f.char.w_stb
+
+        dma_push = Signal()
+        dma_data = Signal(8)
+
+        with m.If(self._char.f.char.w_stb):
+            m.d.comb += [
+                char_cdc_fifo.w_data.eq(self._char.f.char.w_data),
+                char_cdc_fifo.w_en.eq(1),
+            ]
+        with m.Elif(wb_push):
+            m.d.comb += [
+                char_cdc_fifo.w_data.eq(wb.dat_w),
+                char_cdc_fifo.w_en.eq(1),
+            ]
+        with m.Elif(dma_push):
+            m.d.comb += [
+                char_cdc_fifo.w_data.eq(dma_data),
+                char_cdc_fifo.w_en.eq(1),
+            ]
+
+        # Reads from the window return 0.
+        m.d.sync += wb.ack.eq((wb_req & ~wb.we) | (wb_push & char_cdc_fifo.w_rdy))
+
+        dma_accepted = dma_push & ~self._char.f.char.w_stb & ~wb_push & char_cdc_fifo.w_rdy
+
         wiring.connect(m, ansi.chars, char_cdc_fifo.r_stream)
         wiring.connect(m, ansi.commands, cmd.commands)
 
+        # ---
+        # DMA
+
+        dma = self.dma_bus
+        dma_ctl = self._dma_control.f
+        dma_addr = Signal(24)
+        dma_len = Signal(16)
+        dma_busy = Signal()
+        dma_error = Signal()
+
+        m.d.comb += [
+            dma_ctl.busy.r_data.eq(dma_busy),
+            dma_ctl.error.r_data.eq(dma_error),
+        ]
+
+        # Same as the debug bridge, one read at a time, STB_O is dropped
+        # once the request is accepted, and raised again on retry.
+        m.d.comb += dma.sel.eq(1)
+        with m.If(dma.stb & ~dma.stall):
+            m.d.sync += dma.stb.eq(0)
+        with m.If(dma.cyc & dma.rty):
+            m.d.sync += dma.stb.eq(1)
+
+        with m.FSM():
+            with m.State("idle"):
+                with m.If(dma_ctl.start.w_stb & dma_ctl.start.w_data & (self._dma_len.f.len.data != 0)):
+                    m.d.sync += [
+                        dma_addr.eq(self._dma_addr.f.addr.data),
+                        dma_len.eq(self._dma_len.f.len.data),
+                        dma_busy.eq(1),
+                        dma_error.eq(0),
+                    ]
+                    m.next = "read"
+            with m.State("read"):
+                with m.If(~dma.cyc):
+                    m.d.sync += [
+                        dma.adr.eq(dma_addr),
+                        dma.cyc.eq(1),
+                        dma.stb.eq(1),
+                    ]
+                with m.Elif(dma.err):
+                    m.d.sync += [
+                        dma.cyc.eq(0),
+                        dma_busy.eq(0),
+                        dma_error.eq(1),
+                    ]
+                    m.next = "idle"
+                with m.Elif(dma.ack):
+                    m.d.sync += [
+                        dma.cyc.eq(0),
+                        dma_data.eq(dma.dat_r),
+                    ]
+                    m.next = "push"
+            with m.State("push"):
+                m.d.comb += dma_push.eq(1)
+                with m.If(dma_accepted):
+                    m.d.sync += [
+                        dma_addr.eq(dma_addr + 1),
+                        dma_len.eq(dma_len - 1),
+                    ]
+                    with m.If(dma_len == 1):
+                        m.d.sync += dma_busy.eq(0)
+                        m.next = "idle"
+                    with m.Else():
+                        m.next = "read"
+
+        # ---
+        # Direct access to the text memory
+
+        class TextBusRequest(data.Struct):
+            write: 1
+            cell: 13
+            data: CharacterCell
+
+        m.submodules.text_req_fifo = text_req_fifo = AsyncFIFO(
+            width=TextBusRequest.as_shape().size,
+            depth=16,
+            w_domain="sync",
+            r_domain="pixel")
+
+        m.submodules.text_resp_fifo = text_resp_fifo = AsyncFIFO(
+            width=CharacterCell.as_shape().size,
+            depth=4,
+            w_domain="pixel",
+            r_domain="sync")
+
+        tb = self.text_bus
+        tb_req = tb.cyc & tb.stb & ~tb.ack
+        tb_cell = tb.adr[2:]
+        tb_byte = tb.adr[:2]
+        tb_in_range = tb_cell < 128 * 48
+
+        # First 3 bytes of the cell being written, and the last cell read.
+        tb_staged = Signal(24)
+        tb_latched = Signal(32)
+        tb_byte_q = Signal(2)
+        tb_read_pending = Signal()
+
+        req = TextBusRequest(text_req_fifo.w_data)
+        m.d.comb += [
+            req.write.eq(tb.we),
+            req.cell.eq(tb_cell),
+            req.data.eq(Cat(tb_staged, tb.dat_w)),
+            tb.dat_r.eq(tb_latched.word_select(tb_byte_q, 8)),
+        ]
+
+        m.d.sync += tb.ack.eq(0)
+        with m.If(tb_req):
+            m.d.sync += tb_byte_q.eq(tb_byte)
+
+            with m.If(tb.we & (tb_byte != 3)):
+                with m.Switch(tb_byte):
+                    for i in range(3):
+                        with m.Case(i):
+                            m.d.sync += tb_staged[i * 8:(i + 1) * 8].eq(tb.dat_w)
+                m.d.sync += tb.ack.eq(1)
+            with m.Elif((tb_byte != 0) & ~tb.we):
+                m.d.sync += tb.ack.eq(1)
+            with m.Elif(~tb_in_range):
+                with m.If(~tb.we):
+                    m.d.sync += tb_latched.eq(0)
+                m.d.sync += tb.ack.eq(1)
+            with m.Elif(tb.we):
+                # Writes are posted.
+                m.d.comb += text_req_fifo.w_en.eq(1)
+                m.d.sync += tb.ack.eq(text_req_fifo.w_rdy)
+            with m.Elif(~tb_read_pending):
+                m.d.comb += text_req_fifo.w_en.eq(1)
+                m.d.sync += tb_read_pending.eq(text_req_fifo.w_rdy)
+            with m.Elif(text_resp_fifo.r_rdy):
+                m.d.comb += text_resp_fifo.r_en.eq(1)
+                m.d.sync += [
+                    tb_latched.eq(text_resp_fifo.r_data),
+                    tb_read_pending.eq(0),
+                    tb.ack.eq(1),
+                ]
+
+        # Cells are display relative, same as in the command processor.
+        pix_req = TextBusRequest(text_req_fifo.r_data)
+        pix_addr = pix_req.cell + cmd.start_line * 128
+        pix_addr_wrapped = Mux(pix_addr >= 128 * 48, pix_addr - 128 * 48, pix_addr)
+        pix_read_pending = Signal()
+        pix_read_cell = Signal(2)
+
+        m.d.pixel += pix_read_pending.eq(0)
+        with m.If(~cmd.fb_write.en.any() & text_req_fifo.r_rdy):
+            m.d.comb += [
+                text_req_fifo.r_en.eq(1),
+                text_wr.addr.eq(pix_addr_wrapped >> 2),
+            ]
+            with m.If(pix_req.write):
+                m.d.comb += text_wr.en.eq(C(1, TextWord.length) << pix_addr_wrapped[:2])
+                for cell in text_wr.data:
+                    m.d.comb += cell.eq(pix_req.data)
+            with m.Else():
+                m.d.pixel += [
+                    pix_read_pending.eq(1),
+                    pix_read_cell.eq(pix_addr_wrapped[:2]),
+                ]
+
+        m.d.comb += [
+            text_resp_fifo.w_data.eq(text_bus_rd.data[pix_read_cell]),
+            text_resp_fifo.w_en.eq(pix_read_pending),
+        ]
+
         return m
@@ -35,8 +35,12 @@ class WishboneCut(wiring.Component):
         # high in the cycle it presented ACK (because that's also when
         # the manager would just see ACK).
 
-        # TODO(qookie): Add support for ERR (and RTY).
         # ERR and RTY act as additional ACKs.
+        tgt_term = self._tgt_bus.ack
+        for name in ("err", "rty"):
+            if hasattr(self._tgt_bus, name):
+                tgt_term = tgt_term | getattr(self._tgt_bus, name)
+                m.d.sync += getattr(self.wb_bus, name).eq(getattr(self._tgt_bus, name))
 
         in_stb_q = Signal()
         m.d.sync += in_stb_q.eq(self.wb_bus.stb)
@@ -49,7 +53,7 @@ class WishboneCut(wiring.Component):
         # registered STB immediately. The assumption is that a
         # transaction does not terminate before acknowledgement
         # (that is, the manager does not lower STB before seeing ACK).
-        with m.If(self._tgt_bus.ack):
+        with m.If(tgt_term):
             m.d.sync += self._tgt_bus.stb.eq(0)
 
         # ---
@@ -67,3 +71,97 @@ class WishboneCut(wiring.Component):
         return m
 
     pass
+
+
+# A pipelined (B4, STALL-based) Wishbone combinatorial cut.
+# Requests go through a two-entry skid buffer, so STALL towards the
+# manager is registered, and a new request can be accepted every
+# cycle. Responses (ACK, ERR, RTY and read data) are registered.
+#
+# The target may be a classic subordinate, in which case it is driven
+# one request at a time, treating the lack of termination as STALL.
+class WishbonePipelinedCut(wiring.Component):
+    def __init__(self, target_bus):
+        self._tgt_bus = target_bus
+
+        super().__init__({
+            "wb_bus": In(wishbone.Signature(
+                addr_width=target_bus.addr_width,
+                data_width=target_bus.data_width,
+                granularity=target_bus.granularity,
+                features=target_bus.features | {wishbone.Feature.STALL},
+            ))
+        })
+
+        target_bus.memory_map.freeze()
+        self.wb_bus.memory_map = target_bus.memory_map
+
+    def elaborate(self, platform):
+        m = Module()
+
+        tgt = self._tgt_bus
+
+        # Signals making up a request.
+        req_names = ["adr", "dat_w", "sel", "we"]
+        for name in ("cti", "bte", "lock"):
+            if hasattr(tgt, name):
+                req_names.append(name)
+
+        tgt_term = tgt.ack
+        for name in ("err", "rty"):
+            if hasattr(tgt, name):
+                tgt_term = tgt_term | getattr(tgt, name)
+
+        if hasattr(tgt, "stall"):
+            tgt_stall = tgt.stall
+        else:
+            tgt_stall = ~tgt_term
+
+        skid_valid = Signal()
+        skid = {name: Signal.like(getattr(self.wb_bus, name), name=f"skid_{name}")
+                for name in req_names}
+
+        in_accept = self.wb_bus.cyc & self.wb_bus.stb & ~skid_valid
+        m.d.comb += self.wb_bus.stall.eq(skid_valid)
+
+        # Request path
+        # ---
+        with m.If(~tgt.stb | ~tgt_stall):
+            # Output register is free (or being emptied this cycle).
+            with m.If(skid_valid):
+                m.d.sync += [getattr(tgt, name).eq(skid[name]) for name in req_names]
+                m.d.sync += [
+                    tgt.stb.eq(1),
+                    skid_valid.eq(0),
+                ]
+            with m.Elif(in_accept):
+                m.d.sync += [getattr(tgt, name).eq(getattr(self.wb_bus, name)) for name in req_names]
+                m.d.sync += tgt.stb.eq(1)
+            with m.Else():
+                m.d.sync += tgt.stb.eq(0)
+        with m.Elif(in_accept):
+            # Output register is occupied, park the request.
+            m.d.sync += [skid[name].eq(getattr(self.wb_bus, name)) for name in req_names]
+            m.d.sync += skid_valid.eq(1)
+
+        # The manager dropping CYC aborts everything in flight.
+        with m.If(~self.wb_bus.cyc):
+            m.d.sync += [
+                tgt.stb.eq(0),
+                skid_valid.eq(0),
+            ]
+
+        m.d.sync += tgt.cyc.eq(self.wb_bus.cyc)
+
+        # Response path
+        # ---
+        m.d.sync += [
+            self.wb_bus.dat_r.eq(tgt.dat_r),
+            self.wb_bus.ack.eq(tgt.ack & tgt.cyc & self.wb_bus.cyc),
+        ]
+        for name in ("err", "rty"):
+            if hasattr(tgt, name):
+                m.d.sync += getattr(self.wb_bus, name).eq(
+                    getattr(tgt, name) & tgt.cyc & self.wb_bus.cyc)
+
+        return m
@@ -0,0 +1,50 @@
+from amaranth import *
+
+from amaranth_soc import wishbone
+
+from amaranth.lib import wiring
+from amaranth.lib.wiring import In, Out
+from amaranth.utils import exact_log2
+
+
+# A Wishbone width converter, letting a narrow manager access a wider
+# subordinate. Every access turns into a single access on the wide bus,
+# with SEL picking the byte lane, so the subordinate's granularity must
+# match the manager's data width.
+class WishboneWidthConverter(wiring.Component):
+    def __init__(self, target_bus, *, data_width=8):
+        if target_bus.granularity != data_width:
+            raise ValueError(f"Target bus granularity must be {data_width}, "
+                             f"not {target_bus.granularity}")
+
+        self._tgt_bus = target_bus
+        self._ratio = target_bus.data_width // data_width
+
+        super().__init__({
+            "wb_bus": In(wishbone.Signature(
+                addr_width=target_bus.addr_width + exact_log2(self._ratio),
+                data_width=data_width,
+            ))
+        })
+
+        target_bus.memory_map.freeze()
+        self.wb_bus.memory_map = target_bus.memory_map
+
+    def elaborate(self, platform):
+        m = Module()
+
+        lane_bits = exact_log2(self._ratio)
+        lane = self.wb_bus.adr[:lane_bits]
+
+        m.d.comb += [
+            self._tgt_bus.adr.eq(self.wb_bus.adr[lane_bits:]),
+            self._tgt_bus.dat_w.eq(Cat(self.wb_bus.dat_w for _ in range(self._ratio))),
+            self._tgt_bus.sel.eq(Mux(self.wb_bus.sel, C(1, self._ratio) << lane, 0)),
+            self._tgt_bus.cyc.eq(self.wb_bus.cyc),
+            self._tgt_bus.stb.eq(self.wb_bus.stb),
+            self._tgt_bus.we.eq(self.wb_bus.we),
+            self.wb_bus.dat_r.eq(self._tgt_bus.dat_r.word_select(lane, self.wb_bus.data_width)),
+            self.wb_bus.ack.eq(self._tgt_bus.ack),
+        ]
+
+        return m
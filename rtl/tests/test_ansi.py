@@ -18,15 +18,64 @@ class TestAnsiEscapeProcessor:
         @sim.add_testbench
         async def tb_pull(ctx):
             cmd = await stream_get(ctx, dut.commands)
-            assert cmd.opcode == Opcode.SET_FG
-            assert cmd.params.color == 101
+            assert cmd.opcode == Opcode.SET_STYLE
+            assert not cmd.params.style.reset
+            assert cmd.params.style.set_fg
+            assert cmd.params.style.fg == 101
+            assert cmd.params.style.set_bg
+            assert cmd.params.style.bg == 76
+            assert cmd.params.style.set_attr == Attributes.STRIKE
+            assert cmd.params.style.clear_attr == Attributes(0)
+
+        run_sim(sim)
+
+    def test_sgr_order(self):
+        dut = TextAnsiEscProcessor()
+        sim = prepare_sim(dut)
+
+        @sim.add_testbench
+        async def tb_push(ctx):
+            seq = "\x1b[31;1;0;4;7;27;38;2;1;2;3;92m"
+            for c in seq:
+                await stream_put(ctx, dut.chars, ord(c))
+
+        @sim.add_testbench
+        async def tb_pull(ctx):
+            cmd = await stream_get(ctx, dut.commands)
+            assert cmd.opcode == Opcode.SET_STYLE
+            assert cmd.params.style.reset
+            assert cmd.params.style.set_fg
+            assert cmd.params.style.fg == 10
+            assert not cmd.params.style.set_bg
+            assert cmd.params.style.set_attr == Attributes.UNDERLINE
+            assert cmd.params.style.clear_attr == Attributes.INVERT
+
+        run_sim(sim)
+
+    def test_cursor_position(self):
+        dut = TextAnsiEscProcessor()
+        sim = prepare_sim(dut)
+
+        @sim.add_testbench
+        async def tb_push(ctx):
+            seq = "\x1b[12;34Hx\x1b[;5H"
+            for c in seq:
+                await stream_put(ctx, dut.chars, ord(c))
+
+        @sim.add_testbench
+        async def tb_pull(ctx):
+            cmd = await stream_get(ctx, dut.commands)
+            assert cmd.opcode == Opcode.MOVE_CURSOR_ABS
+            assert cmd.params.abs_pos.x == 33
+            assert cmd.params.abs_pos.y == 11
 
             cmd = await stream_get(ctx, dut.commands)
-            assert cmd.opcode == Opcode.SET_BG
-            assert cmd.params.color == 76
+            assert cmd.opcode == Opcode.PUT_CHAR
+            assert cmd.params.char == ord("x")
 
             cmd = await stream_get(ctx, dut.commands)
-            assert cmd.opcode == Opcode.SET_ATTR
-            assert cmd.params.attr == Attributes.STRIKE
+            assert cmd.opcode == Opcode.MOVE_CURSOR_ABS
+            assert cmd.params.abs_pos.x == 4
+            assert cmd.params.abs_pos.y == 0
 
         run_sim(sim)
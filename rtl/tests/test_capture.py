@@ -0,0 +1,62 @@
+import pytest
+
+from amaranth import *
+
+from paaliaq.test import *
+from paaliaq.test import _captures
+
+
+def counter_module():
+    m = Module()
+    counter = Signal(8)
+    m.d.sync += counter.eq(counter + 1)
+    return m, counter
+
+
+class TestWaveformCapture:
+    def run(self, m, capture, ticks):
+        sim = prepare_sim(m, timeout=ticks + 10, trace={})
+        sim.add_process(capture.process)
+
+        @sim.add_testbench
+        async def tb(ctx):
+            await ctx.tick().repeat(ticks)
+
+        run_sim(sim, inspect.stack()[1].function)
+
+    def test_last_cycles(self):
+        m, counter = counter_module()
+        capture = WaveformCapture({"counter": counter}, depth=16)
+        self.run(m, capture, 100)
+
+        assert capture.triggered_at is None
+        assert [tick for tick, _ in capture._samples] == list(range(84, 100))
+        assert [sampled for _, sampled in capture._samples] == [[i] for i in range(84, 100)]
+
+    def test_trigger_window(self):
+        m, counter = counter_module()
+        capture = WaveformCapture({"counter": counter}, depth=20, trigger=counter == 50)
+        self.run(m, capture, 100)
+
+        assert capture.triggered_at == 50
+        assert [sampled for _, sampled in capture._samples] == [[i] for i in range(41, 61)]
+
+    def test_repeated_names(self, tmp_path):
+        m = Module()
+        data_a, data_b = Signal(4, name="data"), Signal(4, name="data")
+        m.d.sync += [data_a.eq(data_a + 1), data_b.eq(data_b + 2)]
+
+        sim = prepare_sim(m, timeout=20, trace=[data_a, data_b, data_a[1:3]])
+        capture = _captures[sim]
+        assert capture._names == ["data", "data_1", "v2"]
+
+        @sim.add_testbench
+        async def tb(ctx):
+            await ctx.tick().repeat(5)
+
+        run_sim(sim)
+
+        capture.write_vcd(tmp_path / "capture.vcd")
+        vcd = (tmp_path / "capture.vcd").read_text()
+        for name in capture._names:
+            assert f" {name} $end" in vcd
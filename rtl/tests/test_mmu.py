@@ -0,0 +1,79 @@
+import pytest
+
+from paaliaq.test import *
+from paaliaq.mmu import *
+
+
+PT_BASE = 0x1000
+
+
+def pte(pfn, *, present=1):
+    return (pfn << 4) | 0b1110 | present
+
+
+# Page table memory, answering each read in the cycle after it's issued.
+class PageTableModel:
+    def __init__(self, bus):
+        self._bus = bus
+        self.ptes = {}
+
+    def read(self, adr):
+        entry = self.ptes.get((adr - PT_BASE) >> 1, 0)
+        return (entry >> 8) if adr & 1 else (entry & 0xff)
+
+    async def process(self, ctx):
+        bus = self._bus
+        async for _, _, cyc, stb, adr in ctx.tick().sample(bus.cyc, bus.stb, bus.adr):
+            ctx.set(bus.ack, cyc & stb)
+            if cyc & stb:
+                ctx.set(bus.dat_r, self.read(adr))
+
+
+async def translate(ctx, iface, vaddr):
+    ctx.set(iface.vaddr, vaddr)
+    ctx.set(iface.stb, 1)
+    paddr, abort = await ctx.tick().sample(iface.paddr, iface.abort).until(iface.valid)
+    ctx.set(iface.stb, 0)
+    await ctx.tick()
+    return None if abort else paddr
+
+
+async def flush_page(ctx, csr_bus, vpn):
+    await csr_write(ctx, csr_bus, 0x8, vpn << 4, 2)
+    for _ in range(4):
+        await ctx.tick()
+
+
+class TestMMU:
+    def test_prefetch_refill(self):
+        dut = MMU(tlb_ways=2, tlb_sets=4, pte_prefetch=2)
+        sim = prepare_sim(dut, timeout=2000)
+
+        pt = PageTableModel(dut.wb_bus)
+        sim.add_process(pt.process)
+        pt.ptes = {0: pte(0x100), 1: pte(0x101), 4: pte(0, present=0), 5: pte(0x105)}
+
+        @sim.add_testbench
+        async def tb(ctx):
+            await csr_write(ctx, dut.csr_bus, 0x4, PT_BASE, 4)
+            await csr_write(ctx, dut.csr_bus, 0x8, 1, 2)
+            for _ in range(10):
+                await ctx.tick()
+
+            # Page 1 comes in with page 0, into way 1 of its set.
+            assert await translate(ctx, dut.iface, 0x000123) == 0x100123
+            assert await translate(ctx, dut.iface, 0x001123) == 0x101123
+
+            # Page 5 comes in with page 4, into way 0 of that same set.
+            assert await translate(ctx, dut.iface, 0x004000) is None
+            assert await translate(ctx, dut.iface, 0x005000) == 0x105000
+
+            # Page 1 is remapped, and comes in again with page 0. It must
+            # replace the entry it already has, rather than page 5.
+            pt.ptes[1] = pte(0x201)
+            await flush_page(ctx, dut.csr_bus, 0)
+            assert await translate(ctx, dut.iface, 0x000123) == 0x100123
+            assert await translate(ctx, dut.iface, 0x001123) == 0x201123
+            assert await translate(ctx, dut.iface, 0x005000) == 0x105000
+
+        run_sim(sim)
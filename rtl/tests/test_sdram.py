@@ -0,0 +1,160 @@
+import random
+
+import pytest
+
+from amaranth.hdl import Fragment
+from amaranth_soc import wishbone
+
+from paaliaq.test import *
+from paaliaq.sdram import *
+from paaliaq.sim import SimPlatform, SDRAMModel
+
+
+# Minimum number of cycles between commands, for the SDRAM on the board
+# at 75MHz.
+tRP = 3
+tRCD = 3
+tRAS = 4
+tRRD = 2
+tRFC = 10
+tDPL = 2
+
+
+# Watches the commands the controller sends, and checks that they keep
+# to the SDRAM's timing.
+class TimingChecker:
+    def __init__(self, ios):
+        self._ios = ios
+        self.tick = 0
+        self.refreshes = []
+
+    async def process(self, ctx):
+        ios = self._ios
+        active = [False] * 4
+        activated = [None] * 4
+        precharged = [-100] * 4
+        written = [-100] * 4
+        last_activate = -100
+        last_refresh = -100
+
+        async for _, _, ras, cas, we, ba, a in ctx.tick().sample(
+                ios.ras, ios.cas, ios.we, ios.ba, ios.a):
+            self.tick += 1
+            tick = self.tick
+            if (ras, cas, we) == (0, 0, 0):
+                continue
+
+            assert tick - last_refresh >= tRFC, f"Command {tick - last_refresh} cycles after REFRESH"
+
+            match (ras, cas, we):
+                case (1, 0, 0): # ACTIVATE
+                    assert not active[ba], f"ACTIVATE of active bank {ba}"
+                    assert tick - precharged[ba] >= tRP, f"ACTIVATE {tick - precharged[ba]} cycles after PRECHARGE"
+                    assert tick - last_activate >= tRRD, f"ACTIVATE {tick - last_activate} cycles after ACTIVATE"
+                    active[ba] = True
+                    activated[ba] = tick
+                    last_activate = tick
+                case (1, 0, 1): # PRECHARGE
+                    banks = range(4) if a & (1 << 10) else [ba]
+                    for bank in banks:
+                        if active[bank]:
+                            assert tick - activated[bank] >= tRAS, f"PRECHARGE {tick - activated[bank]} cycles after ACTIVATE"
+                            assert tick - written[bank] >= tDPL, f"PRECHARGE {tick - written[bank]} cycles after WRITE"
+                            active[bank] = False
+                            precharged[bank] = tick
+                case (0, 1, _): # READ, WRITE
+                    assert active[ba], f"Access to idle bank {ba}"
+                    assert tick - activated[ba] >= tRCD, f"Access {tick - activated[ba]} cycles after ACTIVATE"
+                    if we:
+                        written[ba] = tick
+                case (1, 1, 0): # REFRESH
+                    assert not any(active), "REFRESH with banks active"
+                    for bank in range(4):
+                        assert tick - precharged[bank] >= tRP, f"REFRESH {tick - precharged[bank]} cycles after PRECHARGE"
+                    last_refresh = tick
+                    self.refreshes.append(tick)
+
+
+def address(bank, row, column):
+    return (row << 11) | (bank << 9) | column
+
+
+class TestSDRAMController:
+    def prepare(self, timeout):
+        platform = SimPlatform(soc_clk=75e6)
+        dut = SDRAMController(init_ns=1000)
+        sim = prepare_sim(Fragment.get(dut, platform), timeout=timeout, trace={})
+
+        sim.add_process(SDRAMModel(platform.sdram).process)
+        checker = TimingChecker(platform.sdram)
+        sim.add_process(checker.process)
+        return dut, sim, checker
+
+    def test_random(self):
+        dut, sim, checker = self.prepare(timeout=20000)
+
+        rng = random.Random(1)
+        accesses = {address(rng.randrange(4), rng.randrange(4), rng.randrange(1 << 9)): rng.randrange(1 << 16)
+                    for _ in range(500)}
+
+        @sim.add_testbench
+        async def tb(ctx):
+            for adr, data in accesses.items():
+                await wb_write(ctx, dut.wb_bus, adr, data)
+            for adr, data in accesses.items():
+                assert await wb_read(ctx, dut.wb_bus, adr) == data
+            assert len(checker.refreshes) >= 4
+
+        run_sim(sim)
+
+    def test_refresh_after_precharge(self):
+        dut, sim, checker = self.prepare(timeout=20000)
+
+        # Refreshes come due at a fixed interval. Every interval, a row
+        # gets opened, and a write to another row of the same bank
+        # precharges it at a different point ahead of the refresh.
+        @sim.add_testbench
+        async def tb(ctx):
+            # The first two are part of the initialization.
+            while len(checker.refreshes) < 4:
+                await ctx.tick()
+            interval = checker.refreshes[3] - checker.refreshes[2]
+
+            for lead in range(-2, 12):
+                refresh = checker.refreshes[-1] + interval
+                await wb_write(ctx, dut.wb_bus, address(0, 1, 0), lead)
+                while checker.tick < refresh - lead:
+                    await ctx.tick()
+                await wb_write(ctx, dut.wb_bus, address(0, 2, 0), lead)
+                while checker.tick < refresh + 20:
+                    await ctx.tick()
+
+            assert await wb_read(ctx, dut.wb_bus, address(0, 1, 0)) == 11
+            assert await wb_read(ctx, dut.wb_bus, address(0, 2, 0)) == 11
+
+        run_sim(sim)
+
+    def test_burst_read(self):
+        dut, sim, checker = self.prepare(timeout=5000)
+
+        @sim.add_testbench
+        async def tb(ctx):
+            for i in range(16):
+                await wb_write(ctx, dut.wb_bus, address(1, 5, 0x1f8) + i, 0x1000 + i)
+
+            bus = dut.wb_bus
+            ctx.set(bus.adr, address(1, 5, 0x1f8))
+            ctx.set(bus.sel, 0b11)
+            ctx.set(bus.cti, wishbone.CycleType.INCR_BURST)
+            ctx.set(bus.cyc, 1)
+            ctx.set(bus.stb, 1)
+            for i in range(16):
+                if i == 15:
+                    ctx.set(bus.cti, wishbone.CycleType.END_OF_BURST)
+                data, = await ctx.tick().sample(bus.dat_r).until(bus.ack)
+                assert data == 0x1000 + i
+                ctx.set(bus.adr, address(1, 5, 0x1f8) + i + 1)
+            ctx.set(bus.cyc, 0)
+            ctx.set(bus.stb, 0)
+
+        run_sim(sim)
@@ -0,0 +1,62 @@
+import pytest
+
+from paaliaq.test import *
+from paaliaq.testseq import *
+
+
+INIT_CODE = [0x18, 0xa9, 0x01]
+FINI_CODE = [0x60, 0x61]
+
+
+# Stands in for the CPU bridge, raising STB for one debug cycle and
+# returning the data the sequencer answered with.
+async def fetch(ctx, svc, addr):
+    ctx.set(svc.addr, addr)
+    ctx.set(svc.vpa, 1)
+    ctx.set(svc.vda, 1)
+    ctx.set(svc.rwb, 1)
+    ctx.set(svc.stb, 1)
+    data, = await ctx.tick().sample(svc.r_data).until(svc.ack)
+    ctx.set(svc.stb, 0)
+    return data
+
+
+class TestTestSequencer:
+    def test_back_to_back(self):
+        dut = TestSequencer()
+        sim = prepare_sim(dut, timeout=2000)
+
+        @sim.add_testbench
+        async def tb(ctx):
+            for i, byte in enumerate(INIT_CODE):
+                await wb_write(ctx, dut.wb_bus, 0x0000 + i, byte)
+            for i, byte in enumerate(FINI_CODE):
+                await wb_write(ctx, dut.wb_bus, 0x0200 + i, byte)
+
+            await csr_write(ctx, dut.csr_bus, 0x2, len(INIT_CODE), 2)
+            await csr_write(ctx, dut.csr_bus, 0x4, len(FINI_CODE), 2)
+            await csr_write(ctx, dut.csr_bus, 0x8, 0, 2)
+            await csr_write(ctx, dut.csr_bus, 0x0, 0b01)
+
+            assert await fetch(ctx, dut.svc, 0x000000) == 0x5c
+
+            for _ in range(2):
+                await csr_write(ctx, dut.csr_bus, 0x0, 0b11)
+
+                # Fetches follow each other as closely as the bridge allows,
+                # straight through the phase changes.
+                for byte in INIT_CODE:
+                    assert await fetch(ctx, dut.svc, 0x000000) == byte
+                assert await fetch(ctx, dut.svc, 0x000000) == 0xea
+                for byte in FINI_CODE:
+                    assert await fetch(ctx, dut.svc, 0x000000) == byte
+                assert await fetch(ctx, dut.svc, 0x000000) == 0x5c
+
+                control = await csr_read(ctx, dut.csr_bus, 0x0)
+                assert control & 0b1100 == 0b1000
+                assert await csr_read(ctx, dut.csr_bus, 0xa, 2) == len(INIT_CODE) + 1 + len(FINI_CODE)
+
+            # The host gets the code memory back once the sequencer is idle.
+            assert await wb_read(ctx, dut.wb_bus, 0x0000) == INIT_CODE[0]
+
+        run_sim(sim)
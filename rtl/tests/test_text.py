@@ -0,0 +1,247 @@
+import pytest
+
+from amaranth.hdl import Fragment
+
+from paaliaq.test import *
+from paaliaq.video import *
+from paaliaq.sim import SimPlatform
+
+
+# Mirrors the writes of a TextCommandProcessor into a model of the text
+# memory, and shows it the way the framebuffer would, starting at start_line.
+class ScreenModel:
+    def __init__(self, dut):
+        self.dut = dut
+        self.cells = ["."] * (128 * 48)
+
+    async def process(self, ctx):
+        fb_write = self.dut.fb_write
+        async for _, _, addr, en, data in ctx.tick().sample(fb_write.addr, fb_write.en, fb_write.data):
+            for i in range(TextWord.length):
+                if en & (1 << i):
+                    self.cells[addr * TextWord.length + i] = chr(data[i].char)
+
+    def rows(self, ctx):
+        start_line = ctx.get(self.dut.start_line)
+        return ["".join(self.cells[((start_line + y) % 48) * 128:][:128]) for y in range(48)]
+
+
+def put_char(char):
+    return {"opcode": Opcode.PUT_CHAR, "params": {"char": ord(char)}}
+
+
+def move_cursor(x, y):
+    return {"opcode": Opcode.MOVE_CURSOR_ABS, "params": {"abs_pos": {"x": x, "y": y, "set_x": 1, "set_y": 1}}}
+
+
+def scroll(delta):
+    return {"opcode": Opcode.SCROLL, "params": {"rel_pos": {"delta": delta}}}
+
+
+def erase(opcode, *, before, after):
+    return {"opcode": opcode, "params": {"erase": {"before": before, "after": after}}}
+
+
+def put_line(text):
+    return [put_char(c) for c in text + "\r\n"]
+
+
+class TestTextCommandProcessor:
+    def run(self, commands, check):
+        dut = TextCommandProcessor()
+        sim = prepare_sim(dut, timeout=20000, trace={})
+        screen = ScreenModel(dut)
+        sim.add_process(screen.process)
+
+        @sim.add_testbench
+        async def tb(ctx):
+            for command in commands:
+                await stream_put(ctx, dut.commands, command)
+            # Only taken once the processor is idle again, so every
+            # write of the commands above has been done.
+            await stream_put(ctx, dut.commands, {"opcode": Opcode.MOVE_CURSOR_REL})
+            await ctx.tick()
+            check(ctx, dut, screen.rows(ctx))
+
+        run_sim(sim, inspect.stack()[1].function)
+
+    def test_overflow(self):
+        commands = [{"opcode": Opcode.RESET}]
+        for i in range(50):
+            commands += put_line(f"line {i}")
+
+        def check(ctx, dut, rows):
+            assert ctx.get(dut.start_line) == 3
+            assert ctx.get(dut.cursor_y) == 47
+            for y in range(47):
+                assert rows[y] == f"line {y + 3}".ljust(128)
+            assert rows[47] == " " * 128
+
+        self.run(commands, check)
+
+    def test_scroll_ring(self):
+        commands = []
+        for i in range(48):
+            commands += [move_cursor(0, i), *map(put_char, f"line {i}")]
+        commands += [scroll(5), scroll(-7)]
+
+        def check(ctx, dut, rows):
+            assert ctx.get(dut.start_line) == 46
+            for y in range(7):
+                assert rows[y] == " " * 128
+            for y in range(7, 48):
+                assert rows[y] == f"line {y - 2}".ljust(128, ".")
+
+        self.run(commands, check)
+
+    def test_erase_display_after(self):
+        commands = [*put_line("top"), scroll(2)]
+        for i in range(48):
+            commands += [move_cursor(0, i), *map(put_char, "0123456789")]
+        commands += [move_cursor(5, 20), erase(Opcode.ERASE_DISPLAY, before=0, after=1)]
+
+        def check(ctx, dut, rows):
+            assert ctx.get(dut.start_line) == 2
+            for y in range(20):
+                assert rows[y] == "0123456789".ljust(128, ".")
+            assert rows[20] == "01234".ljust(128)
+            for y in range(21, 48):
+                assert rows[y] == " " * 128
+
+        self.run(commands, check)
+
+    def test_erase_display_before(self):
+        commands = [scroll(-1)]
+        for i in range(48):
+            commands += [move_cursor(0, i), *map(put_char, "0123456789")]
+        commands += [move_cursor(6, 30), erase(Opcode.ERASE_DISPLAY, before=1, after=0)]
+
+        def check(ctx, dut, rows):
+            assert ctx.get(dut.start_line) == 47
+            for y in range(30):
+                assert rows[y] == " " * 128
+            assert rows[30] == "       789".ljust(128, ".")
+            for y in range(31, 48):
+                assert rows[y] == "0123456789".ljust(128, ".")
+
+        self.run(commands, check)
+
+    def test_erase_line(self):
+        commands = []
+        for i in range(3):
+            commands += [move_cursor(0, i), *map(put_char, "0123456789")]
+        commands += [
+            move_cursor(3, 0), erase(Opcode.ERASE_LINE, before=1, after=0),
+            move_cursor(6, 1), erase(Opcode.ERASE_LINE, before=0, after=1),
+            move_cursor(2, 2), erase(Opcode.ERASE_LINE, before=0, after=0),
+        ]
+
+        def check(ctx, dut, rows):
+            assert rows[0] == "    456789".ljust(128, ".")
+            assert rows[1] == "012345".ljust(128)
+            assert rows[2] == "01 3456789".ljust(128, ".")
+            assert rows[3] == "." * 128
+
+        self.run(commands, check)
+
+
+# Answers the DMA engine's reads from a sparse memory, with an error for
+# anything outside of it.
+class DMAMemoryModel:
+    def __init__(self, bus, mem):
+        self._bus = bus
+        self.mem = mem
+
+    async def testbench(self, ctx):
+        bus = self._bus
+        async for _, _, cyc, stb, adr in ctx.tick().sample(bus.cyc, bus.stb, bus.adr):
+            ctx.set(bus.ack, 0)
+            ctx.set(bus.err, 0)
+            if cyc and stb:
+                if adr in self.mem:
+                    ctx.set(bus.dat_r, self.mem[adr])
+                    ctx.set(bus.ack, 1)
+                else:
+                    ctx.set(bus.err, 1)
+
+
+class TestTextAnsiTerminal:
+    def prepare(self, timeout, mem=None):
+        dut = TextAnsiTerminal()
+        sim = prepare_sim(Fragment.get(dut, SimPlatform(soc_clk=1e6)), timeout=timeout, trace={})
+        sim.add_clock(1e-6, domain="pixel")
+        sim.add_clock(0.2e-6, domain="tmds")
+        sim.add_testbench(DMAMemoryModel(dut.dma_bus, mem or {}).testbench, background=True)
+        return dut, sim
+
+    @staticmethod
+    def cell(ctx, dut, index):
+        return ctx.get(dut._text.data[index // TextWord.length])[index % TextWord.length]
+
+    def row(self, ctx, dut, y):
+        return "".join(chr(self.cell(ctx, dut, y * 128 + x).char) for x in range(128))
+
+    def test_window_and_dma(self):
+        mem = {0x800100 + i: byte for i, byte in enumerate(b"dma!")}
+        dut, sim = self.prepare(timeout=5000, mem=mem)
+
+        @sim.add_testbench
+        async def tb(ctx):
+            for char in b"abc":
+                await wb_write(ctx, dut.wb_bus, 0x00, char)
+            await csr_write(ctx, dut.csr_bus, 0x0, ord(" "))
+
+            await csr_write(ctx, dut.csr_bus, 0x4, 0x800100, 3)
+            await csr_write(ctx, dut.csr_bus, 0x8, len(mem), 2)
+            await csr_write(ctx, dut.csr_bus, 0xa, 0b1)
+            while (control := await csr_read(ctx, dut.csr_bus, 0xa)) & 0b10:
+                pass
+            assert control & 0b100 == 0
+
+            # A DMA that runs off the end of the buffer stops with an error.
+            await csr_write(ctx, dut.csr_bus, 0x8, len(mem) + 1, 2)
+            await csr_write(ctx, dut.csr_bus, 0xa, 0b1)
+            while (control := await csr_read(ctx, dut.csr_bus, 0xa)) & 0b10:
+                pass
+            assert control & 0b100
+
+            while await csr_read(ctx, dut.csr_bus, 0x2, 2) != 0:
+                pass
+            await ctx.tick().repeat(100)
+            assert self.row(ctx, dut, 0) == "abc dma!dma!".ljust(128)
+
+        run_sim(sim)
+
+    def test_cell_window(self):
+        dut, sim = self.prepare(timeout=10000)
+
+        text = "".join(f"line {i}\r\n" for i in range(30))
+        cells = {40 * 128 + i * 9: (ord("A") + i, i, 15 - i, 1 << (i % 8)) for i in range(14)}
+
+        # Keeps the command processor busy writing while the cells are
+        # accessed, so that the two take turns on the write port.
+        @sim.add_testbench
+        async def tb_chars(ctx):
+            for char in text:
+                await wb_write(ctx, dut.wb_bus, 0x00, ord(char))
+
+        @sim.add_testbench
+        async def tb_cells(ctx):
+            for cell, data in cells.items():
+                for i, byte in enumerate(data):
+                    await wb_write(ctx, dut.text_bus, cell * 4 + i, byte)
+                assert [await wb_read(ctx, dut.text_bus, cell * 4 + i) for i in range(4)] == list(data)
+
+            # Past the end of the display.
+            assert await wb_read(ctx, dut.text_bus, 128 * 48 * 4) == 0
+
+            while await csr_read(ctx, dut.csr_bus, 0x2, 2) != 0:
+                pass
+            await ctx.tick().repeat(200)
+
+            for y in range(30):
+                assert self.row(ctx, dut, y) == f"line {y}".ljust(128)
+            for cell, data in cells.items():
+                assert self.cell(ctx, dut, cell).as_value().value == int.from_bytes(bytes(data), "little")
+
+        run_sim(sim)
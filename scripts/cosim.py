@@ -0,0 +1,131 @@
+import ctypes
+
+
+# Drives the Verilator co-simulation of the SoC (see sim/cosim.hpp),
+# built as a shared library:
+#
+#   (cd rtl && python -m paaliaq.sim --verilog ../build/sim_top.v)
+#   cmake -S sim -B build/sim && cmake --build build/sim
+#
+# The clock and baud rates must match the ones the top was emitted for.
+class CoSim:
+    UART = 0
+    DEBUG_UART = 1
+
+    def __init__(self, lib_path, *, soc_clk=75e6, video=False,
+                 uart_baudrate=115200, debug_baudrate=2000000):
+        lib = self._lib = ctypes.CDLL(lib_path)
+        self.soc_clk = soc_clk
+
+        lib.cosim_new.argtypes = [ctypes.c_uint, ctypes.c_uint, ctypes.c_bool]
+        lib.cosim_new.restype = ctypes.c_void_p
+        lib.cosim_free.argtypes = [ctypes.c_void_p]
+        lib.cosim_step.argtypes = [ctypes.c_void_p, ctypes.c_uint64]
+        lib.cosim_cycles.argtypes = [ctypes.c_void_p]
+        lib.cosim_cycles.restype = ctypes.c_uint64
+        lib.cosim_cpu_cycles.argtypes = [ctypes.c_void_p]
+        lib.cosim_cpu_cycles.restype = ctypes.c_uint64
+        lib.cosim_peek.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_uint64)]
+        lib.cosim_poke.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint64]
+        lib.cosim_sdram_peek.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
+        lib.cosim_sdram_peek.restype = ctypes.c_uint16
+        lib.cosim_sdram_poke.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint16]
+        lib.cosim_trace_open.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint64, ctypes.c_uint64]
+        lib.cosim_trace_close.argtypes = [ctypes.c_void_p]
+        lib.cosim_uart_send.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t]
+        lib.cosim_uart_recv.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t]
+        lib.cosim_uart_recv.restype = ctypes.c_size_t
+        lib.cosim_uart_wait.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint64]
+        lib.cosim_uart_wait.restype = ctypes.c_uint64
+
+        self._sim = lib.cosim_new(int(soc_clk // uart_baudrate), int(soc_clk // debug_baudrate), video)
+
+    def close(self):
+        if self._sim is not None:
+            self._lib.cosim_free(self._sim)
+            self._sim = None
+
+    def __del__(self):
+        self.close()
+
+    def step(self, cycles=1):
+        self._lib.cosim_step(self._sim, cycles)
+
+    @property
+    def cycles(self):
+        return self._lib.cosim_cycles(self._sim)
+
+    @property
+    def cpu_cycles(self):
+        return self._lib.cosim_cpu_cycles(self._sim)
+
+    # Top level ports, by name (e.g. "cpu_addr_lo", see VerilatorTop).
+    def peek(self, name):
+        value = ctypes.c_uint64()
+        if not self._lib.cosim_peek(self._sim, name.encode(), ctypes.byref(value)):
+            raise KeyError(name)
+        return value.value
+
+    def poke(self, name, value):
+        if not self._lib.cosim_poke(self._sim, name.encode(), value):
+            raise KeyError(name)
+
+    # Backdoor into the SDRAM model, by 16-bit word.
+    def sdram_peek(self, addr):
+        return self._lib.cosim_sdram_peek(self._sim, addr)
+
+    def sdram_poke(self, addr, value):
+        self._lib.cosim_sdram_poke(self._sim, addr, value)
+
+    # Writes a VCD of the given window of cycles (up to, but excluding
+    # end). Nothing is written outside of it.
+    def trace(self, path, start=0, end=2**64 - 1):
+        self._lib.cosim_trace_open(self._sim, path.encode(), start, end)
+
+    def trace_close(self):
+        self._lib.cosim_trace_close(self._sim)
+
+    def uart_send(self, port, data):
+        self._lib.cosim_uart_send(self._sim, port, bytes(data), len(data))
+
+    def uart_recv(self, port, length):
+        buf = ctypes.create_string_buffer(length)
+        n = self._lib.cosim_uart_recv(self._sim, port, buf, length)
+        return buf.raw[:n]
+
+    # Runs until length bytes have been received, or for max_cycles.
+    def uart_wait(self, port, length, max_cycles):
+        return self._lib.cosim_uart_wait(self._sim, port, length, max_cycles)
+
+    def serial(self, port=DEBUG_UART, timeout=None):
+        return CoSimSerial(self, port, timeout)
+
+
+# Stands in for a serial.Serial, so that UARTDebugHost can talk to the
+# simulated debug bridge. The simulation runs while waiting for data,
+# and the timeout is in simulated time.
+class CoSimSerial:
+    # Cycles to run for at a time when there's no timeout.
+    WAIT_CHUNK = 1000000
+
+    def __init__(self, sim, port, timeout=None):
+        self._sim = sim
+        self._port = port
+        self.timeout = timeout
+
+    def write(self, data):
+        self._sim.uart_send(self._port, data)
+        return len(data)
+
+    def read(self, length):
+        data = bytearray()
+        waited = 0
+        limit = None if self.timeout is None else int(self.timeout * self._sim.soc_clk)
+
+        while True:
+            data += self._sim.uart_recv(self._port, length - len(data))
+            if len(data) == length or (limit is not None and waited >= limit):
+                return bytes(data)
+
+            chunk = self.WAIT_CHUNK if limit is None else limit - waited
+            waited += self._sim.uart_wait(self._port, length - len(data), chunk)
@@ -4,36 +4,105 @@ import serial
 from contextlib import contextmanager
 
 
+# Host side of the UART debug bridge (see rtl/paaliaq/debug.py).
+#
+# Commands are queued, and sent in one go when a response is needed
+# (or when flush() is called). Writes don't have responses, so they're
+# sent out at the end of a batched() block, or right away outside of
+# one. Reads are always sent together with the writes queued before
+# them, and the responses are read back in bulk.
 class UARTDebugHost:
-    def __init__(self, port, baud=2000000):
-        self._ser = serial.Serial(port, baud)
+    # Length limit of a single block command.
+    MAX_BLOCK_LEN = 0xFFFF
+    # Number of read commands sent in one go. The bridge only buffers
+    # 512 bytes of requests while it's busy sending responses.
+    MAX_READS_IN_FLIGHT = 64
+
+    # With a timeout (in seconds), reads that don't get a response in
+    # time fail instead of hanging forever. Instead of the name of a
+    # serial port, port can be something that behaves like one (e.g. a
+    # CoSimSerial, see cosim.py).
+    def __init__(self, port, baud=2000000, timeout=None):
+        if isinstance(port, str):
+            self._ser = serial.Serial(port, baud, timeout=timeout)
+        else:
+            self._ser = port
+        self._queue = bytearray()
+        self._batch_depth = 0
 
-    def _cmd(self, op, addr, wr_data):
-        self._ser.write(bytes([
+    def _queue_cmd(self, op, addr, length):
+        self._queue += bytes([
             ord(op),
             (addr >> 0)  & 0xFF,
             (addr >> 8)  & 0xFF,
             (addr >> 16) & 0xFF,
-            wr_data,
-        ]))
+            (length >> 0) & 0xFF,
+            (length >> 8) & 0xFF,
+        ])
+
+    def flush(self):
+        if self._queue:
+            self._ser.write(self._queue)
+            self._queue.clear()
 
-        return self._ser.read()[0]
+    @contextmanager
+    def batched(self):
+        self._batch_depth += 1
+        try:
+            yield None
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.flush()
+
+    def peek_block(self, address, length):
+        for offset in range(0, length, self.MAX_BLOCK_LEN):
+            n = min(length - offset, self.MAX_BLOCK_LEN)
+            self._queue_cmd('R', address + offset, n)
+
+        self.flush()
+
+        data = self._ser.read(length)
+        assert len(data) == length
+        return data
+
+    # Read the same (multi-byte) register count times, e.g. to drain
+    # a FIFO-like register.
+    def peek_repeated(self, address, width, count):
+        out = bytearray()
+        for first in range(0, count, self.MAX_READS_IN_FLIGHT):
+            n = min(count - first, self.MAX_READS_IN_FLIGHT)
+            for _ in range(n):
+                self._queue_cmd('R', address, width)
+
+            self.flush()
+
+            data = self._ser.read(n * width)
+            assert len(data) == n * width
+            out += data
+        return bytes(out)
+
+    def poke_block(self, address, data):
+        data = memoryview(data).cast('B')
+        for offset in range(0, len(data), self.MAX_BLOCK_LEN):
+            chunk = data[offset:offset + self.MAX_BLOCK_LEN]
+            self._queue_cmd('W', address + offset, len(chunk))
+            self._queue += chunk
+
+        if not self._batch_depth:
+            self.flush()
 
     def peek8(self, address):
-        return self._cmd('r', address, 0)
+        return self.peek_block(address, 1)[0]
 
     def poke8(self, address, value):
-        self._cmd('w', address, value)
+        self.poke_block(address, bytes([value]))
 
     def _peek_n(self, address, width):
-        v = 0
-        for i in range(width):
-            v |= self.peek8(address + i) << (i * 8)
-        return v
+        return int.from_bytes(self.peek_block(address, width), 'little')
 
     def _poke_n(self, address, data, width):
-        for i in range(width):
-            self.poke8(address + i, (data >> (i * 8)) & 0xFF)
+        self.poke_block(address, (data & ((1 << (width * 8)) - 1)).to_bytes(width, 'little'))
 
     def peek16(self, address): return self._peek_n(address, 2)
     def poke16(self, address, data): self._poke_n(address, data, 2)
@@ -50,11 +119,33 @@ class UARTDebugHost:
     def trace_disable(self):
         self.poke8(0x10408, 0x00)
 
-    def tracee_ready(self):
-        v = self.peek8(0x10408)
-        if (v & 0x30) != 0:
+    @staticmethod
+    def _is_tracee_ready(config):
+        if (config & 0x30) != 0:
             return False
-        return (v & 0x08) != 0
+        return (config & 0x08) != 0
+
+    def tracee_ready(self):
+        return self._is_tracee_ready(self.peek8(0x10408))
+
+    # Wait for the CPU to halt, and read back the debug registers from
+    # DbgConfig (0x10408) up to DbgPAddr (0x10414) in one go.
+    def _wait_tracee(self, length):
+        while True:
+            regs = self.peek_block(0x10408, length)
+            if self._is_tracee_ready(regs[0]):
+                return regs
+
+    @staticmethod
+    def _decode_bus(regs):
+        bus_misc = regs[0x1]
+        return (
+            int.from_bytes(regs[0x4:0x7], 'little'),
+            bus_misc & (1 << 0) != 0,
+            bus_misc & (1 << 1) != 0,
+            bus_misc & (1 << 2) != 0,
+            bus_misc & (1 << 3) != 0,
+        )
 
     @contextmanager
     def tracing(self):
@@ -64,26 +155,8 @@ class UARTDebugHost:
         finally:
             self.trace_disable()
 
-    def trace_step(self):
-        while not self.tracee_ready():
-            pass
-
-        va = self.peek24(0x1040c)
-
-        bus_misc = self.peek8(0x10409)
-        vpa, vda, vpb, rwb = (
-            bus_misc & (1 << 0) != 0,
-            bus_misc & (1 << 1) != 0,
-            bus_misc & (1 << 2) != 0,
-            bus_misc & (1 << 3) != 0,
-        )
-
-        pa = self.peek24(0x10414) if vpa or vda else 0
-
-        self.poke8(0x10408, 0x0c)
-
-        data = self.peek8(0x10411 if rwb else 0x10410)
-
+    @staticmethod
+    def _format_cycle(va, pa, vpa, vda, vpb, rwb, data):
         pa_str = f"{pa:06x}" if vpa or vda else "??????"
         data_str = f"{data:02x}" if vpa or vda else "??"
         vpa_str = "P" if vpa else "-"
@@ -91,7 +164,70 @@ class UARTDebugHost:
         vpb_str = "-" if vpb else "V"
         rwb_str = ("R" if rwb else "W") if vpa or vda else "-"
 
-        print(f'{va:06x} {pa_str} {vpa_str}{vda_str}{vpb_str}{rwb_str} {data_str}')
+        return f'{va:06x} {pa_str} {vpa_str}{vda_str}{vpb_str}{rwb_str} {data_str}'
+
+    # Bus trace buffer. Starts recording every CPU cycle, and stops
+    # post_count cycles after any of the given trigger conditions,
+    # or when trace_buffer_stop is called.
+    def trace_buffer_start(self, *, trig_addr=None, trig_ifetch=False, trig_abort=False, post_count=0):
+        with self.batched():
+            self.trace_buffer_stop()
+            if trig_addr is not None:
+                self.poke24(0x1041c, trig_addr)
+            self.poke16(0x10420, post_count)
+            self.poke8(0x10418, (
+                0x01
+                | (0x04 if trig_addr is not None else 0)
+                | (0x08 if trig_ifetch else 0)
+                | (0x10 if trig_abort else 0)
+            ))
+
+    def trace_buffer_stop(self):
+        self.poke8(0x10418, 0x02)
+
+    def trace_buffer_running(self):
+        return (self.peek8(0x10418) & 0x01) != 0
+
+    def trace_buffer_triggered(self):
+        return (self.peek8(0x10418) & 0x20) != 0
+
+    # Returns the recorded cycles, oldest first, as tuples of
+    # (vaddr, paddr, vpa, vda, vpb, rwb, abort, data).
+    def trace_buffer_read(self):
+        count = self.peek16(0x10422)
+        raw = self.peek_repeated(0x10428, 8, count)
+
+        entries = []
+        for i in range(count):
+            v = int.from_bytes(raw[i * 8:(i + 1) * 8], 'little')
+            entries.append((
+                (v >> 0)  & 0xFFFFFF,
+                (v >> 24) & 0xFFFFFF,
+                (v >> 56) & 1 != 0,
+                (v >> 57) & 1 != 0,
+                (v >> 58) & 1 != 0,
+                (v >> 59) & 1 != 0,
+                (v >> 60) & 1 != 0,
+                (v >> 48) & 0xFF,
+            ))
+        return entries
+
+    def trace_buffer_dump(self):
+        for va, pa, vpa, vda, vpb, rwb, abort, data in self.trace_buffer_read():
+            abort_str = " ABORT" if abort else ""
+            print(self._format_cycle(va, pa, vpa, vda, vpb, rwb, data) + abort_str)
+
+    def trace_step(self):
+        regs = self._wait_tracee(0xf)
+        va, vpa, vda, vpb, rwb = self._decode_bus(regs)
+
+        pa = int.from_bytes(regs[0xc:0xf], 'little') if vpa or vda else 0
+
+        with self.batched():
+            self.poke8(0x10408, 0x0c)
+            data = self.peek8(0x10411 if rwb else 0x10410)
+
+        print(self._format_cycle(va, pa, vpa, vda, vpb, rwb, data))
 
     def debug_enable(self):
         self.poke8(0x10408, 0x06)
@@ -100,32 +236,24 @@ class UARTDebugHost:
             self.poke8(0x10408, 0x0c)
 
     def debug_step(self, ctrl):
-        while not self.tracee_ready():
-            pass
-
-        va = self.peek24(0x1040c)
-
-        bus_misc = self.peek8(0x10409)
-        vpa, vda, vpb, rwb = (
-            bus_misc & (1 << 0) != 0,
-            bus_misc & (1 << 1) != 0,
-            bus_misc & (1 << 2) != 0,
-            bus_misc & (1 << 3) != 0,
-        )
+        regs = self._wait_tracee(0x7)
+        va, vpa, vda, vpb, rwb = self._decode_bus(regs)
 
-        self.poke8(0x10408, 0x0c)
+        # Everything done during this step goes out in one write.
+        with self.batched():
+            self.poke8(0x10408, 0x0c)
 
-        done, resume = ctrl.should_resume_after(va, vpa, vda, vpb, rwb)
-        if done and resume:
-            # Clear dbg_enable (RW1C)
-            self.poke8(0x10408, 0x0d)
+            done, resume = ctrl.should_resume_after(va, vpa, vda, vpb, rwb)
+            if done and resume:
+                # Clear dbg_enable (RW1C)
+                self.poke8(0x10408, 0x0d)
 
-        if not (vda or vpa):
-            ctrl.noop(va, vpb, rwb, self.peek8(0x10410) if not rwb else None)
-        elif rwb:
-            self.poke8(0x1040a, ctrl.read(va, vpa, vda, vpb))
-        else:
-            ctrl.write(va, vpa, vda, vpb, self.peek8(0x10410))
+            if not (vda or vpa):
+                ctrl.noop(va, vpb, rwb, self.peek8(0x10410) if not rwb else None)
+            elif rwb:
+                self.poke8(0x1040a, ctrl.read(va, vpa, vda, vpb))
+            else:
+                ctrl.write(va, vpa, vda, vpb, self.peek8(0x10410))
 
         return done
 
@@ -133,3 +261,62 @@ class UARTDebugHost:
         self.debug_enable()
         while not self.debug_step(ctrl):
             pass
+
+    # Hardware test sequencer (see rtl/paaliaq/testseq.py). Once it's
+    # enabled, it services all debug cycles instead of debug_step, and
+    # the CPU spins in a JMP $000000 loop between tests.
+    TEST_SEQ_MAX_CODE = 0x200
+    TEST_SEQ_MAX_MEM = 128
+
+    def test_seq_enable(self):
+        self.poke8(0x10b00, 0x01)
+        self.debug_enable()
+        self.trace_disable()
+
+    # Runs a test, made up of init code, the test itself, running
+    # against the given memory contents for the given number of cycles,
+    # and fini code. Returns every cycle of it as tuples of
+    # (vaddr, vpa, vda, vpb, rwb, data), or None if the sequencer ran
+    # out of space for the log or the memory image.
+    def test_seq_run(self, init_code, fini_code, mem, cycles):
+        assert len(init_code) <= self.TEST_SEQ_MAX_CODE
+        assert len(fini_code) <= self.TEST_SEQ_MAX_CODE
+        assert len(mem) <= self.TEST_SEQ_MAX_MEM
+
+        image = bytearray()
+        for addr, value in mem.items():
+            image += addr.to_bytes(3, 'little') + bytes([value])
+
+        # Everything goes out in one write.
+        with self.batched():
+            self.poke_block(0x020000, bytes(init_code))
+            self.poke_block(0x020200, bytes(fini_code))
+            if image:
+                self.poke_block(0x020400, image)
+            self.poke16(0x10b02, len(init_code))
+            self.poke16(0x10b04, len(fini_code))
+            self.poke8(0x10b06, len(mem))
+            self.poke16(0x10b08, cycles)
+            self.poke8(0x10b00, 0x03)
+
+        while (status := self.peek8(0x10b00)) & 0x04:
+            pass
+
+        if status & 0x10:
+            return None
+
+        count = self.peek16(0x10b0a)
+        raw = self.peek_block(0x021000, count * 8)
+
+        entries = []
+        for i in range(count):
+            v = int.from_bytes(raw[i * 8:(i + 1) * 8], 'little')
+            entries.append((
+                (v >> 0)  & 0xFFFFFF,
+                (v >> 32) & 1 != 0,
+                (v >> 33) & 1 != 0,
+                (v >> 34) & 1 != 0,
+                (v >> 35) & 1 != 0,
+                (v >> 24) & 0xFF,
+            ))
+        return entries
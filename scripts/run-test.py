@@ -1,16 +1,24 @@
 import argparse
+import io
 import itertools
 import json
+import mmap
+import multiprocessing
+import os
+import queue
 import random
+import struct
 import sys
 import time
 import tqdm
 
+from cosim import CoSim
 from dataclasses import dataclass
 from debug import UARTDebugHost
 from functools import cache
 from pathlib import Path
 from pprint import pprint
+from w65c816 import W65C816
 
 
 SPINNER_CHARS = ["|", "/", "-", "\\"]
@@ -32,7 +40,7 @@ def log(msg, *, show=None):
         print(msg)
 
 
-@dataclass
+@dataclass(slots=True)
 class MachineState:
     emul: bool = False
     a: int = 0
@@ -46,7 +54,7 @@ class MachineState:
     dbr: int = 0
 
 
-@dataclass
+@dataclass(slots=True)
 class TestCase:
     name: str
 
@@ -123,8 +131,157 @@ def compare_result(test, actual_mem, actual_cycles, actual_state):
     return success
 
 
+# Binary cache of a test file
+# ---
+# Parsing a whole JSON test file takes a long time, and a lot of
+# memory, so each one is converted once into a binary file next to
+# it, which is then memory-mapped, and only the tests that are
+# actually used get decoded.
+#
+# Layout (little endian):
+#   header   magic, number of tests, size and mtime of the JSON file
+#   index    offset of each test's record, from the start of the file
+#   records  name (length-prefixed), initial and final state, number
+#            of initial RAM bytes, final RAM bytes and cycles, followed
+#            by those
+#
+# The cache is rebuilt whenever the JSON file changes.
+CACHE_MAGIC = b"P816TST1"
+CACHE_HEADER = struct.Struct("<8sIQQ")
+CACHE_OFFSET = struct.Struct("<I")
+CACHE_STATE = struct.Struct("<?HHHHHBHBB")
+CACHE_COUNTS = struct.Struct("<HHH")
+CACHE_RAM = struct.Struct("<IB")
+# Data of 0xFFFF means the data bus value is unknown.
+CACHE_CYCLE = struct.Struct("<IH4s")
+
+
+def _cache_path(test_file):
+    return test_file.parent / ".cache" / (test_file.stem + ".bin")
+
+
+def _encode_state(state):
+    return CACHE_STATE.pack(
+        state["e"] > 0, state["a"], state["x"], state["y"], state["s"],
+        state["d"], state["p"], state["pc"], state["pbr"], state["dbr"],
+    )
+
+
+def _encode_test(test):
+    name = test["name"].encode()
+    record = bytearray([len(name)]) + name
+    record += _encode_state(test["initial"])
+    record += _encode_state(test["final"])
+    record += CACHE_COUNTS.pack(len(test["initial"]["ram"]), len(test["final"]["ram"]), len(test["cycles"]))
+    for addr, value in test["initial"]["ram"] + test["final"]["ram"]:
+        record += CACHE_RAM.pack(addr, value)
+    for addr, value, ctrl in test["cycles"]:
+        # Skip emxl in bus control since they're not wired up...
+        record += CACHE_CYCLE.pack(addr, 0xFFFF if value is None else value, ctrl[:4].encode())
+    return record
+
+
+def build_test_cache(test_file, cache_file):
+    stat = test_file.stat()
+    with open(test_file, "r") as f:
+        data = json.load(f)
+
+    records = [_encode_test(test) for test in data]
+
+    offset = CACHE_HEADER.size + CACHE_OFFSET.size * len(records)
+    index = bytearray()
+    for record in records:
+        index += CACHE_OFFSET.pack(offset)
+        offset += len(record)
+
+    # Written under a temporary name first, so that a concurrent (or
+    # interrupted) run never sees half of a cache file.
+    cache_file.parent.mkdir(exist_ok=True)
+    tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_file, "wb") as f:
+        f.write(CACHE_HEADER.pack(CACHE_MAGIC, len(records), stat.st_size, stat.st_mtime_ns))
+        f.write(index)
+        for record in records:
+            f.write(record)
+    os.replace(tmp_file, cache_file)
+
+
+class TestFile:
+    def __init__(self, test_file):
+        cache_file = _cache_path(test_file)
+        stat = test_file.stat()
+
+        if not self._is_valid(cache_file, stat):
+            log(f"Building test cache {cache_file}")
+            build_test_cache(test_file, cache_file)
+
+        with open(cache_file, "rb") as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _, self._count, _, _ = CACHE_HEADER.unpack_from(self._buf, 0)
+
+    @staticmethod
+    def _is_valid(cache_file, stat):
+        try:
+            with open(cache_file, "rb") as f:
+                header = f.read(CACHE_HEADER.size)
+        except FileNotFoundError:
+            return False
+        if len(header) != CACHE_HEADER.size:
+            return False
+        magic, _, size, mtime_ns = CACHE_HEADER.unpack(header)
+        return magic == CACHE_MAGIC and size == stat.st_size and mtime_ns == stat.st_mtime_ns
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+
+        buf = self._buf
+        (pos,) = CACHE_OFFSET.unpack_from(buf, CACHE_HEADER.size + CACHE_OFFSET.size * index)
+
+        name_len = buf[pos]
+        name = buf[pos + 1:pos + 1 + name_len].decode()
+        pos += 1 + name_len
+
+        initial_state = MachineState(*CACHE_STATE.unpack_from(buf, pos))
+        pos += CACHE_STATE.size
+        final_state = MachineState(*CACHE_STATE.unpack_from(buf, pos))
+        pos += CACHE_STATE.size
+
+        n_initial, n_final, n_cycles = CACHE_COUNTS.unpack_from(buf, pos)
+        pos += CACHE_COUNTS.size
+
+        ram = list(CACHE_RAM.iter_unpack(buf[pos:pos + CACHE_RAM.size * (n_initial + n_final)]))
+        pos += CACHE_RAM.size * (n_initial + n_final)
+
+        cycles = [
+            [addr, None if value == 0xFFFF else value, ctrl.decode()]
+            for addr, value, ctrl in CACHE_CYCLE.iter_unpack(buf[pos:pos + CACHE_CYCLE.size * n_cycles])
+        ]
+
+        return TestCase(
+            name=name,
+            initial_state=initial_state,
+            initial_mem=dict(ram[:n_initial]),
+            final_state=final_state,
+            final_mem=dict(ram[n_initial:]),
+            cycles=cycles,
+        )
+
+
 @cache
 def load_test_file(test_file):
+    try:
+        return TestFile(test_file)
+    except OSError as e:
+        # E.g. a read-only test directory, fall back to parsing the
+        # whole file.
+        log(f"Can't use test cache for {test_file}: {e}", show=True)
+
     with open(test_file, "r") as f:
         data = json.load(f)
 
@@ -365,19 +522,60 @@ class FiniDriver(MemorylessDriver):
         self.state.dbr = w["dbr"]
 
 
-def run_test(client, test):
-    log(f"Running test \"{test.name}\"", show=not quiet_run)
+# Feeds a bus log captured by the hardware test sequencer through the
+# drivers, in the same way debug_with would have while servicing the
+# cycles itself. Returns whether the log covers all of the drivers.
+def replay_bus_log(bus_log, ctrls):
+    ctrls = iter(ctrls)
+    ctrl = next(ctrls)
 
-    # Prepare halt loop for after test is over
-    client.poke8(0x000000, 0x5C)
-    client.poke8(0x000001, 0x00)
-    client.poke8(0x000002, 0x00)
-    client.poke8(0x000003, 0x00)
+    for va, vpa, vda, vpb, rwb, data in bus_log:
+        if ctrl is None:
+            return False
+
+        done, _ = ctrl.should_resume_after(va, vpa, vda, vpb, rwb)
+
+        if not (vda or vpa):
+            ctrl.noop(va, vpb, rwb, data if not rwb else None)
+        elif rwb:
+            value = ctrl.read(va, vpa, vda, vpb)
+            if value != data:
+                log(f"  Sequencer returned {data:02x} for read of ${va:06x}, expected {value:02x}", show=True)
+                return False
+        else:
+            ctrl.write(va, vpa, vda, vpb, data)
+
+        if done:
+            ctrl = next(ctrls, None)
+
+    return ctrl is None
+
+
+def run_test(client, test, hw_seq=False):
+    log(f"Running test \"{test.name}\"", show=not quiet_run)
 
     init_ctrl = InitDriver(test.initial_state)
     test_ctrl = MemoryDriver(dict(test.initial_mem), len(test.cycles))
     fini_ctrl = FiniDriver()
 
+    if hw_seq:
+        start_ts = time.monotonic()
+        bus_log = client.test_seq_run(init_ctrl.read_data, fini_ctrl.read_data,
+                                      test.initial_mem, len(test.cycles))
+        end_ts = time.monotonic()
+
+        if bus_log is None:
+            log(f"Test \"{test.name}\" doesn't fit in the test sequencer, rerun without --hw-seq", show=True)
+            return False
+        if not replay_bus_log(bus_log, [init_ctrl, test_ctrl, fini_ctrl]):
+            log(f"Test \"{test.name}\" has an incomplete bus log", show=True)
+            return False
+
+        return _check_result(test, test_ctrl, fini_ctrl, end_ts - start_ts)
+
+    # Prepare halt loop for after test is over
+    client.poke_block(0x000000, bytes([0x5C, 0x00, 0x00, 0x00]))
+
     start_ts = time.monotonic()
 
     def _step_with_log(ctrl, msg):
@@ -395,23 +593,249 @@ def run_test(client, test):
 
     end_ts = time.monotonic()
 
+    return _check_result(test, test_ctrl, fini_ctrl, end_ts - start_ts)
+
+
+# Bus for the CPU model, which hands each cycle to the drivers in turn,
+# in the same way debug_with does for the hardware.
+class ModelBus:
+    class Done(Exception):
+        pass
+
+    def __init__(self, ctrls):
+        self._ctrls = iter(ctrls)
+        self._ctrl = next(self._ctrls)
+        self._done = False
+
+    def _begin(self, addr, vpa, vda, vpb, rwb):
+        if self._ctrl is None:
+            raise ModelBus.Done()
+        self._done, _ = self._ctrl.should_resume_after(addr, vpa, vda, vpb, rwb)
+        return self._ctrl
+
+    def _end(self):
+        if self._done:
+            self._ctrl = next(self._ctrls, None)
+
+    def noop(self, addr, vpb, rwb, value):
+        self._begin(addr, False, False, vpb, rwb).noop(addr, vpb, rwb, value)
+        self._end()
+
+    def read(self, addr, vpa, vda, vpb):
+        value = self._begin(addr, vpa, vda, vpb, True).read(addr, vpa, vda, vpb)
+        self._end()
+        return value
+
+    def write(self, addr, vpa, vda, vpb, value):
+        self._begin(addr, vpa, vda, vpb, False).write(addr, vpa, vda, vpb, value)
+        self._end()
+
+
+# Upper bound on the cycles of one test run on the CPU model, including
+# setting up and collecting the state, so that WAI or STP can't hang it.
+MODEL_MAX_CYCLES = 10000
+
+
+def run_test_model(test):
+    log(f"Running test \"{test.name}\" on the CPU model", show=not quiet_run)
+
+    init_ctrl = InitDriver(test.initial_state)
+    test_ctrl = MemoryDriver(dict(test.initial_mem), len(test.cycles))
+    fini_ctrl = FiniDriver()
+
+    cpu = W65C816(ModelBus([init_ctrl, test_ctrl, fini_ctrl]))
+
+    start_ts = time.monotonic()
+    try:
+        while cpu.cycles < MODEL_MAX_CYCLES:
+            cpu.step()
+    except ModelBus.Done:
+        pass
+    else:
+        log(f"Test \"{test.name}\" didn't finish in {MODEL_MAX_CYCLES} cycles", show=True)
+        return False
+    end_ts = time.monotonic()
+
+    return _check_result(test, test_ctrl, fini_ctrl, end_ts - start_ts)
+
+
+def _check_result(test, test_ctrl, fini_ctrl, duration):
     success = compare_result(test, test_ctrl.mem, test_ctrl.bus_activity[:-1], fini_ctrl.state)
 
     log(
-        f"Test \"{test.name}\" {'PASS' if success else 'FAIL'}, in {end_ts - start_ts:.2f} seconds",
+        f"Test \"{test.name}\" {'PASS' if success else 'FAIL'}, in {duration:.2f} seconds",
         show=not quiet_run,
     )
 
     return success
 
 
-def main(port, baud, tests):
-    client = UARTDebugHost(port, baud)
+# Runs tests taken from task_queue on one board, until it gets None.
+# Each test's log is captured and sent back together with its result,
+# so the parent can merge the logs of all boards. If anything goes
+# wrong with the board, the test is handed back, and the worker quits.
+def board_worker(port, baud, hw_seq, timeout, task_queue, result_queue):
+    global logfile, verbose, verbose_cycles, quiet_run
+
+    # Output of several boards would be interleaved, the parent prints
+    # it instead.
+    verbose = False
+    verbose_cycles = False
+    quiet_run = True
+
+    try:
+        client = UARTDebugHost(port, baud, timeout)
+        if hw_seq:
+            client.test_seq_enable()
+    except Exception as e:
+        result_queue.put(("failed", port, None, repr(e)))
+        return
+
+    while (test := task_queue.get()) is not None:
+        # So that the parent knows which test was lost if we die.
+        result_queue.put(("started", port, test, None))
+        logfile = io.StringIO()
+        try:
+            success = run_test(client, test, hw_seq)
+        except Exception as e:
+            result_queue.put(("failed", port, test, repr(e)))
+            return
+        result_queue.put(("result", port, test, (success, logfile.getvalue())))
+
+
+def run_tests_parallel(ports, baud, tests, hw_seq, timeout):
+    # Every board takes the next test as soon as it's done with the
+    # previous one, so slow boards (or slow tests) don't hold up the
+    # others.
+    ctx = multiprocessing.get_context("fork")
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+
+    for test in tests:
+        task_queue.put(test)
+
+    workers = {
+        port: ctx.Process(
+            target=board_worker,
+            args=(port, baud, hw_seq, timeout, task_queue, result_queue),
+            daemon=True,
+        )
+        for port in ports
+    }
+    for worker in workers.values():
+        worker.start()
 
     results = {}
+    per_board = {port: 0 for port in ports}
+    # A test which took down a board is retried once on another board,
+    # and counted as failed if that one goes down too.
+    retried = set()
+    remaining = len(tests)
+    alive = len(ports)
+    running = {}
+    dead = set()
+
+    progress = tqdm.tqdm(total=remaining) if quiet_run else None
+
+    while remaining and alive:
+        try:
+            kind, port, test, info = result_queue.get(timeout=1)
+        except queue.Empty:
+            # A worker that crashed or got killed doesn't report back,
+            # the test it was running is failed instead of waited on.
+            for port, worker in workers.items():
+                if port in dead or worker.is_alive():
+                    continue
+                dead.add(port)
+                alive -= 1
+                log(f"Board worker on {port} died (exit code {worker.exitcode}), no longer using it", show=True)
+                if (test := running.pop(port, None)) is not None:
+                    log(f"Test \"{test.name}\" was running on it, counting it as failed", show=True)
+                    results[test.name] = False
+                    remaining -= 1
+            continue
+
+        # Anything still queued from a worker found dead is stale, its
+        # test was already counted.
+        if port in dead:
+            continue
+
+        if kind == "started":
+            running[port] = test
+            continue
+
+        running.pop(port, None)
+
+        if kind == "failed":
+            dead.add(port)
+            alive -= 1
+            log(f"Board on {port} failed, no longer using it: {info}", show=True)
+            if test is None:
+                continue
+            if test.name in retried:
+                log(f"Test \"{test.name}\" failed on two boards, giving up on it", show=True)
+                results[test.name] = False
+                remaining -= 1
+            else:
+                retried.add(test.name)
+                task_queue.put(test)
+            continue
+
+        success, test_log = info
+        logfile.write(test_log)
+        logfile.flush()
+        log(f"  (ran on {port})", show=False)
+        if verbose or verbose_cycles:
+            print(test_log, end="")
+        elif not quiet_run:
+            print(f"Test \"{test.name}\" {'PASS' if success else 'FAIL'} on {port}")
+
+        results[test.name] = success
+        per_board[port] += 1
+        remaining -= 1
+        if progress:
+            progress.update()
+
+    if progress:
+        progress.close()
+
+    if remaining:
+        log(f"All boards failed, {remaining} tests were not run.", show=True)
+
+    for worker in workers.values():
+        task_queue.put(None)
+    for worker in workers.values():
+        worker.join()
+
+    log("Tests run per board:", show=True)
+    for port, count in per_board.items():
+        log(f"  {port}: {count}", show=True)
+
+    return results
+
+
+def main(ports, baud, tests, hw_seq=False, timeout=None, model=False, sim=None, sim_clk=75e6):
+    if model:
+        results = {}
+
+        for test in (tqdm.tqdm(tests) if quiet_run else tests):
+            results[test.name] = run_test_model(test)
+    elif len(ports) > 1 and not sim:
+        results = run_tests_parallel(ports, baud, tests, hw_seq, timeout)
+    else:
+        if sim:
+            # The timeout is in simulated time here.
+            client = UARTDebugHost(CoSim(sim, soc_clk=sim_clk).serial(timeout=timeout))
+        else:
+            client = UARTDebugHost(ports[0], baud, timeout)
+
+        if hw_seq:
+            client.test_seq_enable()
 
-    for test in (tqdm.tqdm(tests) if quiet_run else tests):
-        results[test.name] = run_test(client, test)
+        results = {}
+
+        for test in (tqdm.tqdm(tests) if quiet_run else tests):
+            results[test.name] = run_test(client, test, hw_seq)
 
     n_ran = len(results)
     n_pass = len([result for result in results.values() if result])
@@ -462,8 +886,10 @@ def collect_tests(test_dir, selected_tests, emul, native, select, limit, random_
     tests = []
 
     for test_file in tqdm.tqdm(test_files):
+        test_cases = load_test_file(test_file)
+
         if random_sample:
-            indices = random.sample(range(1, 10001), k=limit)
+            indices = random.sample(range(1, len(test_cases) + 1), k=limit)
         elif select:
             indices = select
         else:
@@ -472,7 +898,6 @@ def collect_tests(test_dir, selected_tests, emul, native, select, limit, random_
         log(f"Collecting tests from {test_file} ({len(indices)} tests)")
 
         for index in indices:
-            test_cases = load_test_file(test_file)
             tests.append(test_cases[index - 1])
 
     return tests
@@ -480,7 +905,8 @@ def collect_tests(test_dir, selected_tests, emul, native, select, limit, random_
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--serial-port", type=str, default="/dev/ttyUSB2")
+    parser.add_argument("--serial-port", type=str, nargs="+", default=["/dev/ttyUSB2"],
+                        help="debug ports of the boards to use, tests are spread across all of them")
     parser.add_argument("--serial-baud", type=int, default=2000000)
     parser.add_argument("--test-dir", type=str, required=True)
     parser.add_argument("--tests", type=str, nargs="*")
@@ -493,6 +919,16 @@ if __name__ == "__main__":
     parser.add_argument("--quiet-run", action="store_true")
     parser.add_argument("--verbose", action="store_true")
     parser.add_argument("--verbose-cycles", action="store_true")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="seconds to wait for a board to respond before giving up on it")
+    parser.add_argument("--hw-seq", action="store_true",
+                        help="run tests on the FPGA-side test sequencer, instead of servicing every cycle from here")
+    parser.add_argument("--model", action="store_true",
+                        help="run tests on a model of the CPU instead of a board, no hardware needed")
+    parser.add_argument("--sim", type=str, default=None,
+                        help="run tests on the Verilator co-simulation (path to libcosim.so) instead of a board")
+    parser.add_argument("--sim-clk", type=int, default=75,
+                        help="SoC clock in MHz the simulated top was emitted for")
 
     args = parser.parse_args()
 
@@ -527,4 +963,5 @@ if __name__ == "__main__":
     random.shuffle(tests)
     print(f"Collected {len(tests)} tests. Running...")
 
-    main(args.serial_port, args.serial_baud, tests)
+    main(args.serial_port, args.serial_baud, tests, args.hw_seq, args.timeout, args.model,
+         args.sim, args.sim_clk * 1e6)
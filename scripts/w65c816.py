@@ -0,0 +1,999 @@
+#!/usr/bin/env python
+
+# Bus-cycle model of the W65C816, for running the drivers from
+# run-test.py without any hardware.
+#
+# The CPU talks to a bus with the same callbacks the drivers have:
+#   read(addr, vpa, vda, vpb) -> value
+#   write(addr, vpa, vda, vpb, value)
+#   noop(addr, vpb, rwb, value)
+# and makes exactly one of those calls per CPU cycle, in the order the
+# real CPU performs them. Internal (IO) cycles keep the address of the
+# previous cycle (the byte after the opcode, for implied instructions),
+# except where the datasheet gives them one (indexing across a page).
+#
+# IRQ and NMI are taken between instructions, from the irq and nmi
+# attributes (active high, NMI on its rising edge). Not modelled: ABORT,
+# and the E/M/X and MLB outputs. STP idles forever.
+
+
+FLAG_N = 0x80
+FLAG_V = 0x40
+FLAG_M = 0x20
+FLAG_X = 0x10
+FLAG_D = 0x08
+FLAG_I = 0x04
+FLAG_Z = 0x02
+FLAG_C = 0x01
+
+# Kinds of accesses an addressing mode is used for. Indexed modes
+# always take an extra cycle for writes and read-modify-writes.
+ACCESS_READ = 0
+ACCESS_WRITE = 1
+ACCESS_RMW = 2
+
+
+class W65C816:
+    def __init__(self, bus):
+        self.bus = bus
+
+        # State after reset.
+        self.a = 0
+        self.x = 0
+        self.y = 0
+        self.s = 0x01FF
+        self.d = 0
+        self.p = FLAG_M | FLAG_X | FLAG_I
+        self.pc = 0
+        self.pbr = 0
+        self.dbr = 0
+        self.e = True
+
+        # Interrupt inputs.
+        self.irq = False
+        self.nmi = False
+        self._nmi_prev = False
+
+        self.cycles = 0
+
+        # Last address and data on the bus, for IO cycles.
+        self._addr = 0
+        self._in_data = 0
+        self._out_data = 0
+
+    # Everything carried from one instruction to the next, for saving
+    # and restoring the model between instructions.
+    def state(self):
+        return {name: value for name, value in vars(self).items() if name != "bus"}
+
+    def load_state(self, state):
+        vars(self).update(state)
+
+    # Goes through the reset sequence, up to and including the reset
+    # vector fetch.
+    def reset(self):
+        self.e = True
+        self.p = (self.p | FLAG_M | FLAG_X | FLAG_I) & ~FLAG_D
+        self.d = 0
+        self.pbr = 0
+        self.dbr = 0
+        self.x &= 0xFF
+        self.y &= 0xFF
+
+        self._io((self.pbr << 16) | self.pc)
+        self._io()
+        # The stack is accessed like for an interrupt, but not written.
+        for _ in range(3):
+            self._io(0x0100 | (self.s & 0xFF))
+            self.s = 0x0100 | ((self.s - 1) & 0xFF)
+
+        pc = self._read(0xFFFC, vpb=False)
+        self.pc = pc | (self._read(0xFFFD, vpb=False) << 8)
+
+    # Executes one instruction, starting with its opcode fetch, or
+    # takes a pending interrupt.
+    def step(self):
+        nmi_edge = self.nmi and not self._nmi_prev
+        self._nmi_prev = self.nmi
+        if nmi_edge:
+            self._interrupt(0xFFFA, 0xFFEA)
+            return
+        if self.irq and not self.p & FLAG_I:
+            self._interrupt(0xFFFE, 0xFFEE)
+            return
+
+        opcode = self._read((self.pbr << 16) | self.pc, vpa=True)
+        self.pc = (self.pc + 1) & 0xFFFF
+        self._addr = (self.pbr << 16) | self.pc
+
+        handler, args = OPCODES[opcode]
+        handler(self, *args)
+
+    # Bus cycles
+    # ---
+    def _read(self, addr, *, vpa=False, vda=True, vpb=True):
+        self._addr = addr
+        self._in_data = value = self.bus.read(addr, vpa, vda, vpb)
+        self.cycles += 1
+        return value
+
+    def _write(self, addr, value):
+        self._addr = addr
+        self._out_data = value
+        self.bus.write(addr, False, True, True, value)
+        self.cycles += 1
+
+    def _io(self, addr=None):
+        if addr is not None:
+            self._addr = addr
+        self.bus.noop(self._addr, True, True, None)
+        self.cycles += 1
+
+    # The IO cycle of a read-modify-write in emulation mode drives
+    # the unmodified data with RWB low.
+    def _io_rmw(self):
+        if self.e:
+            self._out_data = self._in_data
+            self.bus.noop(self._addr, True, False, self._out_data)
+            self.cycles += 1
+        else:
+            self._io()
+
+    def _fetch(self):
+        value = self._read((self.pbr << 16) | self.pc, vpa=True, vda=False)
+        self.pc = (self.pc + 1) & 0xFFFF
+        return value
+
+    def _fetch16(self):
+        lo = self._fetch()
+        return lo | (self._fetch() << 8)
+
+    # Direct page accesses wrap within the page in emulation mode, if
+    # DL is 0, except for those by instructions new to the 65C816.
+    def _direct(self, offset):
+        if self.e and not (self.d & 0xFF):
+            return self.d | (offset & 0xFF)
+        return (self.d + offset) & 0xFFFF
+
+    def _direct_n(self, offset):
+        return (self.d + offset) & 0xFFFF
+
+    # One more cycle for direct page accesses if DL is not 0.
+    def _io_dl(self):
+        if self.d & 0xFF:
+            self._io()
+
+    # The stack wraps within page 1 in emulation mode, except for
+    # accesses by instructions new to the 65C816, which only fix up
+    # the high byte once they're done.
+    def _push(self, value):
+        self._write(self.s, value & 0xFF)
+        if self.e:
+            self.s = 0x0100 | ((self.s - 1) & 0xFF)
+        else:
+            self.s = (self.s - 1) & 0xFFFF
+
+    def _pull(self):
+        if self.e:
+            self.s = 0x0100 | ((self.s + 1) & 0xFF)
+        else:
+            self.s = (self.s + 1) & 0xFFFF
+        return self._read(self.s)
+
+    def _push_n(self, value):
+        self._write(self.s, value & 0xFF)
+        self.s = (self.s - 1) & 0xFFFF
+
+    def _pull_n(self):
+        self.s = (self.s + 1) & 0xFFFF
+        return self._read(self.s)
+
+    def _fix_s(self):
+        if self.e:
+            self.s = 0x0100 | (self.s & 0xFF)
+
+    # Registers and flags
+    # ---
+    def _m8(self):
+        return self.e or (self.p & FLAG_M) != 0
+
+    def _x8(self):
+        return self.e or (self.p & FLAG_X) != 0
+
+    def _wide(self, width_flag):
+        return not (self.e or self.p & width_flag)
+
+    def _set_nz(self, value, wide):
+        if wide:
+            value &= 0xFFFF
+            n = value & 0x8000
+        else:
+            value &= 0xFF
+            n = value & 0x80
+        self.p = (self.p & ~(FLAG_N | FLAG_Z)) | (FLAG_N if n else 0) | (0 if value else FLAG_Z)
+
+    def _set_flag(self, flag, value):
+        if value:
+            self.p |= flag
+        else:
+            self.p &= ~flag
+
+    def _set_a(self, value, wide):
+        if wide:
+            self.a = value & 0xFFFF
+        else:
+            self.a = (self.a & 0xFF00) | (value & 0xFF)
+        self._set_nz(value, wide)
+
+    def _get_a(self, wide):
+        return self.a if wide else self.a & 0xFF
+
+    def _set_index(self, name, value):
+        wide = not self._x8()
+        value &= 0xFFFF if wide else 0xFF
+        setattr(self, name, value)
+        self._set_nz(value, wide)
+
+    # After anything that changes P or E.
+    def _update_mode(self):
+        if self.e:
+            self.p |= FLAG_M | FLAG_X
+        if self.p & FLAG_X:
+            self.x &= 0xFF
+            self.y &= 0xFF
+
+    # Addressing modes
+    # ---
+    # Each performs the cycles up to the data access, and returns the
+    # addresses of the low and high bytes of the data.
+    def _m_abs(self, access):
+        addr = (self.dbr << 16) | self._fetch16()
+        return addr, (addr + 1) & 0xFFFFFF
+
+    def _abs_indexed(self, access, index):
+        base = self._fetch16()
+        bank = self.dbr << 16
+        if access != ACCESS_READ or not self._x8() or (base >> 8) != ((base + index) >> 8):
+            self._io(bank | (base & 0xFF00) | ((base + index) & 0xFF))
+        addr = (bank + base + index) & 0xFFFFFF
+        return addr, (addr + 1) & 0xFFFFFF
+
+    def _m_abs_x(self, access):
+        return self._abs_indexed(access, self.x)
+
+    def _m_abs_y(self, access):
+        return self._abs_indexed(access, self.y)
+
+    def _m_long(self, access):
+        addr = self._fetch16()
+        addr |= self._fetch() << 16
+        return addr, (addr + 1) & 0xFFFFFF
+
+    def _m_long_x(self, access):
+        addr = self._fetch16()
+        addr = ((self._fetch() << 16) + addr + self.x) & 0xFFFFFF
+        return addr, (addr + 1) & 0xFFFFFF
+
+    def _m_dp(self, access):
+        offset = self._fetch()
+        self._io_dl()
+        return self._direct(offset), self._direct(offset + 1)
+
+    def _dp_indexed(self, index):
+        offset = self._fetch()
+        self._io_dl()
+        self._io()
+        return self._direct(offset + index), self._direct(offset + index + 1)
+
+    def _m_dp_x(self, access):
+        return self._dp_indexed(self.x)
+
+    def _m_dp_y(self, access):
+        return self._dp_indexed(self.y)
+
+    def _data_bank_ptr(self, ptr, index=0):
+        addr = ((self.dbr << 16) + ptr + index) & 0xFFFFFF
+        return addr, (addr + 1) & 0xFFFFFF
+
+    def _m_dp_ind(self, access):
+        offset = self._fetch()
+        self._io_dl()
+        ptr = self._read(self._direct(offset))
+        ptr |= self._read(self._direct(offset + 1)) << 8
+        return self._data_bank_ptr(ptr)
+
+    def _m_dp_x_ind(self, access):
+        offset = self._fetch()
+        self._io_dl()
+        self._io()
+        ptr = self._read(self._direct(offset + self.x))
+        ptr |= self._read(self._direct(offset + self.x + 1)) << 8
+        return self._data_bank_ptr(ptr)
+
+    def _m_dp_ind_y(self, access):
+        offset = self._fetch()
+        self._io_dl()
+        ptr = self._read(self._direct(offset))
+        ptr |= self._read(self._direct(offset + 1)) << 8
+        if access != ACCESS_READ or not self._x8() or (ptr >> 8) != ((ptr + self.y) >> 8):
+            self._io((self.dbr << 16) | (ptr & 0xFF00) | ((ptr + self.y) & 0xFF))
+        return self._data_bank_ptr(ptr, self.y)
+
+    def _dp_ind_long(self, index):
+        offset = self._fetch()
+        self._io_dl()
+        ptr = self._read(self._direct_n(offset))
+        ptr |= self._read(self._direct_n(offset + 1)) << 8
+        ptr |= self._read(self._direct_n(offset + 2)) << 16
+        addr = (ptr + index) & 0xFFFFFF
+        return addr, (addr + 1) & 0xFFFFFF
+
+    def _m_dp_ind_long(self, access):
+        return self._dp_ind_long(0)
+
+    def _m_dp_ind_long_y(self, access):
+        return self._dp_ind_long(self.y)
+
+    def _m_sr(self, access):
+        offset = self._fetch()
+        self._io()
+        return (self.s + offset) & 0xFFFF, (self.s + offset + 1) & 0xFFFF
+
+    def _m_sr_ind_y(self, access):
+        offset = self._fetch()
+        self._io()
+        ptr = self._read((self.s + offset) & 0xFFFF)
+        ptr |= self._read((self.s + offset + 1) & 0xFFFF) << 8
+        self._io()
+        return self._data_bank_ptr(ptr, self.y)
+
+    # Instruction classes
+    # ---
+    def _op_read(self, mode, alu, width_flag):
+        wide = self._wide(width_flag)
+        lo_addr, hi_addr = mode(self, ACCESS_READ)
+        value = self._read(lo_addr)
+        if wide:
+            value |= self._read(hi_addr) << 8
+        alu(self, value, wide)
+
+    def _op_imm(self, alu, width_flag):
+        wide = self._wide(width_flag)
+        value = self._fetch()
+        if wide:
+            value |= self._fetch() << 8
+        alu(self, value, wide)
+
+    def _op_write(self, mode, reg, width_flag):
+        wide = self._wide(width_flag)
+        lo_addr, hi_addr = mode(self, ACCESS_WRITE)
+        value = getattr(self, reg) if reg else 0
+        self._write(lo_addr, value & 0xFF)
+        if wide:
+            self._write(hi_addr, (value >> 8) & 0xFF)
+
+    def _op_rmw(self, mode, alu):
+        wide = not self._m8()
+        lo_addr, hi_addr = mode(self, ACCESS_RMW)
+        value = self._read(lo_addr)
+        if wide:
+            value |= self._read(hi_addr) << 8
+        self._io_rmw()
+        value = alu(self, value, wide)
+        if wide:
+            self._write(hi_addr, (value >> 8) & 0xFF)
+        self._write(lo_addr, value & 0xFF)
+
+    def _op_rmw_a(self, alu):
+        wide = not self._m8()
+        self._io()
+        value = alu(self, self._get_a(wide), wide)
+        self._set_a(value, wide)
+
+    # ALU operations
+    # ---
+    def _alu_ora(self, value, wide):
+        self._set_a(self._get_a(wide) | value, wide)
+
+    def _alu_and(self, value, wide):
+        self._set_a(self._get_a(wide) & value, wide)
+
+    def _alu_eor(self, value, wide):
+        self._set_a(self._get_a(wide) ^ value, wide)
+
+    def _alu_lda(self, value, wide):
+        self._set_a(value, wide)
+
+    def _alu_ldx(self, value, wide):
+        self._set_index('x', value)
+
+    def _alu_ldy(self, value, wide):
+        self._set_index('y', value)
+
+    def _compare(self, reg, value, wide):
+        result = reg - value
+        self._set_flag(FLAG_C, result >= 0)
+        self._set_nz(result, wide)
+
+    def _alu_cmp(self, value, wide):
+        self._compare(self._get_a(wide), value, wide)
+
+    def _alu_cpx(self, value, wide):
+        self._compare(self.x, value, wide)
+
+    def _alu_cpy(self, value, wide):
+        self._compare(self.y, value, wide)
+
+    def _alu_bit(self, value, wide):
+        self._set_flag(FLAG_Z, (value & self._get_a(wide)) == 0)
+        self._set_flag(FLAG_V, value & (0x4000 if wide else 0x40))
+        self._set_flag(FLAG_N, value & (0x8000 if wide else 0x80))
+
+    def _alu_bit_imm(self, value, wide):
+        self._set_flag(FLAG_Z, (value & self._get_a(wide)) == 0)
+
+    def _alu_adc(self, value, wide):
+        digits = 4 if wide else 2
+        a = self._get_a(wide)
+        result = a + value + (self.p & FLAG_C)
+
+        if self.p & FLAG_D:
+            result = (a & 0xF) + (value & 0xF) + (self.p & FLAG_C)
+            for i in range(1, digits):
+                low_mask = (1 << (4 * i)) - 1
+                if result > (0xA << (4 * i - 4)) - 1:
+                    result += 0x6 << (4 * i - 4)
+                carry = result > low_mask
+                digit_mask = 0xF << (4 * i)
+                result = (a & digit_mask) + (value & digit_mask) + (carry << (4 * i)) + (result & low_mask)
+
+        sign = 0x8000 if wide else 0x80
+        self._set_flag(FLAG_V, ~(a ^ value) & (a ^ result) & sign)
+        if self.p & FLAG_D and result > (0xA << (4 * digits - 4)) - 1:
+            result += 0x6 << (4 * digits - 4)
+        self._set_flag(FLAG_C, result > (0xFFFF if wide else 0xFF))
+        self._set_a(result, wide)
+
+    def _alu_sbc(self, value, wide):
+        digits = 4 if wide else 2
+        a = self._get_a(wide)
+        value ^= 0xFFFF if wide else 0xFF
+        result = a + value + (self.p & FLAG_C)
+
+        if self.p & FLAG_D:
+            result = (a & 0xF) + (value & 0xF) + (self.p & FLAG_C)
+            for i in range(1, digits):
+                low_mask = (1 << (4 * i)) - 1
+                if result <= low_mask:
+                    result -= 0x6 << (4 * i - 4)
+                carry = result > low_mask
+                digit_mask = 0xF << (4 * i)
+                result = (a & digit_mask) + (value & digit_mask) + (carry << (4 * i)) + (result & low_mask)
+
+        sign = 0x8000 if wide else 0x80
+        self._set_flag(FLAG_V, ~(a ^ value) & (a ^ result) & sign)
+        if self.p & FLAG_D and result <= (0xFFFF if wide else 0xFF):
+            result -= 0x6 << (4 * digits - 4)
+        self._set_flag(FLAG_C, result > (0xFFFF if wide else 0xFF))
+        self._set_a(result, wide)
+
+    def _alu_asl(self, value, wide):
+        self._set_flag(FLAG_C, value & (0x8000 if wide else 0x80))
+        value = (value << 1) & (0xFFFF if wide else 0xFF)
+        self._set_nz(value, wide)
+        return value
+
+    def _alu_rol(self, value, wide):
+        carry = self.p & FLAG_C
+        self._set_flag(FLAG_C, value & (0x8000 if wide else 0x80))
+        value = ((value << 1) | carry) & (0xFFFF if wide else 0xFF)
+        self._set_nz(value, wide)
+        return value
+
+    def _alu_lsr(self, value, wide):
+        self._set_flag(FLAG_C, value & 1)
+        value >>= 1
+        self._set_nz(value, wide)
+        return value
+
+    def _alu_ror(self, value, wide):
+        carry = self.p & FLAG_C
+        self._set_flag(FLAG_C, value & 1)
+        value = (value >> 1) | (carry << (15 if wide else 7))
+        self._set_nz(value, wide)
+        return value
+
+    def _alu_inc(self, value, wide):
+        value = (value + 1) & (0xFFFF if wide else 0xFF)
+        self._set_nz(value, wide)
+        return value
+
+    def _alu_dec(self, value, wide):
+        value = (value - 1) & (0xFFFF if wide else 0xFF)
+        self._set_nz(value, wide)
+        return value
+
+    def _alu_tsb(self, value, wide):
+        a = self._get_a(wide)
+        self._set_flag(FLAG_Z, (value & a) == 0)
+        return value | a
+
+    def _alu_trb(self, value, wide):
+        a = self._get_a(wide)
+        self._set_flag(FLAG_Z, (value & a) == 0)
+        return value & ~a
+
+    # Other instructions
+    # ---
+    def _op_branch(self, flag, taken_if):
+        offset = self._fetch()
+        if flag and bool(self.p & flag) != taken_if:
+            return
+        target = (self.pc + offset - (0x100 if offset & 0x80 else 0)) & 0xFFFF
+        # In emulation mode, crossing a page takes one more cycle.
+        if self.e and (self.pc >> 8) != (target >> 8):
+            self._io()
+        self._io()
+        self.pc = target
+
+    def _op_brl(self):
+        offset = self._fetch16()
+        self._io()
+        self.pc = (self.pc + offset) & 0xFFFF
+
+    def _op_jmp_abs(self):
+        self.pc = self._fetch16()
+
+    def _op_jmp_long(self):
+        pc = self._fetch16()
+        self.pbr = self._fetch()
+        self.pc = pc
+
+    def _op_jmp_ind(self):
+        ptr = self._fetch16()
+        pc = self._read(ptr)
+        self.pc = pc | (self._read((ptr + 1) & 0xFFFF) << 8)
+
+    def _op_jmp_ind_x(self):
+        ptr = (self._fetch16() + self.x) & 0xFFFF
+        self._io()
+        pc = self._read((self.pbr << 16) | ptr)
+        self.pc = pc | (self._read((self.pbr << 16) | ((ptr + 1) & 0xFFFF)) << 8)
+
+    def _op_jml_ind(self):
+        ptr = self._fetch16()
+        pc = self._read(ptr)
+        pc |= self._read((ptr + 1) & 0xFFFF) << 8
+        self.pbr = self._read((ptr + 2) & 0xFFFF)
+        self.pc = pc
+
+    def _op_jsr_abs(self):
+        target = self._fetch16()
+        self._io()
+        ret = (self.pc - 1) & 0xFFFF
+        self._push(ret >> 8)
+        self._push(ret)
+        self.pc = target
+
+    def _op_jsr_ind_x(self):
+        lo = self._fetch()
+        # PC is at the last byte of the instruction.
+        self._push_n(self.pc >> 8)
+        self._push_n(self.pc)
+        ptr = (lo | (self._fetch() << 8)) + self.x
+        self._io()
+        pc = self._read((self.pbr << 16) | (ptr & 0xFFFF))
+        self.pc = pc | (self._read((self.pbr << 16) | ((ptr + 1) & 0xFFFF)) << 8)
+        self._fix_s()
+
+    def _op_jsl(self):
+        target = self._fetch16()
+        self._push_n(self.pbr)
+        self._io()
+        bank = self._fetch()
+        ret = (self.pc - 1) & 0xFFFF
+        self._push_n(ret >> 8)
+        self._push_n(ret)
+        self.pc = target
+        self.pbr = bank
+        self._fix_s()
+
+    def _op_rts(self):
+        self._io()
+        self._io()
+        pc = self._pull()
+        pc |= self._pull() << 8
+        self._io()
+        self.pc = (pc + 1) & 0xFFFF
+
+    def _op_rtl(self):
+        self._io()
+        self._io()
+        pc = self._pull_n()
+        pc |= self._pull_n() << 8
+        self.pbr = self._pull_n()
+        self.pc = (pc + 1) & 0xFFFF
+        self._fix_s()
+
+    def _op_rti(self):
+        self._io()
+        self._io()
+        self.p = self._pull()
+        self._update_mode()
+        pc = self._pull()
+        self.pc = pc | (self._pull() << 8)
+        if not self.e:
+            self.pbr = self._pull()
+
+    def _enter_vector(self, vector_e, vector_n, p):
+        if not self.e:
+            self._push(self.pbr)
+        self._push(self.pc >> 8)
+        self._push(self.pc)
+        self._push(p)
+        self.p = (self.p | FLAG_I) & ~FLAG_D
+        vector = vector_e if self.e else vector_n
+        pc = self._read(vector, vpb=False)
+        self.pc = pc | (self._read(vector + 1, vpb=False) << 8)
+        self.pbr = 0
+
+    def _op_interrupt(self, vector_e, vector_n):
+        # Signature byte.
+        self._fetch()
+        self._enter_vector(vector_e, vector_n, self.p)
+
+    # The opcode fetch still happens for hardware interrupts, but what
+    # was fetched is dropped. In emulation mode, the pushed B flag is
+    # clear.
+    def _interrupt(self, vector_e, vector_n):
+        self._read((self.pbr << 16) | self.pc, vpa=True)
+        self._io((self.pbr << 16) | self.pc)
+        self._enter_vector(vector_e, vector_n, self.p & ~FLAG_X if self.e else self.p)
+
+    def _op_push(self, reg, width_flag):
+        self._io()
+        value = getattr(self, reg)
+        if width_flag and self._wide(width_flag):
+            self._push(value >> 8)
+        self._push(value)
+
+    def _op_pull(self, reg, width_flag):
+        self._io()
+        self._io()
+        wide = self._wide(width_flag)
+        value = self._pull()
+        if wide:
+            value |= self._pull() << 8
+        if reg == 'a':
+            self._set_a(value, wide)
+        else:
+            self._set_index(reg, value)
+
+    def _op_php(self):
+        self._io()
+        self._push(self.p)
+
+    def _op_plp(self):
+        self._io()
+        self._io()
+        self.p = self._pull()
+        self._update_mode()
+
+    def _op_phd(self):
+        self._io()
+        self._push_n(self.d >> 8)
+        self._push_n(self.d)
+        self._fix_s()
+
+    def _op_pld(self):
+        self._io()
+        self._io()
+        d = self._pull_n()
+        self.d = d | (self._pull_n() << 8)
+        self._set_nz(self.d, True)
+        self._fix_s()
+
+    def _op_plb(self):
+        self._io()
+        self._io()
+        self.dbr = self._pull_n()
+        self._set_nz(self.dbr, False)
+        self._fix_s()
+
+    def _op_pea(self):
+        value = self._fetch16()
+        self._push_n(value >> 8)
+        self._push_n(value)
+        self._fix_s()
+
+    def _op_pei(self):
+        offset = self._fetch()
+        self._io_dl()
+        value = self._read(self._direct_n(offset))
+        value |= self._read(self._direct_n(offset + 1)) << 8
+        self._push_n(value >> 8)
+        self._push_n(value)
+        self._fix_s()
+
+    def _op_per(self):
+        offset = self._fetch16()
+        self._io()
+        value = (self.pc + offset) & 0xFFFF
+        self._push_n(value >> 8)
+        self._push_n(value)
+        self._fix_s()
+
+    def _op_flag(self, flag, value):
+        self._io()
+        self._set_flag(flag, value)
+
+    def _op_rep(self):
+        mask = self._fetch()
+        self._io()
+        self.p &= ~mask
+        self._update_mode()
+
+    def _op_sep(self):
+        mask = self._fetch()
+        self._io()
+        self.p |= mask
+        self._update_mode()
+
+    def _op_xce(self):
+        self._io()
+        carry = bool(self.p & FLAG_C)
+        self._set_flag(FLAG_C, self.e)
+        self.e = carry
+        if self.e:
+            self.s = 0x0100 | (self.s & 0xFF)
+        self._update_mode()
+
+    def _op_xba(self):
+        self._io()
+        self._io()
+        self.a = ((self.a >> 8) | (self.a << 8)) & 0xFFFF
+        self._set_nz(self.a, False)
+
+    def _op_inc_index(self, reg, delta):
+        self._io()
+        self._set_index(reg, getattr(self, reg) + delta)
+
+    # Transfers between A, X and Y, sized by the destination.
+    def _op_transfer(self, src, dst):
+        self._io()
+        value = getattr(self, src)
+        if dst == 'a':
+            self._set_a(value, not self._m8())
+        else:
+            self._set_index(dst, value)
+
+    def _op_tcs(self):
+        self._io()
+        self.s = self.a
+        self._fix_s()
+
+    def _op_tsc(self):
+        self._io()
+        self.a = self.s
+        self._set_nz(self.a, True)
+
+    def _op_tcd(self):
+        self._io()
+        self.d = self.a
+        self._set_nz(self.d, True)
+
+    def _op_tdc(self):
+        self._io()
+        self.a = self.d
+        self._set_nz(self.a, True)
+
+    def _op_txs(self):
+        self._io()
+        self.s = self.x
+        self._fix_s()
+
+    def _op_tsx(self):
+        self._io()
+        self._set_index('x', self.s)
+
+    def _op_nop(self):
+        self._io()
+
+    def _op_wdm(self):
+        self._fetch()
+
+    def _op_wai(self):
+        self._io()
+        self._io()
+        while not (self.irq or self.nmi):
+            self._io()
+
+    def _op_stp(self):
+        while True:
+            self._io()
+
+    def _op_block_move(self, step):
+        dst_bank = self._fetch()
+        src_bank = self._fetch()
+        self.dbr = dst_bank
+        value = self._read((src_bank << 16) | self.x)
+        self._write((dst_bank << 16) | self.y, value)
+        self._io()
+        mask = 0xFF if self._x8() else 0xFFFF
+        self.x = (self.x + step) & mask
+        self.y = (self.y + step) & mask
+        self._io()
+        self.a = (self.a - 1) & 0xFFFF
+        if self.a != 0xFFFF:
+            self.pc = (self.pc - 3) & 0xFFFF
+
+
+# Opcode table
+# ---
+# Maps each opcode to an instruction class (or instruction) and its
+# arguments, such as the addressing mode and ALU operation.
+OPCODES = [None] * 256
+
+def _op(opcode, handler, *args):
+    assert OPCODES[opcode] is None, f"opcode {opcode:02x} defined twice"
+    OPCODES[opcode] = (handler, args)
+
+_c = W65C816
+
+# ORA, AND, EOR, ADC, STA, LDA, CMP, SBC
+_GROUP1_MODES = {
+    0x01: _c._m_dp_x_ind,
+    0x03: _c._m_sr,
+    0x05: _c._m_dp,
+    0x07: _c._m_dp_ind_long,
+    0x0D: _c._m_abs,
+    0x0F: _c._m_long,
+    0x11: _c._m_dp_ind_y,
+    0x12: _c._m_dp_ind,
+    0x13: _c._m_sr_ind_y,
+    0x15: _c._m_dp_x,
+    0x17: _c._m_dp_ind_long_y,
+    0x19: _c._m_abs_y,
+    0x1D: _c._m_abs_x,
+    0x1F: _c._m_long_x,
+}
+
+for _base, _alu in [(0x00, _c._alu_ora), (0x20, _c._alu_and), (0x40, _c._alu_eor),
+                    (0x60, _c._alu_adc), (0xA0, _c._alu_lda), (0xC0, _c._alu_cmp),
+                    (0xE0, _c._alu_sbc)]:
+    _op(_base | 0x09, _c._op_imm, _alu, FLAG_M)
+    for _low, _mode in _GROUP1_MODES.items():
+        _op(_base | _low, _c._op_read, _mode, _alu, FLAG_M)
+
+for _low, _mode in _GROUP1_MODES.items():
+    _op(0x80 | _low, _c._op_write, _mode, 'a', FLAG_M)
+
+# ASL, ROL, LSR, ROR, DEC, INC
+for _base, _alu in [(0x00, _c._alu_asl), (0x20, _c._alu_rol), (0x40, _c._alu_lsr),
+                    (0x60, _c._alu_ror), (0xC0, _c._alu_dec), (0xE0, _c._alu_inc)]:
+    _op(_base | 0x06, _c._op_rmw, _c._m_dp, _alu)
+    _op(_base | 0x0E, _c._op_rmw, _c._m_abs, _alu)
+    _op(_base | 0x16, _c._op_rmw, _c._m_dp_x, _alu)
+    _op(_base | 0x1E, _c._op_rmw, _c._m_abs_x, _alu)
+
+for _opcode, _alu in [(0x0A, _c._alu_asl), (0x2A, _c._alu_rol), (0x4A, _c._alu_lsr),
+                      (0x6A, _c._alu_ror), (0x3A, _c._alu_dec), (0x1A, _c._alu_inc)]:
+    _op(_opcode, _c._op_rmw_a, _alu)
+
+_op(0x04, _c._op_rmw, _c._m_dp, _c._alu_tsb)
+_op(0x0C, _c._op_rmw, _c._m_abs, _c._alu_tsb)
+_op(0x14, _c._op_rmw, _c._m_dp, _c._alu_trb)
+_op(0x1C, _c._op_rmw, _c._m_abs, _c._alu_trb)
+
+_op(0x89, _c._op_imm, _c._alu_bit_imm, FLAG_M)
+_op(0x24, _c._op_read, _c._m_dp, _c._alu_bit, FLAG_M)
+_op(0x2C, _c._op_read, _c._m_abs, _c._alu_bit, FLAG_M)
+_op(0x34, _c._op_read, _c._m_dp_x, _c._alu_bit, FLAG_M)
+_op(0x3C, _c._op_read, _c._m_abs_x, _c._alu_bit, FLAG_M)
+
+_op(0xA2, _c._op_imm, _c._alu_ldx, FLAG_X)
+_op(0xA6, _c._op_read, _c._m_dp, _c._alu_ldx, FLAG_X)
+_op(0xAE, _c._op_read, _c._m_abs, _c._alu_ldx, FLAG_X)
+_op(0xB6, _c._op_read, _c._m_dp_y, _c._alu_ldx, FLAG_X)
+_op(0xBE, _c._op_read, _c._m_abs_y, _c._alu_ldx, FLAG_X)
+
+_op(0xA0, _c._op_imm, _c._alu_ldy, FLAG_X)
+_op(0xA4, _c._op_read, _c._m_dp, _c._alu_ldy, FLAG_X)
+_op(0xAC, _c._op_read, _c._m_abs, _c._alu_ldy, FLAG_X)
+_op(0xB4, _c._op_read, _c._m_dp_x, _c._alu_ldy, FLAG_X)
+_op(0xBC, _c._op_read, _c._m_abs_x, _c._alu_ldy, FLAG_X)
+
+_op(0xE0, _c._op_imm, _c._alu_cpx, FLAG_X)
+_op(0xE4, _c._op_read, _c._m_dp, _c._alu_cpx, FLAG_X)
+_op(0xEC, _c._op_read, _c._m_abs, _c._alu_cpx, FLAG_X)
+_op(0xC0, _c._op_imm, _c._alu_cpy, FLAG_X)
+_op(0xC4, _c._op_read, _c._m_dp, _c._alu_cpy, FLAG_X)
+_op(0xCC, _c._op_read, _c._m_abs, _c._alu_cpy, FLAG_X)
+
+_op(0x86, _c._op_write, _c._m_dp, 'x', FLAG_X)
+_op(0x8E, _c._op_write, _c._m_abs, 'x', FLAG_X)
+_op(0x96, _c._op_write, _c._m_dp_y, 'x', FLAG_X)
+_op(0x84, _c._op_write, _c._m_dp, 'y', FLAG_X)
+_op(0x8C, _c._op_write, _c._m_abs, 'y', FLAG_X)
+_op(0x94, _c._op_write, _c._m_dp_x, 'y', FLAG_X)
+_op(0x64, _c._op_write, _c._m_dp, None, FLAG_M)
+_op(0x74, _c._op_write, _c._m_dp_x, None, FLAG_M)
+_op(0x9C, _c._op_write, _c._m_abs, None, FLAG_M)
+_op(0x9E, _c._op_write, _c._m_abs_x, None, FLAG_M)
+
+# BPL, BMI, BVC, BVS, BCC, BCS, BNE, BEQ
+for _i, _flag in enumerate([FLAG_N, FLAG_V, FLAG_C, FLAG_Z]):
+    _op((_i << 6) | 0x10, _c._op_branch, _flag, False)
+    _op((_i << 6) | 0x30, _c._op_branch, _flag, True)
+_op(0x80, _c._op_branch, 0, True)
+_op(0x82, _c._op_brl)
+
+_op(0x4C, _c._op_jmp_abs)
+_op(0x5C, _c._op_jmp_long)
+_op(0x6C, _c._op_jmp_ind)
+_op(0x7C, _c._op_jmp_ind_x)
+_op(0xDC, _c._op_jml_ind)
+_op(0x20, _c._op_jsr_abs)
+_op(0x22, _c._op_jsl)
+_op(0xFC, _c._op_jsr_ind_x)
+_op(0x60, _c._op_rts)
+_op(0x6B, _c._op_rtl)
+_op(0x40, _c._op_rti)
+_op(0x00, _c._op_interrupt, 0xFFFE, 0xFFE6) # BRK
+_op(0x02, _c._op_interrupt, 0xFFF4, 0xFFE4) # COP
+
+_op(0x48, _c._op_push, 'a', FLAG_M)
+_op(0xDA, _c._op_push, 'x', FLAG_X)
+_op(0x5A, _c._op_push, 'y', FLAG_X)
+_op(0x8B, _c._op_push, 'dbr', 0)
+_op(0x4B, _c._op_push, 'pbr', 0)
+_op(0x08, _c._op_php)
+_op(0x0B, _c._op_phd)
+_op(0xF4, _c._op_pea)
+_op(0xD4, _c._op_pei)
+_op(0x62, _c._op_per)
+_op(0x68, _c._op_pull, 'a', FLAG_M)
+_op(0xFA, _c._op_pull, 'x', FLAG_X)
+_op(0x7A, _c._op_pull, 'y', FLAG_X)
+_op(0x28, _c._op_plp)
+_op(0x2B, _c._op_pld)
+_op(0xAB, _c._op_plb)
+
+_op(0x18, _c._op_flag, FLAG_C, False) # CLC
+_op(0x38, _c._op_flag, FLAG_C, True)  # SEC
+_op(0x58, _c._op_flag, FLAG_I, False) # CLI
+_op(0x78, _c._op_flag, FLAG_I, True)  # SEI
+_op(0xB8, _c._op_flag, FLAG_V, False) # CLV
+_op(0xD8, _c._op_flag, FLAG_D, False) # CLD
+_op(0xF8, _c._op_flag, FLAG_D, True)  # SED
+_op(0xC2, _c._op_rep)
+_op(0xE2, _c._op_sep)
+_op(0xFB, _c._op_xce)
+_op(0xEB, _c._op_xba)
+
+_op(0xE8, _c._op_inc_index, 'x', 1)  # INX
+_op(0xCA, _c._op_inc_index, 'x', -1) # DEX
+_op(0xC8, _c._op_inc_index, 'y', 1)  # INY
+_op(0x88, _c._op_inc_index, 'y', -1) # DEY
+_op(0xAA, _c._op_transfer, 'a', 'x') # TAX
+_op(0xA8, _c._op_transfer, 'a', 'y') # TAY
+_op(0x8A, _c._op_transfer, 'x', 'a') # TXA
+_op(0x98, _c._op_transfer, 'y', 'a') # TYA
+_op(0x9B, _c._op_transfer, 'x', 'y') # TXY
+_op(0xBB, _c._op_transfer, 'y', 'x') # TYX
+_op(0x1B, _c._op_tcs)
+_op(0x3B, _c._op_tsc)
+_op(0x5B, _c._op_tcd)
+_op(0x7B, _c._op_tdc)
+_op(0x9A, _c._op_txs)
+_op(0xBA, _c._op_tsx)
+
+_op(0xEA, _c._op_nop)
+_op(0x42, _c._op_wdm)
+_op(0xCB, _c._op_wai)
+_op(0xDB, _c._op_stp)
+_op(0x54, _c._op_block_move, 1)  # MVN
+_op(0x44, _c._op_block_move, -1) # MVP
+
+assert None not in OPCODES, f"opcode {OPCODES.index(None):02x} not defined"
+del _c
@@ -109,6 +109,56 @@ private:
 	bool prev_cpu_clk_ = false;
 };
 
+// Drives the CPU pins of the SoC (W65C816BusSignature), as brought out
+// of the sim top (VerilatorTop in rtl/paaliaq/sim.py). The bridge
+// generates the CPU clock, and the CPU latches the read data and moves
+// on to the next cycle as it goes down. Called once per SoC clock.
+struct soc_bus_driver : bus_driver {
+	template <std::invocable<> Fn>
+	void bus_tick(Fn &&tick_cb, uint8_t i_cpu_clk, uint8_t i_cpu_rst,
+			uint8_t i_r_data, uint8_t i_irq, uint8_t i_nmi,
+			uint16_t &o_addr_lo, uint8_t &o_addr_hi, uint8_t &o_w_data,
+			uint8_t &o_rw, uint8_t &o_vda, uint8_t &o_vpa, uint8_t &o_vpb) {
+		bool falling = !i_cpu_clk && prev_cpu_clk_;
+		prev_cpu_clk_ = i_cpu_clk;
+
+		// Nothing happens until the bridge lets go of reset.
+		if (i_cpu_rst)
+			running_ = true;
+		if (!running_ || !falling)
+			return;
+
+		if (started_ && current_r_)
+			in_data_ = i_r_data;
+		started_ = true;
+
+		// Both are active low, NMI is edge triggered.
+		irq_ = !i_irq;
+		if (!i_nmi && prev_nmi_)
+			nmi_ = true;
+		prev_nmi_ = i_nmi;
+
+		bus_op_pending_ = false;
+		tick_cb();
+		assert(bus_op_pending_);
+
+		o_addr_lo = current_addr_ & 0xFFFF;
+		o_addr_hi = (current_addr_ >> 16) & 0xFF;
+		o_rw = current_r_ && !current_w_;
+		o_vda = vda_;
+		o_vpa = vpa_;
+		o_vpb = !vec_pull_;
+		if (current_w_)
+			o_w_data = out_data_;
+	}
+
+private:
+	bool prev_cpu_clk_ = false;
+	bool prev_nmi_ = true;
+	bool running_ = false;
+	bool started_ = false;
+};
+
 struct test_bus_driver : bus_driver {
 	static constexpr size_t ram_size = 16 * 1024 * 1024;
 
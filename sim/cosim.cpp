@@ -0,0 +1,221 @@
+#include "cosim.hpp"
+
+#include <algorithm>
+#include <cstring>
+#include <variant>
+#include "verilated.h"
+#include "verilated_vcd_c.h"
+#include "Vtop.h"
+
+cosim::cosim(unsigned uart_divisor, unsigned debug_uart_divisor, bool video)
+: uart{uart_divisor}, debug_uart{debug_uart_divisor}, cpu_{driver_}, video_{video} {
+	Verilated::traceEverOn(true);
+	top_ = std::make_unique<Vtop>();
+
+	top_->clk = 0;
+	top_->pixel_clk = 0;
+	top_->tmds_clk = 0;
+	top_->uart_rx = 1;
+	top_->debug_uart_rx = 1;
+	top_->eval();
+}
+
+cosim::~cosim() {
+	trace_close();
+	top_->final();
+}
+
+// One SoC clock cycle. The TMDS clock is the fastest, and toggles every
+// step, the SoC and pixel clocks every 5 steps, with the rising edges
+// lined up. Without video, only the SoC clock toggles.
+void cosim::cycle_() {
+	int steps = video_ ? 10 : 2;
+
+	for (int i = 0; i < steps; i++) {
+		bool soc_edge = !video_ || i % 5 == 0;
+
+		if (video_)
+			top_->tmds_clk = !top_->tmds_clk;
+
+		if (soc_edge && !top_->clk) {
+			// The models act on what was on the pins before the edge.
+			uint8_t ras = top_->sdram_ras, cas = top_->sdram_cas, we = top_->sdram_we;
+			uint8_t ba = top_->sdram_ba, dqm = top_->sdram_dqm;
+			uint16_t a = top_->sdram_a, dq_o = top_->sdram_dq_o;
+
+			top_->clk = 1;
+			top_->pixel_clk = video_;
+			top_->eval();
+
+			sdram.tick(ras, cas, we, ba, a, dq_o, dqm, top_->sdram_dq_i);
+			posedge_();
+		} else if (soc_edge) {
+			top_->clk = 0;
+			top_->pixel_clk = 0;
+		}
+
+		top_->eval();
+
+		if (trace_ && cycles_ >= trace_start_ && cycles_ < trace_end_)
+			trace_->dump(time_);
+		time_ += 10 / steps;
+	}
+
+	cycles_++;
+}
+
+void cosim::posedge_() {
+	driver_.bus_tick([&] { cpu_.tick(); cpu_cycles_++; },
+			top_->cpu_clk, top_->cpu_rst,
+			top_->cpu_r_data, top_->cpu_irq, top_->cpu_nmi,
+			top_->cpu_addr_lo, top_->cpu_addr_hi, top_->cpu_w_data,
+			top_->cpu_rw, top_->cpu_vda, top_->cpu_vpa, top_->cpu_vpb);
+
+	uart.tick(top_->uart_tx, top_->uart_rx);
+	debug_uart.tick(top_->debug_uart_tx, top_->debug_uart_rx);
+}
+
+void cosim::step(uint64_t cycles) {
+	for (uint64_t i = 0; i < cycles; i++)
+		cycle_();
+}
+
+uint64_t cosim::step_until_received(uart_model &uart, size_t count, uint64_t max_cycles) {
+	uint64_t i = 0;
+	for (; i < max_cycles && uart.received.size() < count; i++)
+		cycle_();
+	return i;
+}
+
+void cosim::trace_open(const char *path, uint64_t start, uint64_t end) {
+	trace_close();
+
+	trace_ = std::make_unique<VerilatedVcdC>();
+	top_->trace(trace_.get(), 99);
+	trace_->open(path);
+	trace_start_ = start;
+	trace_end_ = end;
+}
+
+void cosim::trace_close() {
+	if (!trace_)
+		return;
+
+	trace_->close();
+	trace_.reset();
+}
+
+namespace {
+	struct port_ref {
+		const char *name;
+		std::variant<CData *, SData *> value;
+	};
+
+	template <typename Fn>
+	bool with_port(Vtop *top, const char *name, Fn &&fn) {
+#define PORT(name) port_ref{#name, &top->name}
+		port_ref ports[] = {
+			PORT(clk), PORT(pixel_clk), PORT(tmds_clk),
+			PORT(uart_rx), PORT(uart_tx),
+			PORT(debug_uart_rx), PORT(debug_uart_tx),
+			PORT(sdram_ba), PORT(sdram_a), PORT(sdram_dq_i), PORT(sdram_dq_o),
+			PORT(sdram_dq_oe), PORT(sdram_dqm),
+			PORT(sdram_we), PORT(sdram_ras), PORT(sdram_cas),
+			PORT(cpu_clk), PORT(cpu_rst),
+			PORT(cpu_addr_lo), PORT(cpu_addr_hi),
+			PORT(cpu_r_data), PORT(cpu_r_data_en), PORT(cpu_w_data),
+			PORT(cpu_rw), PORT(cpu_vda), PORT(cpu_vpa), PORT(cpu_vpb), PORT(cpu_mlb),
+			PORT(cpu_irq), PORT(cpu_nmi), PORT(cpu_abort),
+		};
+#undef PORT
+
+		for (auto &port : ports) {
+			if (!strcmp(port.name, name)) {
+				std::visit(fn, port.value);
+				return true;
+			}
+		}
+
+		return false;
+	}
+}
+
+bool cosim::peek(const char *name, uint64_t &value) {
+	return with_port(top_.get(), name, [&] (auto *port) { value = *port; });
+}
+
+bool cosim::poke(const char *name, uint64_t value) {
+	bool found = with_port(top_.get(), name, [&] (auto *port) { *port = value; });
+	top_->eval();
+	return found;
+}
+
+// C API
+// -----
+
+namespace {
+	uart_model &uart_by_port(cosim *sim, int port) {
+		return port ? sim->debug_uart : sim->uart;
+	}
+}
+
+cosim *cosim_new(unsigned uart_divisor, unsigned debug_uart_divisor, bool video) {
+	return new cosim{uart_divisor, debug_uart_divisor, video};
+}
+
+void cosim_free(cosim *sim) {
+	delete sim;
+}
+
+void cosim_step(cosim *sim, uint64_t cycles) {
+	sim->step(cycles);
+}
+
+uint64_t cosim_cycles(cosim *sim) {
+	return sim->cycles();
+}
+
+uint64_t cosim_cpu_cycles(cosim *sim) {
+	return sim->cpu_cycles();
+}
+
+int cosim_peek(cosim *sim, const char *name, uint64_t *value) {
+	return sim->peek(name, *value);
+}
+
+int cosim_poke(cosim *sim, const char *name, uint64_t value) {
+	return sim->poke(name, value);
+}
+
+uint16_t cosim_sdram_peek(cosim *sim, uint32_t addr) {
+	return sim->sdram[addr];
+}
+
+void cosim_sdram_poke(cosim *sim, uint32_t addr, uint16_t value) {
+	sim->sdram[addr] = value;
+}
+
+void cosim_trace_open(cosim *sim, const char *path, uint64_t start, uint64_t end) {
+	sim->trace_open(path, start, end);
+}
+
+void cosim_trace_close(cosim *sim) {
+	sim->trace_close();
+}
+
+void cosim_uart_send(cosim *sim, int port, const uint8_t *data, size_t len) {
+	auto &uart = uart_by_port(sim, port);
+	uart.to_send.insert(uart.to_send.end(), data, data + len);
+}
+
+size_t cosim_uart_recv(cosim *sim, int port, uint8_t *data, size_t len) {
+	auto &uart = uart_by_port(sim, port);
+	size_t n = std::min(len, uart.received.size());
+	std::copy_n(uart.received.begin(), n, data);
+	uart.received.erase(uart.received.begin(), uart.received.begin() + n);
+	return n;
+}
+
+uint64_t cosim_uart_wait(cosim *sim, int port, size_t count, uint64_t max_cycles) {
+	return sim->step_until_received(uart_by_port(sim, port), count, max_cycles);
+}
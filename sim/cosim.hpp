@@ -0,0 +1,86 @@
+#pragma once
+
+#include <cstdint>
+#include <cstddef>
+#include <memory>
+
+#include "bus-drivers.hpp"
+#include "cpu.hpp"
+#include "models.hpp"
+
+class Vtop;
+class VerilatedVcdC;
+
+// The SoC (as emitted by rtl/paaliaq/sim.py --verilog), together with
+// models of the CPU, the SDRAM and the UARTs, like the Amaranth
+// simulation in sim.py, but at Verilator speed. Used from Python through
+// the C API at the bottom (see scripts/cosim.py), or by sim.cpp.
+struct cosim {
+	// With video, the pixel and TMDS clocks run (at the same rate and 5
+	// times the SoC clock respectively), which costs 5 times as many
+	// evaluations per cycle.
+	cosim(unsigned uart_divisor, unsigned debug_uart_divisor, bool video);
+	~cosim();
+
+	// Runs for the given number of SoC clock cycles.
+	void step(uint64_t cycles);
+
+	// Runs until the given number of bytes have been received from a
+	// UART, or for max_cycles. Returns the number of cycles it ran for.
+	uint64_t step_until_received(uart_model &uart, size_t count, uint64_t max_cycles);
+
+	// Traces are only written between the start and end cycle, and
+	// flushed when closed.
+	void trace_open(const char *path, uint64_t start, uint64_t end);
+	void trace_close();
+
+	// Top level ports, by name.
+	bool peek(const char *name, uint64_t &value);
+	bool poke(const char *name, uint64_t value);
+
+	uint64_t cycles() const { return cycles_; }
+	uint64_t cpu_cycles() const { return cpu_cycles_; }
+
+	sdram_model sdram;
+	uart_model uart;
+	uart_model debug_uart;
+
+private:
+	void cycle_();
+	void posedge_();
+
+	std::unique_ptr<Vtop> top_;
+	soc_bus_driver driver_;
+	w65c816 cpu_;
+
+	bool video_;
+	uint64_t cycles_ = 0;
+	uint64_t cpu_cycles_ = 0;
+	uint64_t time_ = 0;
+
+	std::unique_ptr<VerilatedVcdC> trace_;
+	uint64_t trace_start_ = 0, trace_end_ = 0;
+};
+
+extern "C" {
+	cosim *cosim_new(unsigned uart_divisor, unsigned debug_uart_divisor, bool video);
+	void cosim_free(cosim *sim);
+
+	void cosim_step(cosim *sim, uint64_t cycles);
+	uint64_t cosim_cycles(cosim *sim);
+	uint64_t cosim_cpu_cycles(cosim *sim);
+
+	int cosim_peek(cosim *sim, const char *name, uint64_t *value);
+	int cosim_poke(cosim *sim, const char *name, uint64_t value);
+
+	uint16_t cosim_sdram_peek(cosim *sim, uint32_t addr);
+	void cosim_sdram_poke(cosim *sim, uint32_t addr, uint16_t value);
+
+	void cosim_trace_open(cosim *sim, const char *path, uint64_t start, uint64_t end);
+	void cosim_trace_close(cosim *sim);
+
+	// UARTs are 0 for the main one, and 1 for the debug bridge.
+	void cosim_uart_send(cosim *sim, int port, const uint8_t *data, size_t len);
+	size_t cosim_uart_recv(cosim *sim, int port, uint8_t *data, size_t len);
+	uint64_t cosim_uart_wait(cosim *sim, int port, size_t count, uint64_t max_cycles);
+}
@@ -0,0 +1,158 @@
+#pragma once
+
+#include <array>
+#include <cstdint>
+#include <cstddef>
+#include <deque>
+#include <optional>
+#include <vector>
+
+// Models the SDRAM chip, as seen from the controller, which expects
+// registers on the way to and from the pins (see SDRAMConnector). Same
+// as SDRAMModel in rtl/paaliaq/sim.py. Called once per SoC clock, with
+// what the controller put on the pins before the clock edge.
+struct sdram_model {
+	static constexpr size_t words = size_t{1} << 24;
+
+	sdram_model()
+	: mem_(words, 0) { }
+
+	void tick(uint8_t ras, uint8_t cas, uint8_t we, uint8_t ba, uint16_t a,
+			uint16_t dq_o, uint8_t dqm, uint16_t &dq_i) {
+		tick_++;
+
+		// Beats of a write burst, until another command interrupts it.
+		if (write_left_ && !cas && !(ras && we)) {
+			write_(burst_key_(write_bank_, write_col_, burst_len_ - write_left_), dq_o, dqm);
+			write_left_--;
+		}
+
+		int cmd = (ras << 2) | (cas << 1) | we;
+		switch (cmd) {
+			case 0b111: // MRS
+				cas_latency_ = (a >> 4) & 0b111;
+				burst_len_ = 1 << (a & 0b111);
+				break;
+			case 0b100: // ACTIVATE
+				rows_[ba] = a;
+				break;
+			case 0b101: // PRECHARGE
+				write_left_ = 0;
+				if (a & (1 << 10))
+					rows_.fill(std::nullopt);
+				else
+					rows_[ba] = std::nullopt;
+				break;
+			case 0b010: { // READ
+				write_left_ = 0;
+				// One tick each for the registers to and from the pins.
+				uint64_t start = tick_ + cas_latency_ + 1;
+				for (int i = 0; i < burst_len_; i++)
+					read_data_[(start + i) % read_data_.size()] = mem_[burst_key_(ba, a & 0x1FF, i)];
+				break;
+			}
+			case 0b011: // WRITE
+				write_(burst_key_(ba, a & 0x1FF, 0), dq_o, dqm);
+				write_bank_ = ba;
+				write_col_ = a & 0x1FF;
+				write_left_ = burst_len_ - 1;
+				for (uint64_t t = tick_ + 1; t < tick_ + read_data_.size(); t++)
+					read_data_[t % read_data_.size()] = std::nullopt;
+				break;
+		}
+
+		auto &data = read_data_[tick_ % read_data_.size()];
+		if (data) {
+			dq_i = *data;
+			data = std::nullopt;
+		}
+	}
+
+	// Backdoor access, by word address (bank, row and column).
+	uint16_t &operator[](size_t addr) {
+		return mem_[addr % words];
+	}
+
+private:
+	size_t burst_key_(int bank, int col, int i) const {
+		size_t row = rows_[bank].value_or(0);
+		int base = col & ~(burst_len_ - 1);
+		return (size_t{static_cast<unsigned>(bank)} << 22) | (row << 9)
+			| (base | ((col + i) % burst_len_));
+	}
+
+	void write_(size_t key, uint16_t data, uint8_t dqm) {
+		uint16_t mask = (dqm & 1 ? 0 : 0x00FF) | (dqm & 2 ? 0 : 0xFF00);
+		mem_[key] = (mem_[key] & ~mask) | (data & mask);
+	}
+
+	std::vector<uint16_t> mem_;
+
+	uint64_t tick_ = 0;
+	int cas_latency_ = 2;
+	int burst_len_ = 1;
+	std::array<std::optional<uint16_t>, 4> rows_{};
+
+	// Read data to put on the bus, by tick. Reads are never scheduled
+	// further ahead than CL + 1 + the burst length.
+	std::array<std::optional<uint16_t>, 16> read_data_{};
+
+	// Write burst in progress.
+	int write_bank_ = 0, write_col_ = 0, write_left_ = 0;
+};
+
+// Receives what the SoC sends on a UART, and sends it bytes, at the
+// given number of SoC clocks per bit. Called once per SoC clock.
+struct uart_model {
+	explicit uart_model(unsigned divisor)
+	: divisor_{divisor} { }
+
+	void tick(uint8_t tx, uint8_t &rx) {
+		// Receive, sampling in the middle of each bit.
+		if (rx_ctr_) {
+			if (!--rx_ctr_) {
+				rx_byte_ |= tx << rx_bit_;
+				if (++rx_bit_ == 8) {
+					received.push_back(rx_byte_);
+				} else {
+					rx_ctr_ = divisor_;
+				}
+			}
+		} else if (!tx && prev_tx_) {
+			rx_ctr_ = divisor_ + divisor_ / 2;
+			rx_bit_ = 0;
+			rx_byte_ = 0;
+		}
+		prev_tx_ = tx;
+
+		// Send, start bit, 8 data bits and stop bit.
+		if (tx_ctr_ && --tx_ctr_)
+			return;
+
+		if (tx_bit_ == 10) {
+			if (to_send.empty())
+				return;
+			tx_frame_ = 0x200 | (uint16_t{to_send.front()} << 1);
+			to_send.pop_front();
+			tx_bit_ = 0;
+		}
+
+		rx = (tx_frame_ >> tx_bit_++) & 1;
+		tx_ctr_ = divisor_;
+	}
+
+	std::deque<uint8_t> to_send;
+	std::deque<uint8_t> received;
+
+private:
+	unsigned divisor_;
+
+	bool prev_tx_ = true;
+	unsigned rx_ctr_ = 0;
+	int rx_bit_ = 0;
+	uint8_t rx_byte_ = 0;
+
+	unsigned tx_ctr_ = 0;
+	int tx_bit_ = 10;
+	uint16_t tx_frame_ = 0;
+};
@@ -1,44 +1,41 @@
-#include <iostream>
-#include <memory>
-#include "verilated.h"
-#include "Vtop.h"
-#include "bus-drivers.hpp"
-#include "cpu.hpp"
-#include <verilated_vcd_c.h>
+#include <algorithm>
+#include <cstdio>
+#include <cstdlib>
+#include <string>
+#include "cosim.hpp"
 
+// Runs the co-simulation on its own, printing what the SoC sends on its
+// UART. Tracing is off unless asked for, and only covers the given
+// window of cycles:
+//
+//   sim <cycles> [<trace.vcd> <first cycle> <last cycle>]
+//
+// The clock must match the one the top was emitted for (sim.py's
+// --target-clk).
 int main(int argc, char **argv) {
-	Verilated::traceEverOn(true);
-	Verilated::commandArgs(argc, argv);
-
-	auto top = std::make_unique<Vtop>();
-	fpga_bus_driver driver{};
-	w65c816 cpu{driver};
+	if (argc != 2 && argc != 5) {
+		fprintf(stderr, "usage: %s <cycles> [<trace.vcd> <first cycle> <last cycle>]\n", argv[0]);
+		return 1;
+	}
 
-	auto trace = std::make_unique<VerilatedVcdC>();
-	top->trace(trace.get(), 99);
-	trace->open("sim-trace.vcd");
+	constexpr unsigned soc_clk = 75'000'000;
+	cosim sim{soc_clk / 115200, soc_clk / 2'000'000, false};
 
-	top->clk = 0;
-	top->rst = 1;
-	top->eval();
-	Verilated::timeInc(1);
-	top->rst = 0;
-	top->eval();
-	Verilated::timeInc(1);
+	uint64_t cycles = std::stoull(argv[1]);
+	if (argc == 5)
+		sim.trace_open(argv[2], std::stoull(argv[3]), std::stoull(argv[4]) + 1);
 
-	uint64_t ctr = 0;
+	constexpr uint64_t chunk = 10000;
+	for (uint64_t done = 0; done < cycles; done += chunk) {
+		sim.step(std::min(chunk, cycles - done));
 
-	while (!Verilated::gotFinish()) {
-		driver.bus_tick([&] { cpu.tick(); },
-				top->cpu_clk, top->cpu_addr,
-				top->cpu_data_o, top->cpu_data_i,
-				top->cpu_rwb, top->cpu_vpa, top->cpu_vda,
-				top->cpu_vp, top->cpu_abort,
-				false);
-		top->eval();
-		Verilated::timeInc(1);
-		top->clk = !top->clk;
-		trace->dump(ctr++);
-		trace->flush();
+		for (auto byte : sim.uart.received)
+			putchar(byte);
+		sim.uart.received.clear();
+		fflush(stdout);
 	}
+
+	fprintf(stderr, "\nSimulated %lu cycles (%lu CPU cycles)\n",
+			static_cast<unsigned long>(sim.cycles()),
+			static_cast<unsigned long>(sim.cpu_cycles()));
 }